@@ -1,27 +1,83 @@
 import argparse
 import logging
+import os.path as osp
 import pandas as pd
 
-# our package
-import SQLTool
+# our package (only the SQLite stand-in works without it)
+try:
+    import SQLTool
+except ImportError:
+    SQLTool = None
 
-from utils import read_json, check_low_counts, LowCountsFullData, NoCountsFullData
+from data_quality import partition_blocks, profile_blocks, store_blocks
+from hist_store import HistoricalStore
+from partitioned import plan_partitions, download_partitions, combine_partitions
+from sqlite_source import SQLiteSource
+from utils import read_json, write_table, LowCountsFullData, NoCountsFullData
 
 def parse_args() -> argparse.Namespace:
     """Function to parse command line arguments"""
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('info_path', type=str, help='Path to info.json (loading)')
+    parser.add_argument('info_path', type=str, nargs='+', help='Path to info.json (loading) --- several furnaces share one download of the union of their tags')
     parser.add_argument('config_path', type=str, help='Path to config.json (loading)')
-    parser.add_argument('--hist_data_path', type=str, required = False, help='Path to save historical data (saving)', default = "Output/hist_data.csv")
+    parser.add_argument('--hist_data_path', type=str, required = False, help='Path to save historical data (saving) --- .csv, .parquet or .feather (columnar, typed, needs pyarrow). {name} is the furnace of a multi-info download', default = "Output/hist_data.csv")
     parser.add_argument('--missing_tag_path', type=str, required = False, help='Path to save missing tags (saving)', default = "Output/tags_not_in_SQL.csv")
+    parser.add_argument('--quality_report_path', type=str, required = False, help='Path to save the data quality report (saving)', default = "Output/data_quality.csv")
+    parser.add_argument('--max_missing_pct', type=float, required = False, help='Warn about tags missing more than this percentage', default = 20.0)
+    parser.add_argument('--min_flatline', type=int, required = False, help='Min rows of the same value counted as a flatline', default = 12)
+    parser.add_argument('--float32', action='store_true', help='Save the historical data as float32 (half the size)')
+    parser.add_argument('--partition_freq', type=str, required = False, help='Download in date partitions of this pandas frequency (e.g. MS for months), resumable', default = None)
+    parser.add_argument('--partition_dir', type=str, required = False, help='Directory of the downloaded partitions', default = "Output/partitions")
+    parser.add_argument('--tag_group_size', type=int, required = False, help='Max tags per query of a partition', default = 50)
+    parser.add_argument('--n_connections', type=int, required = False, help='Partitions downloaded at the same time', default = 4)
+    parser.add_argument('--store_dir', type=str, required = False, help='Incremental store of the furnace: only the rows after the last stored timestamp of each tag are downloaded', default = None)
+    parser.add_argument('--compact', action='store_true', help='Merge the appended segments of each month of the store')
+    parser.add_argument('--end_date', type=str, required = False, help='Override the end_date of config.json (e.g. to bring the store up to date)', default = None)
+    parser.add_argument('--sqlite_path', type=str, required = False, help='Download from a local SQLite stand-in instead of the SQL server (see sqlite_source.py)', default = None)
     
     args = parser.parse_args()
+    if SQLTool is None and args.sqlite_path is None:
+        parser.error("SQLTool is not installed: install it to download from the SQL server, or give --sqlite_path")
 
     return args
 
 
+def furnace_name(info_path):
+    """Function to name a furnace after its info file (Output/info_f201a.json -> f201a)"""
+    name = osp.splitext(osp.basename(info_path))[0]
+    return name[len('info_'):] if name.startswith('info_') and len(name) > len('info_') else name
+
+
+def furnace_path(path, name):
+    """Function to get the output path of a furnace: {name} is replaced, otherwise _name is added before the extension"""
+    if '{name}' in path:
+        return path.replace('{name}', name)
+    root, extension = osp.splitext(path)
+    return f'{root}_{name}{extension}'
+
+
+def merge_infos(infos):
+    """
+    Function to union the tags of several furnaces (each tag once, in order of first appearance)
+
+    Parameters
+    ----------
+    infos : Dict[str, Dict[str, int]]
+        info (tag -> id) of each furnace
+
+    Returns
+    -------
+    tags : List[str]
+        distinct tags of all the furnaces
+    """
+    tags = {}
+    for info in infos.values():
+        tags.update(dict.fromkeys(info))
+    return list(tags)
+
+
 def main():
 
     args = parse_args()
@@ -40,30 +96,78 @@ def main():
 
     # load in data
     logging.info("Loading files")
-    info = read_json(args.info_path)
+    infos = {furnace_name(info_path): read_json(info_path) for info_path in args.info_path}
+    if len(infos) < len(args.info_path):
+        raise ValueError(f"Two info files have the same furnace name: {', '.join(args.info_path)}")
     config = read_json(args.config_path)
 
-    # scrape data
-    logging.info("Scraping data")
-    hist_data_df, missing_tags = SQLTool.download_and_format(
-        info.keys(),
-        config['client'],
-        config['server'], 
-        -6,
-        start_date =  config['start_date'],
-        end_date =  config['end_date'],
-        rate = config['rate'],
-        unit = config['unit'])
-
-    # save data
-    logging.info("Saving data")
-    hist_data_df.to_csv(args.hist_data_path)
-
-    # save missing tags
-    missing_df = pd.DataFrame({'missing_tags': missing_tags})
-    missing_df.to_csv(args.missing_tag_path, index=False)
-
-    check_low_counts(hist_data_df)
+    # each tag is downloaded once, whatever the number of furnaces that use it
+    tags = merge_infos(infos)
+    if len(infos) > 1:
+        logging.info(f"{len(infos)} furnaces ({', '.join(infos)}): {len(tags)} distinct tags out of {sum(len(info) for info in infos.values())}")
+
+    source = SQLiteSource(args.sqlite_path) if args.sqlite_path is not None else SQLTool
+    if args.end_date is not None:
+        config['end_date'] = args.end_date
+
+    # scrape data (blocks reads the dates of some tags for the data quality report, one partition or month at a time where possible)
+    if args.store_dir is not None:
+        logging.info(f"Updating the store {args.store_dir} up to {config['end_date']}")
+        store = HistoricalStore(args.store_dir, config['rate'], config['unit'])
+        missing_tags = store.update(source, tags, config, config['start_date'], config['end_date'], group_size=args.tag_group_size, n_connections=args.n_connections)
+        if args.compact:
+            store.compact()
+        hist_data_df = store.read(config['start_date'], config['end_date'], tags=[tag for tag in tags if tag not in missing_tags])
+        blocks = lambda columns: store_blocks(store, config['start_date'], config['end_date'], tags=columns)
+    elif args.partition_freq is not None:
+        logging.info(f"Scraping data in partitions ({args.partition_freq} x {args.tag_group_size} tags) to {args.partition_dir}")
+        partitions = plan_partitions(tags, config['start_date'], config['end_date'], freq=args.partition_freq, group_size=args.tag_group_size)
+        download_partitions(source, partitions, config, args.partition_dir, n_connections=args.n_connections)
+        hist_data_df, missing_tags = combine_partitions(partitions, args.partition_dir)
+        blocks = lambda columns: partition_blocks(partitions, args.partition_dir, tags=columns)
+    else:
+        logging.info("Scraping data")
+        hist_data_df, missing_tags = source.download_and_format(
+            tags,
+            config['client'],
+            config['server'], 
+            -6,
+            start_date =  config['start_date'],
+            end_date =  config['end_date'],
+            rate = config['rate'],
+            unit = config['unit'])
+        blocks = lambda columns: [hist_data_df]
+
+    # a furnace without full rows must not stop the others from being saved, its error is raised at the end
+    failures = {}
+    for name, info in infos.items():
+        # a single furnace keeps the paths as given
+        paths = [args.hist_data_path, args.missing_tag_path, args.quality_report_path]
+        if len(infos) > 1:
+            paths = [furnace_path(path, name) for path in paths]
+        hist_data_path, missing_tag_path, quality_report_path = paths
+        columns = [tag for tag in info if tag in hist_data_df.columns]
+
+        # save data
+        logging.info(f"Saving data to {hist_data_path}")
+        write_table(hist_data_df, hist_data_path, float32=args.float32, columns=columns)
+
+        # save missing tags
+        missing_df = pd.DataFrame({'missing_tags': [tag for tag in info if tag in missing_tags]})
+        missing_df.to_csv(missing_tag_path, index=False)
+
+        # data quality report (missing %, gaps, flatlines, range of each tag) and warnings
+        profile = profile_blocks(blocks(columns), columns, min_flatline=args.min_flatline)
+        profile.report().to_csv(quality_report_path)
+        logging.info(f"{profile.full_rows} of {profile.rows} rows with every tag. Data quality report saved to {quality_report_path}")
+        try:
+            profile.check(args.max_missing_pct)
+        except NoCountsFullData as error:
+            failures[name] = error
+
+    if failures:
+        logging.error(f"No full rows for {', '.join(failures)}, the other furnaces were saved")
+        raise next(iter(failures.values()))
 
     return
 
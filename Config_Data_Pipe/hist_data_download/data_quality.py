@@ -0,0 +1,346 @@
+"""
+Single pass data quality profile of downloaded historical data: the data is fed one block of dates at a time (csv chunks, date partitions
+or the months of the store) and only a few numbers per tag are kept, so the whole history never has to be in memory
+
+Per tag: missing %, longest gap (consecutive missing rows), flatlines (runs of the same value, a stuck sensor), min, max and mean. Over all
+tags: rows where every tag has a value. Gaps and flatlines that cross the boundary of two blocks are carried over, so the result does not
+depend on how the data is split (the blocks must be given in date order).
+
+Usage
+-----
+python data_quality.py Output/hist_data.csv --report_path Output/data_quality.csv
+python data_quality.py --store_dir Output/store --start_date 2021-01-01 --end_date 2021-07-01
+"""
+import argparse
+import logging
+import os.path as osp
+import numpy as np
+import pandas as pd
+
+from utils import warn_full_rows, warn_missing_tags
+
+# report columns (one row per tag)
+REPORT_COLUMNS = [
+    'rows', 'missing_pct', 'longest_gap', 'longest_gap_start', 'longest_flatline', 'longest_flatline_start', 'flatline_runs', 'min', 'max', 'mean'
+    ]
+
+
+def parse_args() -> argparse.Namespace:
+    """Function to parse command line arguments"""
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('hist_data_path', type=str, nargs='?', help='Path to the historical data (.csv is read in chunks)', default=None)
+    parser.add_argument('--store_dir', type=str, required = False, help='Profile an incremental store (one month at a time) instead of a file', default = None)
+    parser.add_argument('--start_date', type=str, required = False, help='First date of the store to profile', default = None)
+    parser.add_argument('--end_date', type=str, required = False, help='Last date (exclusive) of the store to profile', default = None)
+    parser.add_argument('--chunksize', type=int, required = False, help='Rows per chunk of a csv file', default = 50000)
+    parser.add_argument('--min_flatline', type=int, required = False, help='Min rows of the same value counted as a flatline', default = 12)
+    parser.add_argument('--max_missing_pct', type=float, required = False, help='Warn about tags missing more than this percentage', default = 20.0)
+    parser.add_argument('--report_path', type=str, required = False, help='Path to save the report (saving)', default = "Output/data_quality.csv")
+
+    args = parser.parse_args()
+    return args
+
+
+def _runs(flags):
+    """
+    Function to find the runs of True in a boolean array
+
+    Parameters
+    ----------
+    flags : np.ndarray
+        1d boolean array
+
+    Returns
+    -------
+    starts : np.ndarray
+        first index of each run
+    lengths : np.ndarray
+        length of each run
+    """
+    edges = np.diff(np.concatenate(([0], flags.view(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    return starts, np.flatnonzero(edges == -1) - starts
+
+
+class DataQualityProfile(object):
+    """
+    Class for the running data quality statistics of a set of tags
+    """
+
+    def __init__(self, tags, min_flatline=12) -> None:
+        """
+        Parameters
+        ----------
+        tags : List[str]
+            tags to profile (columns of the blocks, a tag missing from a block counts as missing)
+        min_flatline : int
+            min rows of the same value counted as a flatline run
+        """
+        self.tags = list(tags)
+        self.min_flatline = min_flatline
+        k = len(self.tags)
+
+        self.rows = 0
+        self.full_rows = 0
+        self.counts = np.zeros(k, dtype=np.int64)
+        self.sums = np.zeros(k)
+        self.mins = np.full(k, np.nan)
+        self.maxs = np.full(k, np.nan)
+
+        # open runs at the end of the last block (length and start date) and the longest run so far
+        self.gap = np.zeros(k, dtype=np.int64)
+        self.gap_start = [None] * k
+        self.longest_gap = np.zeros(k, dtype=np.int64)
+        self.longest_gap_start = [None] * k
+
+        # a flatline of length n is n - 1 consecutive repeats of the first value
+        self.last = np.full(k, np.nan)
+        self.flat = np.zeros(k, dtype=np.int64)
+        self.flat_start = [None] * k
+        self.longest_flat = np.zeros(k, dtype=np.int64)
+        self.longest_flat_start = [None] * k
+        self.flat_runs = np.zeros(k, dtype=np.int64)
+
+    def update(self, block):
+        """
+        Function to add the next block of dates
+
+        Parameters
+        ----------
+        block : pd.DataFrame
+            rows after the previous block (index is the date), one column per tag
+        """
+        if len(block) == 0:
+            return
+
+        dates = block.index
+        n = len(block)
+        full = np.ones(n, dtype=bool)
+
+        # one column at a time by name (a view of float64 columns, the block is never copied), a tag not in the block is missing
+        for j, tag in enumerate(self.tags):
+            values = block[tag].to_numpy(dtype=np.float64) if tag in block.columns else np.full(n, np.nan)
+            missing = np.isnan(values)
+            full &= ~missing
+
+            self.counts[j] += n - missing.sum()
+            self.sums[j] += np.nansum(values)
+            self.mins[j] = np.fmin(self.mins[j], np.fmin.reduce(values))
+            self.maxs[j] = np.fmax(self.maxs[j], np.fmax.reduce(values))
+            self._update_gaps(j, missing, dates)
+            self._update_flatlines(j, values, dates)
+            self.last[j] = values[-1]
+
+        self.rows += n
+        self.full_rows += int(full.sum())
+
+        return
+
+    def _update_gaps(self, j, missing, dates):
+        """Function to extend the gaps of tag j with a block"""
+        starts, lengths = _runs(missing)
+        if len(starts) == 0:
+            self.gap[j] = 0
+            return
+
+        begins = [dates[start] for start in starts]
+        if starts[0] == 0 and self.gap[j] > 0:
+            # the gap of the previous block goes on
+            lengths[0] += self.gap[j]
+            begins[0] = self.gap_start[j]
+
+        best = int(np.argmax(lengths))
+        if lengths[best] > self.longest_gap[j]:
+            self.longest_gap[j], self.longest_gap_start[j] = lengths[best], begins[best]
+
+        self.gap[j], self.gap_start[j] = (lengths[-1], begins[-1]) if missing[-1] else (0, None)
+
+        return
+
+    def _update_flatlines(self, j, values, dates):
+        """Function to extend the flatlines of tag j with a block"""
+        # repeats[i]: values[i] is the same as the row before it (NaN is never the same)
+        repeats = np.empty(len(values), dtype=bool)
+        repeats[0] = values[0] == self.last[j]
+        repeats[1:] = values[1:] == values[:-1]
+        starts, lengths = _runs(repeats)
+        if self.flat[j] > 0 and not repeats[0]:
+            # the flatline of the previous block ended with it
+            self.flat_runs[j] += int(self.flat[j] + 1 >= self.min_flatline)
+
+        if len(starts) > 0:
+            # k repeats from row i are a flatline of k + 1 rows from row i - 1 (flat_start is the row before the block)
+            begins = [dates[start - 1] if start > 0 else self.flat_start[j] for start in starts]
+            lengths[0] += self.flat[j] if starts[0] == 0 else 0
+
+            # runs still open at the end of the block are counted once they end
+            closed = lengths[:-1] if repeats[-1] else lengths
+            self.flat_runs[j] += int((closed + 1 >= self.min_flatline).sum())
+
+            best = int(np.argmax(lengths))
+            if lengths[best] + 1 > self.longest_flat[j]:
+                self.longest_flat[j], self.longest_flat_start[j] = lengths[best] + 1, begins[best]
+
+        if repeats[-1]:
+            self.flat[j], self.flat_start[j] = lengths[-1], begins[-1]
+        else:
+            # the last row may start the next flatline
+            self.flat[j], self.flat_start[j] = 0, dates[-1]
+
+        return
+
+    def report(self):
+        """
+        Function to build the report
+
+        Returns
+        -------
+        report : pd.DataFrame
+            REPORT_COLUMNS of each tag (index is the tag), gaps and flatlines in rows
+        """
+        # a flatline still open at the end of the data is a run too
+        flat_runs = self.flat_runs + ((self.flat > 0) & (self.flat + 1 >= self.min_flatline))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sums / self.counts
+
+        report = pd.DataFrame({
+            'rows': self.rows,
+            'missing_pct': 100 * (1 - self.counts / self.rows) if self.rows else np.nan,
+            'longest_gap': self.longest_gap,
+            'longest_gap_start': self.longest_gap_start,
+            'longest_flatline': self.longest_flat,
+            'longest_flatline_start': self.longest_flat_start,
+            'flatline_runs': flat_runs,
+            'min': self.mins,
+            'max': self.maxs,
+            'mean': np.where(self.counts > 0, mean, np.nan),
+            }, index=pd.Index(self.tags, name='tag'))
+
+        return report[REPORT_COLUMNS]
+
+    def check(self, max_missing_pct=20.0):
+        """
+        Function to log the data quality warnings: tags missing more than max_missing_pct and too few full rows
+
+        Parameters
+        ----------
+        max_missing_pct : float
+            highest acceptable missing percentage of a tag
+
+        Raises
+        ------
+        NoCountsFullData
+            if no row has every tag
+        """
+        warn_missing_tags(self.report()['missing_pct'], max_missing_pct)
+        warn_full_rows(self.full_rows)
+
+        return
+
+
+def profile_blocks(blocks, tags, min_flatline=12):
+    """
+    Function to profile blocks of dates
+
+    Parameters
+    ----------
+    blocks : Iterable[pd.DataFrame]
+        blocks in date order (index is the date)
+    tags : List[str]
+        tags to profile
+    min_flatline : int
+        min rows of the same value counted as a flatline run
+
+    Returns
+    -------
+    profile : DataQualityProfile
+        profile of all the blocks
+    """
+    profile = DataQualityProfile(tags, min_flatline=min_flatline)
+    for block in blocks:
+        profile.update(block)
+    return profile
+
+
+def csv_blocks(path, chunksize=50000):
+    """Function to read a csv file of historical data in chunks (index is the date)"""
+    with pd.read_csv(path, index_col=0, parse_dates=True, chunksize=chunksize) as reader:
+        yield from reader
+
+
+def store_blocks(store, start_date=None, end_date=None, tags=None):
+    """Function to read a HistoricalStore one month at a time (with both dates, every bucket of the range is a row)"""
+    months = [pd.Period(month, freq='M') for month in store.months()]
+    start = pd.Timestamp(start_date) if start_date is not None else (months[0].start_time if months else None)
+    end = pd.Timestamp(end_date) if end_date is not None else (months[-1].end_time.ceil(store.step) if months else None)
+    for month in months:
+        low, high = max(month.start_time, start), min((month + 1).start_time, end)
+        if low < high:
+            yield store.read(low, high, tags=tags)
+
+
+def partition_blocks(partitions, partition_dir, tags=None):
+    """Function to read downloaded partitions one date partition at a time (the tag groups with one of the tags side by side)"""
+    from partitioned import partition_paths
+
+    groups = {}
+    for partition in partitions:
+        if tags is None or not set(partition.tags).isdisjoint(tags):
+            groups.setdefault(partition.start, []).append(partition_paths(partition_dir, partition)[0])
+    for _, paths in sorted(groups.items()):
+        yield pd.concat([pd.read_csv(path, index_col=0, parse_dates=True) for path in paths], axis=1)
+
+
+def main() -> None:
+    """Main Function"""
+    args = parse_args()
+
+    # set up logger
+    formatstr = '%(asctime)s: %(levelname)s: %(funcName)s Line: %(lineno)d %(message)s'
+    datestr = '%m/%d/%Y %H:%M:%S'
+    logging.basicConfig(
+        level=logging.INFO,
+        format=formatstr,
+        datefmt=datestr,
+        handlers=[
+            logging.FileHandler("data_quality.log"),
+            logging.StreamHandler()
+            ]
+        )
+
+    if args.store_dir is not None:
+        from hist_store import HistoricalStore
+        from utils import read_json
+
+        manifest = read_json(osp.join(args.store_dir, 'manifest.json'))
+        store = HistoricalStore(args.store_dir, manifest['rate'], manifest['unit'])
+        tags = sorted(manifest['marks'])
+        blocks = store_blocks(store, args.start_date, args.end_date)
+    elif args.hist_data_path is not None and args.hist_data_path.endswith('.csv'):
+        tags = list(pd.read_csv(args.hist_data_path, index_col=0, nrows=0).columns)
+        blocks = csv_blocks(args.hist_data_path, args.chunksize)
+    elif args.hist_data_path is not None:
+        # parquet and feather are read whole (the date is the index of parquet and the first column of feather, see write_table)
+        if args.hist_data_path.endswith('.feather'):
+            data = pd.read_feather(args.hist_data_path)
+            data = data.set_index(data.columns[0])
+        else:
+            data = pd.read_parquet(args.hist_data_path)
+        tags, blocks = list(data.columns), [data]
+    else:
+        raise ValueError("Give hist_data_path or --store_dir")
+
+    logging.info(f"Profiling {len(tags)} tags")
+    profile = profile_blocks(blocks, tags, min_flatline=args.min_flatline)
+    report = profile.report()
+    report.to_csv(args.report_path)
+    logging.info(f"{profile.rows} rows, {profile.full_rows} rows with every tag. Report saved to {args.report_path}\n{report.round(3).to_string()}")
+
+    profile.check(args.max_missing_pct)
+
+    return
+
+
+if __name__ == '__main__':
+    main()
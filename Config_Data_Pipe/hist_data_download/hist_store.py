@@ -0,0 +1,225 @@
+"""
+Incremental historical store of a furnace: only the rows after the last downloaded timestamp of each tag are fetched and appended
+
+Layout
+------
+store_dir/manifest.json          high-water mark of each tag (last timestamp with a value), rate and unit
+store_dir/YYYY-MM/seg-*.csv      appended segments of the month (index is the date, one column per tag)
+
+Segments are never rewritten by an update. When a month is read, later segments take precedence over earlier ones where they have a value
+(late values fill the gaps of earlier downloads). compact merges the segments of each month into a single segment.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import logging
+import os
+import os.path as osp
+import time
+import pandas as pd
+
+from sqlite_source import UNITS
+from utils import read_json, write_json
+
+
+class HistoricalStore(object):
+    """
+    Class for the month partitioned, append only store of a furnace
+    """
+
+    def __init__(self, store_dir, rate, unit) -> None:
+        """
+        Parameters
+        ----------
+        store_dir : str
+            directory of the store (created if needed)
+        rate : int
+            bucket size of the downloads
+        unit : str
+            unit of the bucket size (seconds, minutes, hours or days)
+        """
+        self.store_dir = store_dir
+        self.step = pd.Timedelta(f'{rate}{UNITS[unit]}')
+        self.manifest_path = osp.join(store_dir, 'manifest.json')
+
+        os.makedirs(store_dir, exist_ok=True)
+        if osp.exists(self.manifest_path):
+            manifest = read_json(self.manifest_path)
+            if (manifest['rate'], manifest['unit']) != (rate, unit):
+                raise ValueError(f"{store_dir} holds {manifest['rate']} {manifest['unit']} data, not {rate} {unit}")
+            self.marks = {tag: pd.Timestamp(mark) for tag, mark in manifest['marks'].items()}
+        else:
+            self.marks = {}
+        self.rate, self.unit = rate, unit
+
+    def _save_manifest(self):
+        """Function to write the manifest (temporary file and rename)"""
+        tmp_path = self.manifest_path + '.tmp'
+        write_json({'rate': self.rate, 'unit': self.unit, 'marks': {tag: str(mark) for tag, mark in sorted(self.marks.items())}}, tmp_path)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _append(self, data):
+        """Function to append data as a new segment of each month it covers"""
+        stamp = time.time_ns()
+        for month, rows in data.groupby(data.index.to_period('M')):
+            month_dir = osp.join(self.store_dir, str(month))
+            os.makedirs(month_dir, exist_ok=True)
+            path = osp.join(month_dir, f'seg-{stamp}.csv')
+            rows.to_csv(path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+    def update(self, source, tags, config, start_date, end_date, group_size=50, n_connections=4):
+        """
+        Function to download the rows after the high-water mark of each tag (tags without a mark from start_date) up to end_date
+
+        Tags with the same mark are downloaded together (group_size tags per query, n_connections queries at a time). The marks are only
+        moved after the data is on disk, so an interrupted update downloads the same rows again on the next run. Tags without any value
+        (e.g. not in SQL) get no mark and are queried from start_date every time.
+
+        Parameters
+        ----------
+        source : SQLTool | SQLiteSource
+            anything with download_and_format
+        tags : List[str]
+            tags of the furnace
+        config : dict
+            client and server
+        start_date : str
+            first date of the tags that are not in the store yet
+        end_date : str
+            last date (exclusive)
+        group_size : int
+            max tags per query
+        n_connections : int
+            queries at the same time
+
+        Returns
+        -------
+        missing_tags : List[str]
+            tags that are not in SQL
+        """
+        logger = logging.getLogger(__name__)
+        end = pd.Timestamp(end_date)
+
+        # one query per group of tags with the same start
+        starts = {}
+        for tag in tags:
+            start = self.marks[tag] + self.step if tag in self.marks else pd.Timestamp(start_date)
+            if start < end:
+                starts.setdefault(start, []).append(tag)
+        queries = [(start, group[k:k + group_size]) for start, group in sorted(starts.items()) for k in range(0, len(group), group_size)]
+        logger.info(f"{len(tags)} tags, {len(tags) - sum(len(group) for group in starts.values())} up to date, {len(queries)} queries")
+
+        def fetch(query):
+            start, group = query
+            return source.download_and_format(
+                group, config['client'], config['server'], -6, start_date=str(start), end_date=str(end), rate=self.rate, unit=self.unit
+                )
+
+        missing_tags = []
+        with ThreadPoolExecutor(max_workers=n_connections) as pool:
+            for (start, group), (data, missing) in zip(queries, pool.map(fetch, queries)):
+                missing_tags.extend(missing)
+                data = data.dropna(how='all')
+                if len(data):
+                    self._append(data)
+                # the mark is the last timestamp with a value (rows that are still empty are downloaded again next time)
+                for tag, mark in data.apply(pd.Series.last_valid_index).dropna().items():
+                    self.marks[tag] = pd.Timestamp(mark)
+                logger.info(f"{len(group)} tags from {start}: {len(data)} rows appended")
+                self._save_manifest()
+
+        return missing_tags
+
+    def months(self):
+        """Function to list the months in the store"""
+        return sorted(osp.basename(path) for path in glob.glob(osp.join(self.store_dir, '*-*')) if osp.isdir(path))
+
+    def read_month(self, month):
+        """
+        Function to read the segments of a month (later segments take precedence where they have a value)
+
+        Parameters
+        ----------
+        month : str
+            YYYY-MM
+
+        Returns
+        -------
+        data : pd.DataFrame
+            data of the month (index is the date)
+        """
+        data = None
+        for path in sorted(glob.glob(osp.join(self.store_dir, month, 'seg-*.csv'))):
+            segment = pd.read_csv(path, index_col=0, parse_dates=True)
+            data = segment if data is None else segment.combine_first(data)
+        return data
+
+    def read(self, start_date=None, end_date=None, tags=None):
+        """
+        Function to read the store
+
+        Parameters
+        ----------
+        start_date : str | None
+            first date (inclusive)
+        end_date : str | None
+            last date (exclusive) --- with both dates every bucket of the range is a row
+        tags : List[str] | None
+            columns to read (None for every tag)
+
+        Returns
+        -------
+        data : pd.DataFrame
+            index is the date, one column per tag
+        """
+        start = pd.Timestamp(start_date) if start_date is not None else None
+        end = pd.Timestamp(end_date) if end_date is not None else None
+
+        blocks = []
+        for month in self.months():
+            period = pd.Period(month, freq='M')
+            if (start is not None and period.end_time < start) or (end is not None and period.start_time >= end):
+                continue
+            blocks.append(self.read_month(month))
+
+        data = pd.concat(blocks, axis=0).sort_index() if blocks else pd.DataFrame(index=pd.DatetimeIndex([], name='Date'))
+        if start is not None:
+            data = data[data.index >= start]
+        if end is not None:
+            data = data[data.index < end]
+        if start is not None and end is not None:
+            # rows without any value are not stored, put them back like a full download
+            data = data.reindex(pd.date_range(start, end, freq=self.step, inclusive='left', name=data.index.name))
+        if tags is not None:
+            data = data.reindex(columns=list(tags))
+
+        return data
+
+    def compact(self):
+        """
+        Function to merge the segments of each month into a single segment
+
+        Returns
+        -------
+        n_merged : int
+            segments removed
+        """
+        logger = logging.getLogger(__name__)
+        n_merged = 0
+        for month in self.months():
+            paths = sorted(glob.glob(osp.join(self.store_dir, month, 'seg-*.csv')))
+            if len(paths) < 2:
+                continue
+
+            # the merged segment sorts after the ones it replaces, so a crash before they are removed changes nothing
+            merged = self.read_month(month)
+            path = osp.join(self.store_dir, month, f'seg-{time.time_ns()}.csv')
+            merged.sort_index().to_csv(path + '.tmp')
+            os.replace(path + '.tmp', path)
+            for old in paths:
+                os.remove(old)
+            n_merged += len(paths) - 1
+
+        logger.info(f"Compaction: {n_merged} segments merged")
+
+        return n_merged
@@ -0,0 +1,217 @@
+"""
+Partitioned historical download: the date range is split into date partitions x tag groups that are fetched concurrently (one connection per
+thread) and written to the partition directory as soon as they finish
+
+Every partition is a data file and a marker (json with the missing tags) written after it. A partition with a marker is skipped, so a
+failed or interrupted run picks up where it stopped. The partition names contain a hash of the tags of the group: changing the tag list
+downloads the changed groups again.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import logging
+import os
+import os.path as osp
+import time
+import pandas as pd
+
+from utils import read_json, write_json
+
+
+class PartitionDownloadError(Exception):
+    def __init__(self, failed) -> None:
+        self.failed = failed
+
+    def __str__(self):
+        return f"{len(self.failed)} partitions failed ({', '.join(self.failed[:5])}{' ...' if len(self.failed) > 5 else ''}). Rerun to download them"
+
+
+class Partition(object):
+    """
+    Class for the dates [start, end) of a group of tags
+    """
+
+    def __init__(self, start, end, group, tags) -> None:
+        """
+        Parameters
+        ----------
+        start : pd.Timestamp
+            first date (inclusive)
+        end : pd.Timestamp
+            last date (exclusive)
+        group : int
+            index of the tag group
+        tags : List[str]
+            tags of the group
+        """
+        self.start = start
+        self.end = end
+        self.group = group
+        self.tags = tags
+
+    @property
+    def name(self):
+        digest = hashlib.md5('\n'.join(self.tags).encode()).hexdigest()[:8]
+        return f'{self.start:%Y%m%d%H%M}_{self.end:%Y%m%d%H%M}_g{self.group:03d}_{digest}'
+
+
+def plan_partitions(tags, start_date, end_date, freq='MS', group_size=50):
+    """
+    Function to split the download into date partitions x tag groups
+
+    Parameters
+    ----------
+    tags : List[str]
+        tags to download
+    start_date : str
+        first date (inclusive)
+    end_date : str
+        last date (exclusive)
+    freq : str
+        pandas frequency of the partition boundaries (e.g. MS for months, QS for quarters)
+    group_size : int
+        max tags per query
+
+    Returns
+    -------
+    partitions : List[Partition]
+        partitions in date order
+    """
+    start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    boundaries = sorted({start, end, *pd.date_range(start, end, freq=freq)})
+    tags = list(tags)
+    groups = [tags[k:k + group_size] for k in range(0, len(tags), group_size)]
+
+    return [Partition(low, high, k, group) for low, high in zip(boundaries[:-1], boundaries[1:]) for k, group in enumerate(groups)]
+
+
+def partition_paths(partition_dir, partition):
+    """Function to get the data file and the marker of a partition"""
+    return osp.join(partition_dir, f'{partition.name}.csv'), osp.join(partition_dir, f'{partition.name}.json')
+
+
+def fetch_partition(source, partition, config, partition_dir, retries=2):
+    """
+    Function to download a partition and write it (data file first, then the marker)
+
+    Parameters
+    ----------
+    source : SQLTool | SQLiteSource
+        anything with download_and_format
+    partition : Partition
+        partition to download
+    config : dict
+        client, server, rate and unit
+    partition_dir : str
+        directory of the partitions
+    retries : int
+        retries of a failed query
+
+    Returns
+    -------
+    rows : int
+        rows downloaded
+    """
+    logger = logging.getLogger(__name__)
+    data_path, marker_path = partition_paths(partition_dir, partition)
+
+    for attempt in range(retries + 1):
+        try:
+            data, missing_tags = source.download_and_format(
+                partition.tags, config['client'], config['server'], -6,
+                start_date=str(partition.start), end_date=str(partition.end), rate=config['rate'], unit=config['unit']
+                )
+            break
+        except Exception as error:
+            if attempt == retries:
+                raise
+            logger.warning(f"{partition.name}: {error!r}, retry {attempt + 1} of {retries}")
+            time.sleep(2 ** attempt)
+
+    # write to a temporary file and rename so a crash never leaves a partial partition behind
+    tmp_path = data_path + '.tmp'
+    data.to_csv(tmp_path)
+    os.replace(tmp_path, data_path)
+    write_json({'missing_tags': list(missing_tags), 'rows': len(data)}, marker_path)
+
+    return len(data)
+
+
+def download_partitions(source, partitions, config, partition_dir, n_connections=4, retries=2):
+    """
+    Function to download the partitions that are not on disk yet, n_connections at a time
+
+    Parameters
+    ----------
+    source : SQLTool | SQLiteSource
+        anything with download_and_format
+    partitions : List[Partition]
+        partitions to download (see plan_partitions)
+    config : dict
+        client, server, rate and unit
+    partition_dir : str
+        directory of the partitions
+    n_connections : int
+        concurrent queries
+    retries : int
+        retries of a failed query
+
+    Raises
+    ------
+    PartitionDownloadError
+        if a partition failed on every retry (the others are kept on disk)
+    """
+    logger = logging.getLogger(__name__)
+    os.makedirs(partition_dir, exist_ok=True)
+
+    todo = [partition for partition in partitions if not osp.exists(partition_paths(partition_dir, partition)[1])]
+    logger.info(f"{len(partitions)} partitions, {len(partitions) - len(todo)} already downloaded, {len(todo)} to download with {n_connections} connections")
+
+    failed = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_connections) as pool:
+        futures = {pool.submit(fetch_partition, source, partition, config, partition_dir, retries): partition for partition in todo}
+        for done, future in enumerate(as_completed(futures), start=1):
+            partition = futures[future]
+            try:
+                rows = future.result()
+                logger.info(f"[{done}/{len(todo)}] {partition.name}: {rows} rows ({time.perf_counter() - start:.1f} s)")
+            except Exception as error:
+                logger.error(f"[{done}/{len(todo)}] {partition.name} failed: {error!r}")
+                failed.append(partition.name)
+
+    if failed:
+        raise PartitionDownloadError(failed)
+
+    return
+
+
+def combine_partitions(partitions, partition_dir):
+    """
+    Function to assemble the downloaded partitions into one DataFrame
+
+    Parameters
+    ----------
+    partitions : List[Partition]
+        partitions (see plan_partitions), all downloaded
+    partition_dir : str
+        directory of the partitions
+
+    Returns
+    -------
+    data : pd.DataFrame
+        every tag over the whole date range (index is the date)
+    missing_tags : List[str]
+        tags that are not in SQL
+    """
+    missing_tags = []
+    blocks = {}
+    for partition in partitions:
+        data_path, marker_path = partition_paths(partition_dir, partition)
+        blocks.setdefault(partition.start, []).append(pd.read_csv(data_path, index_col=0, parse_dates=True))
+        missing_tags.extend(tag for tag in read_json(marker_path)['missing_tags'] if tag not in missing_tags)
+
+    # tag groups side by side, then the date partitions one after the other
+    data = pd.concat([pd.concat(groups, axis=1) for _, groups in sorted(blocks.items())], axis=0)
+    data = data[~data.index.duplicated(keep='first')]
+
+    return data, missing_tags
@@ -0,0 +1,101 @@
+"""
+Local SQLite stand-in for the historian (SQLTool) so the downloads can be tested without the SQL server
+
+The history is stored long: table history (tag, timestamp, value) with timestamps as ISO strings. SQLiteSource.download_and_format has the
+same arguments and returns the same format as SQLTool.download_and_format: one column per tag averaged over rate x unit buckets (index is
+the bucket start, named Date) and the list of the tags that are not in the database.
+"""
+import sqlite3
+import numpy as np
+import pandas as pd
+
+# SQLTool time units -> pandas frequency aliases
+UNITS = {'seconds': 's', 'minutes': 'min', 'hours': 'h', 'days': 'D'}
+
+
+def write_history(db_path, data):
+    """
+    Function to write (append) historical data into a SQLite stand-in
+
+    Parameters
+    ----------
+    db_path : str
+        path to the SQLite file (created if needed)
+    data : pd.DataFrame
+        index is the timestamp, one column per tag
+    """
+    long = data.rename_axis('timestamp').reset_index().melt(id_vars='timestamp', var_name='tag', value_name='value').dropna(subset=['value'])
+    long['timestamp'] = pd.to_datetime(long['timestamp']).dt.strftime('%Y-%m-%d %H:%M:%S')
+
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS history (tag TEXT, timestamp TEXT, value REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS history_tag_timestamp ON history (tag, timestamp)")
+        conn.executemany("INSERT INTO history (tag, timestamp, value) VALUES (?, ?, ?)", long[['tag', 'timestamp', 'value']].itertuples(index=False))
+
+    return
+
+
+class SQLiteSource(object):
+    """
+    Class with the download_and_format interface of SQLTool backed by a SQLite file (one connection per call, so it is thread safe)
+    """
+
+    def __init__(self, db_path) -> None:
+        """
+        Parameters
+        ----------
+        db_path : str
+            path to the SQLite file (see write_history)
+        """
+        self.db_path = db_path
+
+    def download_and_format(self, tags, client, server, property_id, start_date, end_date, rate, unit):
+        """
+        Function to download the tags in [start_date, end_date) averaged over rate x unit buckets
+
+        Parameters
+        ----------
+        tags : List[str]
+            tags to download
+        client : str
+            not used (SQLTool client)
+        server : str
+            not used (SQLTool server)
+        property_id : int
+            not used (SQLTool property id)
+        start_date : str
+            first timestamp (inclusive)
+        end_date : str
+            last timestamp (exclusive)
+        rate : int
+            bucket size
+        unit : str
+            unit of the bucket size (seconds, minutes, hours or days)
+
+        Returns
+        -------
+        data : pd.DataFrame
+            mean of each tag in each bucket (index is the bucket start, named Date)
+        missing_tags : List[str]
+            tags that are not in the database
+        """
+        tags = list(tags)
+        freq = f'{rate}{UNITS[unit]}'
+        start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+
+        with sqlite3.connect(self.db_path) as conn:
+            placeholders = ', '.join('?' * len(tags))
+            known = {row[0] for row in conn.execute(f"SELECT DISTINCT tag FROM history WHERE tag IN ({placeholders})", tags)}
+            long = pd.read_sql_query(
+                f"SELECT tag, timestamp, value FROM history WHERE tag IN ({placeholders}) AND timestamp >= ? AND timestamp < ?",
+                conn, params=[*tags, start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S')]
+                )
+
+        long['timestamp'] = pd.to_datetime(long['timestamp']).dt.floor(freq)
+        data = long.pivot_table(index='timestamp', columns='tag', values='value', aggfunc='mean')
+        index = pd.date_range(start.floor(freq), end, freq=freq, inclusive='left', name='Date')
+        found = [tag for tag in tags if tag in known]
+        data = data.reindex(index=index, columns=found).astype(np.float64)
+        data.columns.name = None
+
+        return data, [tag for tag in tags if tag not in known]
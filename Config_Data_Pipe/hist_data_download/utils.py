@@ -43,6 +43,47 @@ def write_json(data: dict, *args, indent:int = 4, **kwargs) -> None:
     return
 
 
+def write_table(data, path, float32=False, columns=None):
+    """
+    Function to save historical data as csv, parquet or feather (by extension) --- parquet and feather keep the dtypes and the datetime
+    index (needs pyarrow)
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        historical data (index is the date)
+    path : str
+        output path (.csv, .parquet or .feather)
+    float32 : bool
+        downcast the float columns to float32 (half the size, ~7 significant digits)
+    columns : List[str] | None
+        columns to save (None for every column) --- csv writes them from data without a copy
+    """
+    if columns is not None and (float32 or osp.splitext(path)[1] != '.csv'):
+        data = data[columns]
+        columns = None
+    if float32:
+        data = data.astype({column: 'float32' for column in data.columns[data.dtypes == 'float64']})
+
+    extension = osp.splitext(path)[1]
+    if extension == '.csv':
+        data.to_csv(path, columns=columns)
+        return
+
+    try:
+        if extension == '.parquet':
+            data.to_parquet(path)
+        elif extension == '.feather':
+            # feather has no index, the date is stored as a datetime column
+            data.reset_index().to_feather(path)
+        else:
+            raise ValueError(f"{extension} is not supported, use .csv, .parquet or .feather")
+    except ImportError as error:
+        raise ImportError(f"Writing {extension} files needs pyarrow (pip install pyarrow)") from error
+
+    return
+
+
 class LowCountsFullData(Exception):
     def __init__(self, full_rows_count) -> None:
         self.full_rows_count = full_rows_count
@@ -60,24 +101,22 @@ class NoCountsFullData(Exception):
 
 class HighPercentageMissingTag(Exception):
     def __init__(self, high_missing_tag, missing_tag_value) -> None:
-        self.high_missing_tag = missing_tag_value
+        self.high_missing_tag = high_missing_tag
+        self.missing_tag_value = missing_tag_value
 
     def __str__(self):
-        return f"({self.high_missing_tag}) is missing {self.missing_tag_value}"
+        return f"({self.high_missing_tag}) is missing {self.missing_tag_value:.1f}% of its values"
 
 
-def check_low_counts(hist_data):
+def warn_full_rows(full_rows_count):
     """
-    Function that checks number of rows with full data in historical data
+    Function that checks the number of rows with full data (warns when it is low)
     ----------
-    hist_data : pd.DataFrame
-        DataFrame of historical data
+    full_rows_count : int
+        rows where every tag has a value
     """
     logger = logging.getLogger(__name__)
 
-    trim_df = hist_data.dropna().copy()
-    full_rows_count = trim_df.shape[0]
-
     try:
         if full_rows_count == 0:
             raise(NoCountsFullData(full_rows_count))
@@ -87,4 +126,37 @@ def check_low_counts(hist_data):
     except LowCountsFullData as error:
         logger.warning(str(error))
 
-    return True
\ No newline at end of file
+    return True
+
+
+def warn_missing_tags(missing_pct, max_missing_pct=20.0):
+    """
+    Function that warns about the tags missing more than max_missing_pct of their values
+    ----------
+    missing_pct : pd.Series
+        missing percentage of each tag (index is the tag)
+    max_missing_pct : float
+        highest acceptable missing percentage
+    """
+    logger = logging.getLogger(__name__)
+
+    for tag, value in missing_pct[missing_pct > max_missing_pct].items():
+        try:
+            raise(HighPercentageMissingTag(tag, value))
+        except HighPercentageMissingTag as error:
+            logger.warning(str(error))
+
+    return True
+
+
+def check_low_counts(hist_data):
+    """
+    Function that checks number of rows with full data in historical data
+    ----------
+    hist_data : pd.DataFrame
+        DataFrame of historical data
+    """
+    # count the full rows without copying them
+    full_rows_count = int(hist_data.notna().all(axis=1).sum())
+
+    return warn_full_rows(full_rows_count)
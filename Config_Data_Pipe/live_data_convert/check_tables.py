@@ -0,0 +1,91 @@
+"""
+Round-trip check of the parquet and feather historical data files
+
+    1. a frame with a datetime index and float32/float64 columns is written with write_table (hist_data_download)
+    2. it is read back with read_table, with and without columns
+    3. the date must come back as a datetime, the float dtypes and the values unchanged
+
+Skips (exit 0) when pyarrow is not installed. Exits with an error if a check fails.
+
+Usage
+-----
+python check_tables.py
+"""
+import importlib.util
+import logging
+import os.path as osp
+import tempfile
+import numpy as np
+import pandas as pd
+
+# local imports
+from utils import read_table
+
+
+def load_module(name, *path):
+    """Function to import a module of another folder of the repo by path (hist_data_download has its own utils.py)"""
+    spec = importlib.util.spec_from_file_location(name, osp.join(osp.dirname(osp.abspath(__file__)), *path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_data(n_rows=48):
+    """Function to make a small historical data frame with a datetime index"""
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame({
+        'TAG_A': rng.normal(size=n_rows),
+        'TAG_B': rng.normal(size=n_rows).astype('float32'),
+        'TAG_C': rng.normal(size=n_rows),
+        }, index=pd.date_range('2024-01-01', periods=n_rows, freq='h', name='Date'))
+    return data
+
+
+def compare(name, expected, data, failures):
+    """Function to check the date, dtypes and values of a frame read back (date as the index)"""
+    if not pd.api.types.is_datetime64_any_dtype(data.index):
+        failures.append(f"{name}: the date came back as {data.index.dtype}")
+        return
+    if list(data.columns) != list(expected.columns):
+        failures.append(f"{name}: read {list(data.columns)}, expected {list(expected.columns)}")
+        return
+    if not data.dtypes.equals(expected.dtypes):
+        failures.append(f"{name}: dtypes {dict(data.dtypes)}, expected {dict(expected.dtypes)}")
+    if not (data.index.equals(expected.index) and np.array_equal(data.values, expected.values)):
+        failures.append(f"{name}: values differ")
+    return
+
+
+def main() -> None:
+    """Main Function"""
+    # set up logger
+    formatstr = '%(asctime)s: %(levelname)s: %(funcName)s Line: %(lineno)d %(message)s'
+    datestr = '%m/%d/%Y %H:%M:%S'
+    logging.basicConfig(level=logging.INFO, format=formatstr, datefmt=datestr, handlers=[logging.StreamHandler()])
+
+    if importlib.util.find_spec('pyarrow') is None:
+        logging.warning("pyarrow is not installed, skipping the parquet and feather check")
+        return
+
+    write_table = load_module('hist_utils', '..', 'hist_data_download', 'utils.py').write_table
+
+    data = make_data()
+    columns = ['TAG_C', 'TAG_A']
+    failures = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for extension in ['.parquet', '.feather']:
+            path = osp.join(work_dir, f'hist{extension}')
+            write_table(data, path)
+            compare(f"read_table{extension}", data, read_table(path).set_index('Date'), failures)
+            compare(f"read_table{extension} columns", data[columns], read_table(path, columns).set_index('Date'), failures)
+            logging.info(f"Checked {extension}")
+
+    if failures:
+        raise SystemExit("Table check failed:\n" + "\n".join(failures))
+    logging.info("Table check passed")
+
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -12,7 +12,7 @@ def parse_args() -> argparse.Namespace:
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('hist_data_path', type=str, help='Path to info.json')
+    parser.add_argument('hist_data_path', type=str, help='Path to the historical data (csv, parquet or feather)')
     parser.add_argument('info_path', type=str, help='Path to info.json')
     parser.add_argument('mapper_path', type=str, help='Path to Mapper')
     parser.add_argument('config_path', type=str, help='Path to config.json')
@@ -41,7 +41,7 @@ def main():
 
     # load in data
     logging.info("Loading files")
-    hist_df = pd.read_csv(args.hist_data_path)
+    hist_df = utils.read_table(args.hist_data_path)
     info = utils.read_json(args.info_path)
     config = read_json(args.config_path)
     mapper = pd.read_excel(args.mapper_path, config['mapper_sheet'])
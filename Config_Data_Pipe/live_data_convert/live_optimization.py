@@ -0,0 +1,253 @@
+"""
+Live optimization service: watches the incoming folder of the live deployment and writes optimized setpoints back in the same format
+
+Loop
+----
+1. every new file in the incoming folder is parsed with data_mapper.get_data (see data_mapper.read_input_folder)
+2. the ObjectName___PropertyName columns are renamed to the model variables (tag_map in the live config)
+3. each timestamp is optimized with a budget of objective evaluations that fits in the latency budget
+   (seconds per evaluation are calibrated on the first timestamp and updated after every timestamp)
+4. the optimized setpoints are written with data_mapper.put_data (output_tags and output_property_id in the live config) and the input
+   file is moved to the processed folder
+
+With --state-cache a timestamp whose state (controls, noncontrollables and outlet) is within the deadbands (state_deadband in the live
+config) of a recently optimized one reuses its recommendation, and a close state starts the optimizer from it with a reduced budget
+(see state_cache.py).
+
+The model is loaded once at startup. The end to end latency (file arrival to output written) of every file is logged.
+"""
+import argparse
+import logging
+import numpy as np
+import os
+import os.path as osp
+import pandas as pd
+import sys
+import time
+from shutil import move
+
+import data_mapper
+from state_cache import StateCache
+from utils import read_json
+
+# the optimizer lives in Historical_Optimization (flat imports)
+sys.path.append(osp.join(osp.dirname(osp.abspath(__file__)), '..', '..', 'Historical_Optimization', 'Optimization', 'multip_optimization'))
+from main import control_bounds
+from reader import read_model
+from tools import objective, run_optimization, OPTIMIZATION_METHODS
+from tree_engine import compile_model
+
+
+def parse_args() -> argparse.Namespace:
+    """Function to parse command line arguments"""
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('live_config_path', type=str, help='Path to the live config (folders, tag map, output tags, latency budget)')
+    parser.add_argument('opt_config_path', type=str, help='Path to the optimization config (controllable, noncontrollable)')
+    parser.add_argument('model_path', type=str, help='Path to the model pickle (or compiled model directory)')
+    parser.add_argument('c_value', type=float, help='C value')
+    parser.add_argument('--method', type=str, required=False, default='annealing', choices=OPTIMIZATION_METHODS, help='Optimization method')
+    parser.add_argument('--max-iter', type=int, required=False, default=75, help='Max iterations of the optimizer')
+    parser.add_argument('--compile-model', action='store_true', help='Flatten the tree ensemble into numpy arrays at startup (faster predict)')
+    parser.add_argument('--poll-interval', type=float, required=False, default=5.0, help='Seconds between checks of the incoming folder')
+    parser.add_argument('--once', action='store_true', help='Process the files in the incoming folder and exit')
+    parser.add_argument('--state-cache', action='store_true', help='Reuse the recommendation of recently optimized states within the deadbands (state_deadband in the live config)')
+    parser.add_argument('--deadband', type=float, required=False, default=0.0, help='Deadband of the variables missing from state_deadband in the live config (0 means exact match)')
+    parser.add_argument('--state-ttl', type=float, required=False, default=7200.0, help='Seconds (of snapshot time) a cached state is reused')
+
+    args = parser.parse_args()
+
+    return args
+
+
+class LiveOptimizer(object):
+    """
+    Class that holds the model and the optimization settings for the lifetime of the service and optimizes one timestamp at a time
+    """
+
+    def __init__(self, model, opt_config, c, method, maxiter, latency_budget, safety=0.8, state_cache=None) -> None:
+        """
+        Parameters
+        ----------
+        model : Model
+            model that implements predict
+        opt_config : dict
+            optimization config (controllable, noncontrollable)
+        c : float
+            c value
+        method : str
+            optimization method
+        maxiter : int
+            max iterations (the evaluation budget usually stops the optimizer first)
+        latency_budget : float
+            seconds available for each timestamp
+        safety : float
+            fraction of the latency budget spent in the optimizer (the rest covers reading and writing)
+        state_cache : StateCache | None
+            cache of recently optimized states (controls, noncontrollables and outlet), None to optimize every timestamp
+        """
+        self.model = model
+        self.controllable = opt_config['controllable']
+        self.noncontrollable = opt_config['noncontrollable']
+        self.c = c
+        self.method = method
+        self.maxiter = maxiter
+        self.latency_budget = latency_budget
+        self.safety = safety
+        self.state_cache = state_cache
+        # seconds per objective evaluation (None until the first timestamp)
+        self.seconds_per_evaluation = None
+
+    def calibrate(self, controls, noncontrols, outlet, n=50):
+        """Function to measure the seconds per objective evaluation of the model"""
+        start = time.perf_counter()
+        for _ in range(n):
+            objective(controls, noncontrols, self.model, outlet, self.c)
+        self.seconds_per_evaluation = (time.perf_counter() - start) / n
+        logging.info(f"Calibrated {self.seconds_per_evaluation * 1e3:.3f} ms per objective evaluation")
+
+    @property
+    def max_evaluations(self):
+        """Evaluations that fit in the latency budget"""
+        return max(int(self.safety * self.latency_budget / self.seconds_per_evaluation), 1)
+
+    def optimize(self, data):
+        """
+        Function to optimize every timestamp of the data
+
+        Parameters
+        ----------
+        data : pd.DataFrame
+            index is the timestamp, columns are the model variables (controllable, noncontrollable and OUTLET)
+
+        Returns
+        -------
+        out : pd.DataFrame
+            optimal controls (index is the timestamp, columns are the controllable variables)
+        """
+        controllable = list(self.controllable.keys())
+        data = data.dropna(subset=[*controllable, *self.noncontrollable, 'OUTLET'])
+        bounds = control_bounds(data, self.controllable)
+        controls, noncontrols, outlet = data[controllable].values, data[self.noncontrollable].values, data['OUTLET'].values
+
+        out = pd.DataFrame(index=data.index, columns=controllable, dtype=float)
+        for i, timestamp in enumerate(data.index):
+            x0, maxiter = controls[i], self.maxiter
+            if self.state_cache is not None:
+                state = np.concatenate([controls[i], noncontrols[i], [outlet[i]]])
+                now = pd.Timestamp(timestamp).timestamp()
+                kind, recommendation = self.state_cache.lookup(state, now)
+                if kind == 'hit':
+                    # the controls moved by less than the deadbands, keep the recommendation inside today's bounds
+                    out.loc[timestamp] = np.clip(recommendation, bounds[i][:, 0], bounds[i][:, 1])
+                    logging.info(f"{timestamp}: reused the recommendation of a cached state")
+                    continue
+                if kind == 'warm':
+                    x0 = np.clip(recommendation, bounds[i][:, 0], bounds[i][:, 1])
+                    maxiter = max(self.maxiter // 5, 1)
+
+            if self.seconds_per_evaluation is None:
+                self.calibrate(controls[i], noncontrols[i], outlet[i])
+            max_evaluations = self.max_evaluations if maxiter == self.maxiter else max(self.max_evaluations // 5, 1)
+
+            start = time.perf_counter()
+            # the deadline bounds the latency if the evaluations get slower than calibrated
+            _, optimal_controls, success, nit, nfev, timed_out = run_optimization(
+                timestamp, x0, noncontrols[i], self.model, bounds[i], maxiter, outlet[i], self.c, method=self.method,
+                max_evaluations=max_evaluations, deadline=self.safety * self.latency_budget
+                )
+            seconds = time.perf_counter() - start
+
+            # keep the evaluation budget in line with the actual cost
+            self.seconds_per_evaluation = 0.8 * self.seconds_per_evaluation + 0.2 * seconds / max(nfev, 1)
+            out.loc[timestamp] = optimal_controls
+            if self.state_cache is not None:
+                self.state_cache.store(state, optimal_controls, now)
+            logging.info(
+                f"{timestamp}: optimized in {seconds:.3f} s ({nit} iterations, {nfev} evaluations, success: {success}, deadline hit: {timed_out}"
+                f"{', warm start' if maxiter < self.maxiter else ''})"
+                )
+
+        return out
+
+
+def main():
+
+    args = parse_args()
+
+    formatstr = '%(asctime)s: %(levelname)s: %(funcName)s Line: %(lineno)d %(message)s'
+    datestr = '%m/%d/%Y %H:%M:%S'
+    logging.basicConfig(
+        level=logging.INFO,
+        format=formatstr,
+        datefmt=datestr,
+        handlers=[
+            logging.FileHandler('live_optimization.log'),
+            logging.StreamHandler()
+            ]
+        )
+
+    # load everything once
+    logging.info("Loading config, mapping and model")
+    config = read_json(args.live_config_path)
+    opt_config = read_json(args.opt_config_path)
+    sep = config.get('sep', '___')
+    name_to_id, id_to_name = data_mapper.MapperHandler.load_mapping(config['mapping_path'], sep)
+
+    model = read_model(args.model_path)
+    if args.compile_model:
+        model = compile_model(model)
+
+    # tags to read: every model variable, columns are renamed from ObjectName___PropertyName to the model variable
+    tag_map = config['tag_map']
+    rename = {tag: name for name, tag in tag_map.items()}
+    object_ids, property_ids = zip(*[name_to_id[tuple(tag.split(sep))] for tag in tag_map.values()])
+    output_tags = config['output_tags']
+    output_property_id = config.get('output_property_id')
+    if isinstance(output_property_id, dict):
+        # json keys are strings
+        output_property_id = {int(k): v for k, v in output_property_id.items()}
+
+    state_cache = None
+    if args.state_cache:
+        # one deadband per state variable: controls, noncontrols, outlet
+        deadband_map = config.get('state_deadband', {})
+        names = [*opt_config['controllable'].keys(), *opt_config['noncontrollable'], 'OUTLET']
+        state_cache = StateCache([deadband_map.get(name, args.deadband) for name in names], args.state_ttl)
+
+    optimizer = LiveOptimizer(model, opt_config, args.c_value, args.method, args.max_iter, config['latency_budget'], state_cache=state_cache)
+    os.makedirs(config['outgoing_dir'], exist_ok=True)
+    os.makedirs(config['processed_dir'], exist_ok=True)
+
+    logging.info(f"Watching {config['incoming_dir']}")
+    while True:
+        for incoming_file, data in data_mapper.read_input_folder(
+            config['incoming_dir'], config.get('extension', '.csv'), list(object_ids), list(property_ids), id_to_name, sep=sep, sampling_rate=config.get('sampling_rate')
+            ):
+            incoming_path = osp.join(config['incoming_dir'], incoming_file)
+            arrival = osp.getmtime(incoming_path)
+
+            try:
+                out = optimizer.optimize(data.rename(columns=rename))
+                out.columns = [output_tags[name] for name in out.columns]
+                for timestamp in out.index:
+                    data_mapper.put_data(out.loc[[timestamp]], config['outgoing_dir'], name_to_id, sep=sep, output_property_id=output_property_id)
+            except Exception:
+                logging.exception(f"Error optimizing {incoming_file}")
+                move(incoming_path, osp.join('..', 'Error', incoming_file))
+                continue
+
+            move(incoming_path, osp.join(config['processed_dir'], incoming_file))
+            logging.info(f"{incoming_file}: {len(out)} timestamps, end to end latency {time.time() - arrival:.3f} s")
+            if state_cache is not None:
+                logging.info(state_cache.summary())
+
+        if args.once:
+            break
+        time.sleep(args.poll_interval)
+
+    return
+
+if __name__ == '__main__':
+    main()
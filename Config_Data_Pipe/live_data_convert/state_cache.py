@@ -0,0 +1,121 @@
+"""
+Cache of recently optimized operating states for the live service --- when the furnace is steady the snapshots only differ by sensor noise
+and the previous recommendation is reused instead of optimizing again
+
+A state is the current controls, the noncontrollables and the outlet of a timestamp. Two states match when every variable is within its
+deadband (e.g. 0.05 t/h for OIL). A lookup returns:
+    hit  --- the closest cached state matches, its recommendation is reused
+    warm --- the closest cached state is within warm_factor deadbands, its recommendation is the starting point of the optimizer
+    miss --- nothing close enough, full optimization
+
+Entries expire ttl seconds (of snapshot time) after they were stored, so a slow drift cannot keep reusing an old recommendation.
+"""
+from collections import OrderedDict
+import numpy as np
+
+
+class StateCache(object):
+    """
+    Class that stores the recommendation of recently optimized states and looks up new states within the deadbands
+    """
+
+    def __init__(self, deadband, ttl: float, warm_factor: float = 3.0, max_size: int = 256) -> None:
+        """
+        Parameters
+        ----------
+        deadband : List[float] | np.ndarray
+            deadband of each variable of the state (0 means exact match)
+        ttl : float
+            seconds an entry is kept after it was stored
+        warm_factor : float
+            states within warm_factor deadbands are used as warm start (0 to disable)
+        max_size : int
+            max entries kept, the oldest entries are dropped first
+        """
+        self.deadband = np.asarray(deadband, dtype=float)
+        self.ttl = ttl
+        self.warm_factor = warm_factor
+        self.max_size = max_size
+        # key -> (stored at, state, recommendation), oldest first
+        self._entries = OrderedDict()
+        self._counter = 0
+        self.hits = 0
+        self.warm = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def lookups(self):
+        return self.hits + self.warm + self.misses
+
+    @property
+    def hit_rate(self):
+        """Share of the lookups that reused a recommendation"""
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def expire(self, now: float):
+        """Function to drop the entries older than the ttl"""
+        while self._entries:
+            key, (stored, _, _) = next(iter(self._entries.items()))
+            if now - stored <= self.ttl:
+                break
+            del self._entries[key]
+            self.evictions += 1
+
+    def lookup(self, state, now: float):
+        """
+        Function to find the closest cached state
+
+        Parameters
+        ----------
+        state : np.ndarray
+            state of the timestamp (same variables as the deadband)
+        now : float
+            snapshot time in seconds
+
+        Returns
+        -------
+        kind : str
+            hit, warm or miss
+        recommendation : np.ndarray | None
+            recommendation of the closest cached state (None for a miss)
+        """
+        self.expire(now)
+
+        best_distance, best = np.inf, None
+        if self._entries:
+            states = np.stack([entry[1] for entry in self._entries.values()])
+            # distance in deadbands (max over the variables), exact match for the variables without a deadband
+            diff = np.abs(states - np.asarray(state, dtype=float))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scaled = np.where(self.deadband > 0, diff / np.where(self.deadband > 0, self.deadband, 1.0), np.where(diff > 0, np.inf, 0.0))
+            distance = scaled.max(axis=1)
+            i = int(np.argmin(distance))
+            best_distance, best = distance[i], list(self._entries.values())[i][2]
+
+        if best_distance <= 1.0:
+            self.hits += 1
+            return 'hit', best
+        if best_distance <= self.warm_factor:
+            self.warm += 1
+            return 'warm', best
+        self.misses += 1
+        return 'miss', None
+
+    def store(self, state, recommendation, now: float):
+        """Function to store the recommendation of an optimized state"""
+        self._entries[self._counter] = (now, np.asarray(state, dtype=float).copy(), np.asarray(recommendation, dtype=float).copy())
+        self._counter += 1
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def summary(self):
+        """Function to format the hit rate metrics for the log"""
+        return (
+            f"state cache: {self.lookups} lookups, hit rate {100 * self.hit_rate:.1f}%, warm starts {self.warm}, misses {self.misses}, "
+            f"{len(self)} entries, {self.evictions} evicted"
+            )
@@ -59,4 +59,42 @@ def write_json(data: dict, *args, indent:int = 4, **kwargs) -> None:
     with open(out_path, 'w') as fp:
         json.dump(data, fp, indent=indent, **kwargs)
 
-    return
\ No newline at end of file
+    return
+
+
+def read_table(path, columns=None):
+    """
+    Function to read historical data saved by data_download.py (csv, parquet or feather by extension)
+
+    Parameters
+    ----------
+    path : str
+        path to the file
+    columns : List[str] | None
+        columns to read besides the date (None for every column) --- the other columns are skipped while reading
+
+    Returns
+    -------
+    data : pd.DataFrame
+        historical data with the date as the first column
+    """
+    extension = osp.splitext(path)[1]
+    if extension == '.csv':
+        # the date is the first column, whatever its name
+        usecols = None if columns is None else [pd.read_csv(path, nrows=0).columns[0], *columns]
+        return pd.read_csv(path, usecols=usecols)
+
+    try:
+        if extension == '.parquet':
+            # the datetime index is restored from the pandas metadata
+            return pd.read_parquet(path, columns=None if columns is None else list(columns)).reset_index()
+        if extension == '.feather':
+            # feather has no index: the date is the first column (see write_table), its name is in the schema
+            from pyarrow import ipc
+            with ipc.open_file(path) as reader:
+                date = reader.schema.names[0]
+            return pd.read_feather(path, columns=None if columns is None else [date, *columns])
+    except ImportError as error:
+        raise ImportError(f"Reading {extension} files needs pyarrow (pip install pyarrow)") from error
+
+    raise ValueError(f"{extension} is not supported, use .csv, .parquet or .feather")
@@ -1,2 +1,2 @@
-from reader import read_pickle, read_json, read_file
+from reader import read_pickle, read_json, read_file, read_model
 from tools import mp_optimization
@@ -0,0 +1,360 @@
+"""
+Batch runner: runs every furnace / c value combination of a job spec with a single worker pool (replaces opt_script.sh)
+
+Each dataset is read once and copied into shared memory once (the c values of a furnace share it), each worker loads each model once and
+the chunks of the different jobs are interleaved so every core stays busy until the last job is done. Every job is written as soon as its
+last chunk finishes, in the same format as main.py.
+
+Job spec (json)
+---------------
+{
+    "defaults": {"max_iter": 75, "method": "annealing", "pop_size": 64},
+    "jobs": [
+        {
+            "name": "furnace_a",
+            "input": "./Data/furnace_a_val.csv",
+            "model": "./Data/rf_furnace_a.pkl",
+            "config": "./essar_controllable_a_b_c.json",
+            "c_values": [0.01, 0.1, 1],
+            "out_path": "../opt_a_{c}.csv"
+        }
+    ]
+}
+
+The keys of defaults can be overridden in each job: date_label, max_iter, method, pop_size, warm_start, warm_tol, warm_max_iter, stop_tol,
+patience, max_evals and deadline (see main.py). {c} in out_path is replaced by the c value without its decimal point, as
+opt_script.sh named the outputs (0.01 -> 001, 0.1 -> 01, 1 -> 1, 1000 -> 1000).
+
+Usage
+-----
+python batch.py batch_jobs.json --n-cores 8 --compile-model
+"""
+import argparse
+from contextlib import ExitStack
+import datetime
+import logging
+import multiprocessing as mp
+import os
+import os.path as osp
+import numpy as np
+import tempfile
+import time
+from tqdm import tqdm
+
+# local imports
+from main import prepare_data
+from reader import read_json, read_model
+from shared_arrays import SharedArrays, attach_arrays
+from tools import (
+    bind_optimization_results, format_for_pool, log_run_summary, make_chunks, optimize_rows, _worker_state, RESULT_COLUMNS, OPTIMIZATION_METHODS
+    )
+from tree_engine import compile_model
+
+import warnings
+warnings.filterwarnings('ignore')
+
+# settings of a job when neither the job nor the defaults give them
+JOB_DEFAULTS = {
+    'date_label': 'Date',
+    'max_iter': 75,
+    'method': 'annealing',
+    'pop_size': 64,
+    'warm_start': False,
+    'warm_tol': 0.05,
+    'warm_max_iter': None,
+    'stop_tol': 0.0,
+    'patience': None,
+    'max_evals': None,
+    'deadline': None,
+}
+
+
+class JobSpecError(Exception):
+    """
+    Exception raised for an invalid job spec
+    """
+
+    def __init__(self, job, message) -> None:
+        """
+        Parameters
+        ----------
+        job : str
+            name of the job
+        message : str
+            what is wrong with it
+        """
+        self.job = job
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f'Job {self.job}: {self.message}'
+
+
+def parse_args() -> argparse.Namespace:
+    """Function to parse command line arguments"""
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('job_spec', type=str, help='Path to the job spec (json, see the module docstring)')
+    parser.add_argument('--n-cores', type=int, required=False, default=mp.cpu_count(), help='Number of cores to use (default is all)')
+    parser.add_argument('--chunk-size', type=int, required=False, default=None, help='Rows per task (default: about 8 tasks per core for the largest job)')
+    parser.add_argument('--compile-model', action='store_true', help='Flatten the tree ensembles into numpy arrays once (workers memory map them)')
+
+    args = parser.parse_args()
+    return args
+
+
+def c_label(c):
+    """
+    Function to format a c value for an output path: the digits without the decimal point (0.01 -> 001, 0.1 -> 01, 10 -> 10)
+
+    Parameters
+    ----------
+    c : float
+        c value
+
+    Returns
+    -------
+    label : str
+        c value as opt_script.sh wrote it in the file names
+    """
+    return np.format_float_positional(float(c), trim='-').replace('.', '')
+
+
+def expand_jobs(spec):
+    """
+    Function to expand the job spec into one job per c value
+
+    Parameters
+    ----------
+    spec : dict
+        job spec (defaults and jobs)
+
+    Returns
+    -------
+    jobs : List[dict]
+        settings of each job (JOB_DEFAULTS keys, name, input, model, config, c and out_path)
+    """
+    defaults = {**JOB_DEFAULTS, **spec.get('defaults', {})}
+    jobs = []
+    for entry in spec['jobs']:
+        name = entry.get('name', osp.splitext(osp.basename(entry.get('input', '')))[0])
+        missing = [key for key in ('input', 'model', 'config', 'c_values', 'out_path') if key not in entry]
+        if missing:
+            raise JobSpecError(name, f"missing {', '.join(missing)}")
+        unknown = set(entry) - set(JOB_DEFAULTS) - {'name', 'input', 'model', 'config', 'c_values', 'out_path'}
+        if unknown:
+            raise JobSpecError(name, f"unknown settings {', '.join(sorted(unknown))}")
+
+        settings = {**defaults, **entry}
+        if settings['method'] not in OPTIMIZATION_METHODS:
+            raise JobSpecError(name, f"unknown method {settings['method']} (expected one of {', '.join(OPTIMIZATION_METHODS)})")
+        if len(entry['c_values']) > 1 and '{c}' not in entry['out_path']:
+            raise JobSpecError(name, "out_path needs {c} for several c values")
+
+        for c in entry['c_values']:
+            job = {key: value for key, value in settings.items() if key != 'c_values'}
+            jobs.append({**job, 'name': f'{name} (c={c})', 'c': c, 'out_path': entry['out_path'].replace('{c}', c_label(c))})
+
+    return jobs
+
+
+def _init_batch_worker(datasets, jobs):
+    """
+    Pool initializer: attach to the shared arrays of every dataset and job (the models are loaded the first time a job needs them)
+
+    Parameters
+    ----------
+    datasets : Dict[str, Tuple[str, Dict]]
+        model path and SharedArrays.spec (controls, noncontrols, bounds, outlet) of each dataset
+    jobs : List[dict]
+        dataset, SharedArrays.spec of the result, maxiter, c, options and warm of each job (see _init_worker)
+    """
+    _worker_state['models'] = {}
+    _worker_state['datasets'] = {}
+    _worker_state['blocks'] = []
+    for name, (model_path, spec) in datasets.items():
+        arrays, blocks = attach_arrays(spec)
+        _worker_state['datasets'][name] = (model_path, arrays)
+        _worker_state['blocks'].extend(blocks)
+
+    _worker_state['jobs'] = []
+    for job in jobs:
+        arrays, blocks = attach_arrays(job['result'])
+        _worker_state['jobs'].append({**job, 'result': arrays['result']})
+        _worker_state['blocks'].extend(blocks)
+
+
+def _batch_chunk(task):
+    """
+    Function to optimize the rows [start, stop) of a job (see tools.optimize_rows)
+
+    Parameters
+    ----------
+    task : Tuple[int, int, int]
+        job index, start and stop row
+
+    Returns
+    -------
+    task : Tuple[int, int, int]
+        job index, start and stop row (the rows are now in the result array of the job)
+    """
+    index, start, stop = task
+    job = _worker_state['jobs'][index]
+    model_path, arrays = _worker_state['datasets'][job['dataset']]
+
+    # each model is loaded once per worker, whatever the number of jobs that use it
+    if model_path not in _worker_state['models']:
+        _worker_state['models'][model_path] = read_model(model_path)
+
+    state = {
+        'arrays': {**arrays, 'result': job['result']},
+        'model': _worker_state['models'][model_path],
+        'maxiter': job['maxiter'],
+        'c': job['c'],
+        'options': job['options'],
+        'warm': job['warm'],
+        'cache': None,
+        }
+    optimize_rows(state, start, stop)
+
+    return task
+
+
+def interleave(chunks_per_job):
+    """
+    Function to order the tasks round robin across the jobs (chunk 0 of every job, then chunk 1 ...)
+
+    Parameters
+    ----------
+    chunks_per_job : List[List[Tuple[int, int]]]
+        (start, stop) chunks of each job
+
+    Returns
+    -------
+    tasks : List[Tuple[int, int, int]]
+        (job index, start, stop) of every chunk
+    """
+    tasks = []
+    for k in range(max((len(chunks) for chunks in chunks_per_job), default=0)):
+        for index, chunks in enumerate(chunks_per_job):
+            if k < len(chunks):
+                tasks.append((index, *chunks[k]))
+    return tasks
+
+
+def main() -> None:
+    """Main Function"""
+    start = datetime.datetime.now()
+    mp.set_start_method("spawn")
+    args = parse_args()
+
+    # set up logger
+    formatstr = '%(asctime)s: %(levelname)s: %(funcName)s Line: %(lineno)d %(message)s'
+    datestr = '%m/%d/%Y %H:%M:%S'
+    logging.basicConfig(
+        level=logging.INFO,
+        format=formatstr,
+        datefmt=datestr,
+        handlers=[
+            logging.FileHandler('batch.log'),
+            logging.StreamHandler()
+            ]
+        )
+
+    assert args.n_cores > 1 and args.n_cores <= mp.cpu_count(), f"NumberOfCoresError: Number of cores must be greater than 1 but less than {mp.cpu_count()}. Recieved {args.n_cores}"
+
+    jobs = expand_jobs(read_json(args.job_spec))
+    logging.info(f"{len(jobs)} jobs from {args.job_spec}")
+
+    # the exact method needs the compiled trees
+    compiled = {job['model'] for job in jobs if args.compile_model or job['method'] == 'exact'}
+
+    with ExitStack() as stack:
+        # compile each model once, the workers memory map the node arrays
+        model_paths = {}
+        for job in jobs:
+            if job['model'] not in model_paths:
+                model_paths[job['model']] = job['model']
+                if job['model'] in compiled:
+                    logging.info(f"Compiling {job['model']}")
+                    compiled_dir = stack.enter_context(tempfile.TemporaryDirectory())
+                    compile_model(read_model(job['model'])).save(compiled_dir)
+                    model_paths[job['model']] = compiled_dir
+
+        # read each dataset (input + config) once
+        datasets, dataset_specs = {}, {}
+        for job in jobs:
+            key = (job['input'], job['config'], job['date_label'], job['model'])
+            if key not in datasets:
+                config = read_json(job['config'])
+                logging.info(f"Reading {job['input']}")
+                data, bounds, outlet = prepare_data(job['input'], job['date_label'], config)
+                dates, arrays = format_for_pool(data, job['date_label'], config['controllable'].keys(), config['noncontrollable'], bounds, outlet)
+
+                shared = stack.enter_context(SharedArrays(arrays))
+                datasets[key] = {'name': f'dataset_{len(datasets)}', 'dates': dates, 'controls': list(config['controllable'].keys()), 'rows': len(dates)}
+                dataset_specs[datasets[key]['name']] = (model_paths[job['model']], shared.spec)
+
+            job['dataset'] = datasets[key]
+
+        # one shared result array per job
+        worker_jobs = []
+        for job in jobs:
+            dataset = job['dataset']
+            result = np.full((dataset['rows'], len(dataset['controls']) + len(RESULT_COLUMNS)), np.nan)
+            job['shared'] = stack.enter_context(SharedArrays({'result': result}))
+            worker_jobs.append({
+                'dataset': dataset['name'],
+                'result': job['shared'].spec,
+                'maxiter': job['max_iter'],
+                'c': job['c'],
+                'options': {
+                    'method': job['method'], 'popsize': job['pop_size'], 'deadline': job['deadline'],
+                    'stop_tol': job['stop_tol'], 'patience': job['patience'], 'max_evaluations': job['max_evals'],
+                    },
+                'warm': {'tol': job['warm_tol'], 'maxiter': job['warm_max_iter'] or max(job['max_iter'] // 5, 1)} if job['warm_start'] else None,
+                })
+
+        chunksize = args.chunk_size or max(max(dataset['rows'] for dataset in datasets.values()) // (args.n_cores * 8), 1)
+        chunks_per_job = [make_chunks(job['dataset']['rows'], chunksize) for job in jobs]
+        remaining = [len(chunks) for chunks in chunks_per_job]
+        tasks = interleave(chunks_per_job)
+        logging.info(f"{len(datasets)} datasets, {len(set(model_paths.values()))} models, {len(tasks)} chunks of {chunksize} rows on {args.n_cores} cores")
+
+        run_start = time.perf_counter()
+
+        def write_job(index):
+            # written as soon as the job is done, while the other jobs keep running
+            job = jobs[index]
+            out = bind_optimization_results(job['dataset']['dates'], job['shared']['result'].copy(), job['date_label'], job['dataset']['controls'])
+            out_dir = osp.dirname(job['out_path'])
+            if out_dir:
+                os.makedirs(out_dir, exist_ok=True)
+            out.to_csv(job['out_path'])
+            logging.info(f"{job['name']}: saved {len(out)} rows to {job['out_path']} ({time.perf_counter() - run_start:.1f} s since start)")
+            if len(out):
+                log_run_summary(out)
+
+        # a job without rows has no chunks: its (empty) output is written now
+        for index, count in enumerate(remaining):
+            if count == 0:
+                logging.warning(f"{jobs[index]['name']}: no rows to optimize in {jobs[index]['input']}")
+                write_job(index)
+
+        pool = stack.enter_context(mp.get_context("spawn").Pool(processes=args.n_cores, initializer=_init_batch_worker, initargs=(dataset_specs, worker_jobs)))
+        with tqdm(total=sum(job['dataset']['rows'] for job in jobs)) as progress:
+            for index, chunk_start, chunk_stop in pool.imap_unordered(_batch_chunk, tasks):
+                progress.update(chunk_stop - chunk_start)
+                remaining[index] -= 1
+                if remaining[index] == 0:
+                    write_job(index)
+
+    run_time = datetime.datetime.now() - start
+    logging.info(f"Total run time: {run_time.total_seconds() / 60:.3f} (minutes)")
+
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+"""
+Benchmark of mp_optimization on synthetic furnaces
+
+A synthetic dataset and a random forest are built for each config (same controllable / noncontrollable columns as the furnace configs),
+then every combination of method, max iterations and core count is run on it and compared with a high budget reference run:
+    rows/sec, objective evaluations per row, p50/p99 per row latency (wall time of each row in the workers) and the objective gap of each
+    row versus the reference
+
+The results are saved as JSON (sorted keys) so runs of different versions can be diffed.
+
+Usage
+-----
+python benchmark.py bench.json --methods annealing population --max-iters 25 75 --n-cores 2 4
+"""
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing as mp
+import numpy as np
+import os
+import os.path as osp
+import pandas as pd
+import pickle
+import platform
+import time
+from sklearn.ensemble import RandomForestRegressor
+
+# local imports
+from main import prepare_data
+from reader import read_json
+from tools import mp_optimization, OPTIMIZATION_METHODS
+from tree_engine import compile_model
+
+import warnings
+warnings.filterwarnings('ignore')
+
+# (low, high) of the synthetic controllable variables (the other columns are scaled random walks)
+CONTROL_RANGES = {
+    'OIL': (2.0, 6.0),
+    'GAS': (5.0, 15.0),
+    'COMBUSTION_AIR': (200.0, 400.0),
+    'INLET_TEMP': (200.0, 230.0),
+}
+
+
+def parse_args() -> argparse.Namespace:
+    """Function to parse command line arguments"""
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('out_path', type=str, help='Path to save the results (json)')
+    parser.add_argument('--config-paths', type=str, nargs='+', required=False, default=['essar_controllable_a_b_c.json', 'essar_controllable_d.json'], help='Furnace configs (one synthetic furnace per config)')
+    parser.add_argument('--work-dir', type=str, required=False, default='benchmark_data', help='Directory for the synthetic data and models (reused if they exist)')
+    parser.add_argument('--n-rows', type=int, required=False, default=200, help='Rows per synthetic furnace')
+    parser.add_argument('--n-trees', type=int, required=False, default=100, help='Trees of the synthetic random forests')
+    parser.add_argument('--methods', type=str, nargs='+', required=False, default=['annealing', 'population'], choices=OPTIMIZATION_METHODS, help='Methods to benchmark')
+    parser.add_argument('--max-iters', type=int, nargs='+', required=False, default=[25, 75], help='Max iterations to benchmark')
+    parser.add_argument('--n-cores', type=int, nargs='+', required=False, default=[2], help='Core counts to benchmark')
+    parser.add_argument('--c-value', type=float, required=False, default=1.0, help='C value')
+    parser.add_argument('--reference-method', type=str, required=False, default='annealing', choices=OPTIMIZATION_METHODS, help='Method of the reference run')
+    parser.add_argument('--reference-max-iter', type=int, required=False, default=500, help='Max iterations of the reference run')
+    parser.add_argument('--compile-model', action='store_true', help='Benchmark the compiled model (see tree_engine.py) instead of the pickled forest')
+    parser.add_argument('--seed', type=int, required=False, default=0, help='Seed for the synthetic data')
+
+    args = parser.parse_args()
+    return args
+
+
+def make_furnace(config, n_rows, n_trees, seed):
+    """
+    Function to build a synthetic furnace: data with the columns of the config and a random forest of the outlet temperature
+
+    Parameters
+    ----------
+    config : dict
+        furnace config (controllable, noncontrollable)
+    n_rows : int
+        number of rows (half hourly timestamps)
+    n_trees : int
+        number of trees of the random forest
+    seed : int
+        seed of the random number generator
+
+    Returns
+    -------
+    data : pd.DataFrame
+        Date, controllable, noncontrollable and OUTLET columns
+    model : RandomForestRegressor
+        model of the outlet trained on the data (controllable columns first, then the noncontrollable columns)
+    """
+    rng = np.random.default_rng(seed)
+    controllable = list(config['controllable'].keys())
+    noncontrollable = config['noncontrollable']
+
+    def random_walk(low, high):
+        # slowly moving signal in [low, high] (consecutive timestamps are close like the plant data)
+        steps = rng.normal(0, 0.05, n_rows).cumsum()
+        steps = (steps - steps.min()) / max(np.ptp(steps), 1e-12)
+        return low + (high - low) * np.clip(0.7 * steps + 0.3 * rng.uniform(0, 1, n_rows), 0, 1)
+
+    data = pd.DataFrame({'Date': pd.date_range('2021-01-01', periods=n_rows, freq='30min')})
+    for name in controllable:
+        data[name] = random_walk(*CONTROL_RANGES.get(name, (0.0, 1.0)))
+    for name in noncontrollable:
+        data[name] = random_walk(0.0, 1.0)
+
+    # outlet rises with the fuel, has an optimum in the air and is shifted by the noncontrollables
+    fuel = data[controllable[0]] + data[controllable[1]]
+    outlet = 250 + 6 * fuel - 40 * ((data[controllable[2]] - 300) / 100) ** 2 if len(controllable) > 2 else 250 + 6 * fuel
+    if len(controllable) > 3:
+        outlet = outlet + 0.5 * (data[controllable[3]] - 215)
+    outlet = outlet + data[noncontrollable].values @ rng.uniform(-10, 10, len(noncontrollable))
+    data['OUTLET'] = outlet + rng.normal(0, 1, n_rows)
+
+    model = RandomForestRegressor(n_estimators=n_trees, max_depth=10, random_state=seed, n_jobs=1)
+    model.fit(data[[*controllable, *noncontrollable]].values, data['OUTLET'].values)
+
+    return data, model
+
+
+def run_case(data, bounds, outlet, config, model, model_path, method, maxiter, n_cores, c):
+    """
+    Function to run one benchmark case
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        input data (see main.prepare_data)
+    bounds : np.ndarray
+        rows x controls x (lower, upper)
+    outlet : pd.Series
+        outlet of each row
+    config : dict
+        furnace config
+    model : Model
+        model that implements predict
+    model_path : str
+        path to the model pickle (loaded by the workers)
+    method : str
+        optimization method
+    maxiter : int
+        max iterations
+    n_cores : int
+        number of processes
+    c : float
+        c value
+
+    Returns
+    -------
+    case : dict
+        timings and evaluations of the case
+    objective : np.ndarray
+        objective at the optimal controls of each row
+    """
+    controllable = list(config['controllable'].keys())
+    noncontrollable = config['noncontrollable']
+
+    start = time.perf_counter()
+    out = mp_optimization(data, data.index.name, controllable, noncontrollable, bounds, model, maxiter, n_cores, outlet, c, method=method, model_path=model_path)
+    seconds = time.perf_counter() - start
+
+    case = {
+        'method': method,
+        'maxiter': maxiter,
+        'n_cores': n_cores,
+        'seconds': seconds,
+        'rows_per_sec': len(data) / seconds,
+        'evaluations_per_row': float(out['Evaluations'].mean()),
+        'latency_p50': float(out['Wall_Time'].quantile(0.5)),
+        'latency_p99': float(out['Wall_Time'].quantile(0.99)),
+        'predict_share': float(out['Predict_Time'].sum() / out['Wall_Time'].sum()) if out['Predict_Time'].notna().any() else None,
+        'success_rate': float(out['Success'].mean()),
+        'current_objective': float(out['Nonoptimized_Objective'].mean()),
+    }
+
+    return case, out['Optimized_Objective'].values
+
+
+def main() -> None:
+    """Main Function"""
+    mp.set_start_method("spawn")
+    args = parse_args()
+
+    # set up logger
+    formatstr = '%(asctime)s: %(levelname)s: %(funcName)s Line: %(lineno)d %(message)s'
+    datestr = '%m/%d/%Y %H:%M:%S'
+    logging.basicConfig(level=logging.INFO, format=formatstr, datefmt=datestr, handlers=[logging.StreamHandler()])
+
+    if max(args.n_cores) > mp.cpu_count():
+        logging.warning(f"Benchmarking up to {max(args.n_cores)} cores on a machine with {mp.cpu_count()}")
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(), 'cpu_count': mp.cpu_count()},
+        'settings': {key: value for key, value in vars(args).items() if key not in ('out_path', 'work_dir')},
+        'furnaces': {},
+    }
+
+    for k, config_path in enumerate(args.config_paths):
+        name = osp.splitext(osp.basename(config_path))[0]
+        config = read_json(config_path)
+        controllable = list(config['controllable'].keys())
+        noncontrollable = config['noncontrollable']
+
+        # synthetic data and model (built once and reused)
+        data_path = osp.join(args.work_dir, f'{name}_val.csv')
+        model_path = osp.join(args.work_dir, f'{name}_rf.pkl')
+        if not (osp.exists(data_path) and osp.exists(model_path)):
+            logging.info(f"Building synthetic furnace {name}")
+            synthetic, model = make_furnace(config, args.n_rows, args.n_trees, args.seed + k)
+            synthetic.to_csv(data_path, index=False)
+            with open(model_path, 'wb') as f:
+                pickle.dump(model, f)
+
+        with open(model_path, 'rb') as f:
+            model = pickle.load(f)
+        if args.compile_model:
+            model = compile_model(model)
+            model_path = osp.join(args.work_dir, f'{name}_compiled')
+            model.save(model_path)
+        data, bounds, outlet = prepare_data(data_path, 'Date', config)
+
+        logging.info(f"{name}: reference run ({args.reference_method}, maxiter {args.reference_max_iter}) on {len(data)} rows")
+        reference, reference_objective = run_case(data, bounds, outlet, config, model, model_path, args.reference_method, args.reference_max_iter, max(args.n_cores), args.c_value)
+
+        cases = []
+        for method in args.methods:
+            for maxiter in args.max_iters:
+                for n_cores in args.n_cores:
+                    case, case_objective = run_case(data, bounds, outlet, config, model, model_path, method, maxiter, n_cores, args.c_value)
+                    gap = case_objective - reference_objective
+                    case['gap_mean'] = float(gap.mean())
+                    case['gap_p99'] = float(np.percentile(gap, 99))
+                    case['better_than_reference'] = float((gap < 0).mean())
+                    cases.append(case)
+
+                    logging.info(
+                        f"{name} {method} maxiter={maxiter} cores={n_cores}: {case['rows_per_sec']:.2f} rows/s, {case['evaluations_per_row']:.0f} evaluations/row, "
+                        f"latency p50 {case['latency_p50']:.3f} s / p99 {case['latency_p99']:.3f} s, gap mean {case['gap_mean']:.4f} / p99 {case['gap_p99']:.4f}"
+                        )
+
+        report['furnaces'][name] = {
+            'rows': len(data),
+            'current_objective': reference['current_objective'],
+            'reference': {**reference, 'objective': float(reference_objective.mean())},
+            'cases': cases,
+        }
+
+    with open(args.out_path, 'w') as f:
+        json.dump(report, f, indent=4, sort_keys=True)
+    logging.info(f"Results saved to {args.out_path}")
+
+    return
+
+
+if __name__ == '__main__':
+    main()
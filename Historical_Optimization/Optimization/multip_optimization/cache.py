@@ -0,0 +1,93 @@
+"""
+Prediction cache around a Model --- rows that were already predicted are not sent to the model again
+
+The cache is meant to live for a single timestamp (the noncontrollables are fixed) and be cleared before the next one.
+
+Optionally the controls are quantized to an instrument resolution before they are looked up (e.g. 0.01 t/h for OIL): every control vector
+in the same bin gets the prediction of the first one that was evaluated, and the cache can be bounded (least recently used rows are dropped).
+"""
+from collections import OrderedDict
+import numpy as np
+
+
+class CachedModel(object):
+    """
+    Class that wraps a Model and memoizes predict row by row (implements predict so it can be used as a Model)
+    """
+
+    def __init__(self, model, resolution=None, max_size: int = None) -> None:
+        """
+        Parameters
+        ----------
+        model : Model
+            model that implements predict
+        resolution : List[float] | np.ndarray | None
+            quantization step of the leading features of each row (the controls) --- 0 (or None for every feature) means exact match
+        max_size : int | None
+            max rows kept in the cache, the least recently used rows are dropped first (None for no limit)
+        """
+        self.model = model
+        self.resolution = None if resolution is None else np.asarray(resolution, dtype=float)
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def keys(self, data):
+        """Function to get the cache key of each row of data (n_rows x n_features)"""
+        if self.resolution is not None:
+            n = len(self.resolution)
+            quantized = self.resolution > 0
+            data = data.copy()
+            data[:, :n][:, quantized] = np.round(data[:, :n][:, quantized] / self.resolution[quantized])
+        return [row.tobytes() for row in data]
+
+    def predict(self, formatted_data):
+        """
+        Function to predict the rows, only the rows that are not in the cache are sent to the model (in a single call)
+
+        Parameters
+        ----------
+        formatted_data : np.ndarray
+            input data (n_rows x n_features)
+
+        Returns
+        -------
+        out : np.ndarray
+            prediction for each row (n_rows,)
+        """
+        data = np.atleast_2d(np.asarray(formatted_data, dtype=float))
+        keys = self.keys(data)
+        out = np.empty(len(keys))
+
+        missing = {}
+        for i, key in enumerate(keys):
+            if key in self._cache:
+                out[i] = self._cache[key]
+                self._cache.move_to_end(key)
+            else:
+                # duplicates within the batch are only predicted once
+                missing.setdefault(key, []).append(i)
+
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            first_rows = [rows[0] for rows in missing.values()]
+            predictions = np.asarray(self.model.predict(data[first_rows])).ravel()
+            for (key, rows), prediction in zip(missing.items(), predictions):
+                self._cache[key] = prediction
+                out[rows] = prediction
+
+            if self.max_size is not None:
+                while len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+
+        return out
+
+    def clear(self):
+        """Function to empty the cache (the hit/miss counts are kept)"""
+        self._cache.clear()
@@ -0,0 +1,135 @@
+"""
+Regression check of stream_optimization on a synthetic furnace
+
+    1. a model whose predict raises: the error must reach the caller (no hang) and the shared memory must be unlinked
+    2. a working model: every row is written once, and a second run with the same arguments has nothing left to do
+
+Exits with an error if a check fails.
+
+Usage
+-----
+python check_stream.py --n-cores 2 --timeout 300
+"""
+import argparse
+import logging
+import multiprocessing as mp
+import os
+import os.path as osp
+import tempfile
+import threading
+import pandas as pd
+
+# local imports
+from benchmark import make_furnace
+from main import control_bounds
+from reader import read_json
+from tools import stream_optimization
+
+import warnings
+warnings.filterwarnings('ignore')
+
+
+class FailingModel(object):
+    """
+    Class for a model whose predict always raises (module level so the spawned workers can unpickle it)
+    """
+
+    def predict(self, X):
+        raise ValueError("predict failed on purpose")
+
+
+def parse_args() -> argparse.Namespace:
+    """Function to parse command line arguments"""
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--config-path', type=str, required=False, default='essar_controllable_a_b_c.json', help='Furnace config of the synthetic furnace')
+    parser.add_argument('--n-rows', type=int, required=False, default=24, help='Rows of the synthetic furnace')
+    parser.add_argument('--n-cores', type=int, required=False, default=2, help='Number of cores to use')
+    parser.add_argument('--timeout', type=float, required=False, default=300.0, help='Seconds after which a run counts as hung')
+
+    args = parser.parse_args()
+    return args
+
+
+def shared_segments():
+    """Function to list the shared memory segments of SharedArrays (empty where /dev/shm does not exist)"""
+    return {name for name in os.listdir('/dev/shm') if name.startswith('psm_')} if osp.isdir('/dev/shm') else set()
+
+
+def run_with_timeout(timeout, **kwargs):
+    """
+    Function to run stream_optimization in a thread
+
+    Returns
+    -------
+    outcome : Tuple[str, ?]
+        ('hung', None), ('error', exception) or ('done', rows optimized)
+    """
+    outcome = {}
+
+    def target():
+        try:
+            outcome['done'] = stream_optimization(**kwargs)
+        except Exception as error:
+            outcome['error'] = error
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        return 'hung', None
+    return next(iter(outcome.items()))
+
+
+def main() -> None:
+    """Main Function"""
+    mp.set_start_method("spawn")
+    args = parse_args()
+
+    # set up logger
+    formatstr = '%(asctime)s: %(levelname)s: %(funcName)s Line: %(lineno)d %(message)s'
+    datestr = '%m/%d/%Y %H:%M:%S'
+    logging.basicConfig(level=logging.INFO, format=formatstr, datefmt=datestr, handlers=[logging.StreamHandler()])
+
+    config = read_json(args.config_path)
+    controllable = list(config['controllable'].keys())
+    data, model = make_furnace(config, args.n_rows, n_trees=5, seed=0)
+    data = data.set_index('Date')
+    settings = {
+        'data': data, 'date_label': 'Date', 'controllable_vars': controllable, 'noncontrollable_vars': config['noncontrollable'],
+        'control_bounds': control_bounds(data, config['controllable']), 'maxiter': 2, 'n_process': args.n_cores, 'outlet': data['OUTLET'],
+        'c': 1.0, 'chunksize': 4, 'max_in_flight': 2,
+        }
+
+    failures = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        # 1. failing model
+        before = shared_segments()
+        status, value = run_with_timeout(args.timeout, model=FailingModel(), out_path=osp.join(work_dir, 'failing.csv'), **settings)
+        leaked = shared_segments() - before
+        if status != 'error' or 'predict failed on purpose' not in str(value):
+            failures.append(f"failing model: expected the predict error, got {status} {value!r}")
+        if leaked:
+            failures.append(f"failing model: shared memory not unlinked ({', '.join(sorted(leaked))})")
+        logging.info(f"Failing model: {status} {value!r}")
+
+        # 2. working model, then a resume with nothing left
+        out_path = osp.join(work_dir, 'working.csv')
+        first = run_with_timeout(args.timeout, model=model, out_path=out_path, **settings)
+        second = run_with_timeout(args.timeout, model=model, out_path=out_path, **settings)
+        out = pd.read_csv(out_path)
+        if first != ('done', len(data)) or second != ('done', 0):
+            failures.append(f"working model: runs returned {first} and {second}, expected ('done', {len(data)}) and ('done', 0)")
+        if len(out) != len(data) or out['Date'].duplicated().any():
+            failures.append(f"working model: {len(out)} rows written for {len(data)} timestamps")
+        logging.info(f"Working model: {first}, resume: {second}, {len(out)} rows written")
+
+    if failures:
+        raise SystemExit("Stream check failed:\n" + "\n".join(failures))
+    logging.info("Stream check passed")
+
+    return
+
+
+if __name__ == '__main__':
+    main()
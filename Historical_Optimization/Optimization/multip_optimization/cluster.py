@@ -0,0 +1,110 @@
+"""
+Operating state clustering to avoid optimizing the same operating point many times
+
+Rows are quantized on every controllable, noncontrollable and outlet value (one tolerance per variable) and the rows that land in the same
+bin form a cluster. Only one representative per cluster is optimized, within the intersection of the bounds of all its members, and the
+optimal controls are copied back to every member. Clusters whose bounds do not intersect are not merged.
+"""
+import numpy as np
+
+
+def cluster_rows(arrays, tolerances):
+    """
+    Function to group the rows that are within the tolerances of each other (same quantization bin)
+
+    Parameters
+    ----------
+    arrays : Dict[str, np.ndarray]
+        controls (rows x controls), noncontrols (rows x noncontrols), bounds (rows x controls x 2) and outlet (rows,) --- see format_for_pool
+    tolerances : np.ndarray
+        bin width of each variable in the order: controls, noncontrols, outlet (0 means the values must match exactly)
+
+    Returns
+    -------
+    labels : np.ndarray
+        cluster of each row (rows,)
+    representatives : Dict[str, np.ndarray]
+        controls, noncontrols, bounds and outlet of one representative per cluster (bounds are the intersection of the members' bounds and
+        the controls are clipped to them)
+    """
+    values = np.column_stack([arrays['controls'], arrays['noncontrols'], arrays['outlet']])
+    tolerances = np.asarray(tolerances, dtype=float)
+    keys = np.where(tolerances > 0, np.floor(values / np.where(tolerances > 0, tolerances, 1)), values)
+
+    _, labels = np.unique(keys, axis=0, return_inverse=True)
+    labels = labels.ravel()
+    lower, upper = _intersect_bounds(arrays['bounds'], labels)
+
+    # members of clusters without a common feasible box are optimized on their own
+    empty = np.any(lower > upper, axis=1)
+    if empty.any():
+        split = np.isin(labels, np.flatnonzero(empty))
+        labels = labels.copy()
+        labels[split] = labels.max() + 1 + np.arange(split.sum())
+        _, labels = np.unique(labels, return_inverse=True)
+        labels = labels.ravel()
+        lower, upper = _intersect_bounds(arrays['bounds'], labels)
+
+    # first row of each cluster is the representative ... number the clusters in the order of their first row (keeps the time order)
+    first = np.full(labels.max() + 1, len(labels))
+    np.minimum.at(first, labels, np.arange(len(labels)))
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    labels, first, lower, upper = rank[labels], first[order], lower[order], upper[order]
+
+    representatives = {
+        'controls': np.clip(arrays['controls'][first], lower, upper),
+        'noncontrols': arrays['noncontrols'][first],
+        'bounds': np.stack([lower, upper], axis=-1),
+        'outlet': arrays['outlet'][first],
+        }
+
+    return labels, representatives
+
+
+def _intersect_bounds(bounds, labels):
+    """Function to intersect the (rows x controls x 2) bounds of the rows of each cluster"""
+    n_clusters = labels.max() + 1
+    lower = np.full((n_clusters, bounds.shape[1]), -np.inf)
+    upper = np.full((n_clusters, bounds.shape[1]), np.inf)
+    np.maximum.at(lower, labels, bounds[:, :, 0])
+    np.minimum.at(upper, labels, bounds[:, :, 1])
+    return lower, upper
+
+
+def approximation_error(model, arrays, labels, representatives, optimal_controls, c):
+    """
+    Function to measure the error of using the representative's solution for every member of its cluster
+
+    The objective of each member at the shared solution (its own noncontrollables and outlet) is compared with the objective of the
+    representative at the same solution (one batched predict over all the rows).
+
+    Parameters
+    ----------
+    model : Model
+        model that implements predict
+    arrays : Dict[str, np.ndarray]
+        rows of every member (see cluster_rows)
+    labels : np.ndarray
+        cluster of each row
+    representatives : Dict[str, np.ndarray]
+        representative of each cluster (see cluster_rows)
+    optimal_controls : np.ndarray
+        optimal controls of each representative (clusters x controls)
+    c : float
+        c value
+
+    Returns
+    -------
+    error : np.ndarray
+        absolute objective difference of each row
+    """
+    # imported here: tools imports this module
+    from tools import objective_values
+
+    controls = optimal_controls[labels]
+    member = objective_values(controls, arrays['noncontrols'], model, arrays['outlet'], c)
+    representative = objective_values(optimal_controls, representatives['noncontrols'], model, representatives['outlet'], c)[labels]
+
+    return np.abs(member - representative)
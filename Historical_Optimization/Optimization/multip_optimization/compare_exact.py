@@ -0,0 +1,133 @@
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+import time
+
+# local imports
+from exact import branch_and_bound
+from main import prepare_data
+from reader import read_json, read_model
+from tools import run_optimization, objective
+from tree_engine import compile_model
+
+import warnings
+warnings.filterwarnings('ignore')
+
+
+def parse_args() -> argparse.Namespace:
+    """Function to parse command line arguments"""
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('input_file', type=str, help='Path to the input file')
+    parser.add_argument('c_value', type=float, help='C value')
+    parser.add_argument('--date-label', type=str, required=False, default='Date', help='Column Label for the date')
+    parser.add_argument('--config-path', type=str, required=False, default='controllable.json', help='Path to the config file')
+    parser.add_argument('--model-path', type=str, required=False, default='model.pkl', help='Path to model pickle file')
+    parser.add_argument('--max-iter', type=int, required=False, default=75, help='Max iterations for dual annealing')
+    parser.add_argument('--n-rows', type=int, required=False, default=50, help='Number of rows to compare (random sample)')
+    parser.add_argument('--seed', type=int, required=False, default=0, help='Seed for the row sample')
+    parser.add_argument('--report-path', type=str, required=False, default='exact_report.csv', help='Path to save the per row report')
+
+    args = parser.parse_args()
+    return args
+
+
+class CountingModel(object):
+    """Class that wraps a Model and counts the rows sent to predict"""
+
+    def __init__(self, model) -> None:
+        self.model = model
+        self.n_rows = 0
+
+    def predict(self, formatted_data):
+        data = np.atleast_2d(formatted_data)
+        self.n_rows += len(data)
+        return self.model.predict(data)
+
+
+def compare_row(model, controllable, noncontrollable, bounds, outlet, c, maxiter):
+    """
+    Function to run dual annealing and the exact optimizer on a single row
+
+    Parameters
+    ----------
+    model : FlatForest
+        compiled model (used by both optimizers so the runtimes are comparable)
+    controllable : np.ndarray
+        controllable variables
+    noncontrollable : np.ndarray
+        noncontrollable variables
+    bounds : np.ndarray
+        (lower, upper) for each controllable variable
+    outlet : float
+        outlet value
+    c : float
+        c value
+    maxiter : int
+        max iterations for dual annealing
+
+    Returns
+    -------
+    row : Dict[str, float]
+        objective, runtime and model evaluations of each optimizer
+    """
+    row = {'Current_Objective': objective(controllable, noncontrollable, model, outlet, c)}
+
+    counter = CountingModel(model)
+    start = time.perf_counter()
+    _, x, _, _, _, _ = run_optimization(None, controllable, noncontrollable, counter, bounds, maxiter, outlet, c, method='annealing')
+    row['Annealing_Time'] = time.perf_counter() - start
+    row['Annealing_Objective'] = objective(x, noncontrollable, model, outlet, c)
+    row['Annealing_Evaluations'] = counter.n_rows
+
+    # the exact optimizer counts its own forest traversals (interval bounds + point evaluations)
+    start = time.perf_counter()
+    result = branch_and_bound(model, controllable, noncontrollable, bounds, outlet, c)
+    row['Exact_Time'] = time.perf_counter() - start
+    row['Exact_Objective'] = objective(result.x, noncontrollable, model, outlet, c)
+    row['Exact_Evaluations'] = result.nfev
+    row['Exact_Proven'] = result.success
+
+    return row
+
+
+def main() -> None:
+    """Main Function"""
+    args = parse_args()
+
+    # set up logger
+    formatstr = '%(asctime)s: %(levelname)s: %(funcName)s Line: %(lineno)d %(message)s'
+    datestr = '%m/%d/%Y %H:%M:%S'
+    logging.basicConfig(level=logging.INFO, format=formatstr, datefmt=datestr, handlers=[logging.StreamHandler()])
+
+    config = read_json(args.config_path)
+    controllable = list(config['controllable'].keys())
+    noncontrollable = config['noncontrollable']
+
+    model = compile_model(read_model(args.model_path))
+    data, bounds, outlet = prepare_data(args.input_file, args.date_label, config)
+
+    rows = np.random.default_rng(args.seed).choice(len(data), size=min(args.n_rows, len(data)), replace=False)
+    rows.sort()
+
+    report = [None] * len(rows)
+    for k, i in enumerate(rows):
+        report[k] = compare_row(model, data[controllable].values[i], data[noncontrollable].values[i], bounds[i], outlet.values[i], args.c_value, args.max_iter)
+        logging.info(f"Row {k + 1}/{len(rows)}: annealing {report[k]['Annealing_Objective']:.4f} ({report[k]['Annealing_Time']:.2f} s), exact {report[k]['Exact_Objective']:.4f} ({report[k]['Exact_Time']:.2f} s)")
+
+    report = pd.DataFrame(report, index=data.index[rows])
+    report['Gap'] = report['Annealing_Objective'] - report['Exact_Objective']
+    report.to_csv(args.report_path)
+
+    logging.info(f"Exact optimum proven on {report['Exact_Proven'].mean():.1%} of the rows")
+    logging.info(f"Annealing objective above the exact optimum: mean {report['Gap'].mean():.4f}, max {report['Gap'].max():.4f} (exact better on {(report['Gap'] > 1e-9).mean():.1%} of the rows)")
+    logging.info(f"Runtime per row: annealing {report['Annealing_Time'].mean():.3f} s, exact {report['Exact_Time'].mean():.3f} s")
+    logging.info(f"Model evaluations per row: annealing {report['Annealing_Evaluations'].mean():.0f}, exact {report['Exact_Evaluations'].mean():.0f}")
+    logging.info(f"Report saved to {args.report_path}")
+
+    return
+
+
+if __name__ == '__main__':
+    main()
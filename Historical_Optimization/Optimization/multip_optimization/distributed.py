@@ -0,0 +1,455 @@
+"""
+Distributed optimization: a coordinator hands out row range chunks to workers on any number of hosts (multiprocessing.connection sockets)
+
+Protocol (pickled messages over an authenticated connection)
+--------------------------------------------------------------
+coordinator -> worker: ('setup', settings)            model, maxiter, c, options and warm (once per connection)
+coordinator -> worker: ('chunk', (start, stop), rows)  controls, noncontrols, bounds and outlet of the rows
+worker -> coordinator: ('result', (start, stop), result)  rows of the result array (see tools.RESULT_COLUMNS)
+worker -> coordinator: ('error', (start, stop), traceback)
+coordinator -> worker: ('stop', None, None)
+
+A chunk is retried (on whichever worker asks next) when its worker reports an error, disconnects or does not answer within the chunk timeout,
+up to max_retries times. The results are written into the result array as they come back.
+
+Usage
+-----
+# coordinator with 4 local stand-in workers
+python distributed.py coordinator ./Data/furnace_a_val.csv ../opt_a_1.csv 1 --config-path essar_controllable_a_b_c.json --model-path ./Data/rf_furnace_a.pkl --local-workers 4
+# coordinator reachable from other hosts (without --authkey a random key is written to --authkey-file, readable by the owner only)
+python distributed.py coordinator ./Data/furnace_a_val.csv ../opt_a_1.csv 1 --config-path essar_controllable_a_b_c.json --model-path ./Data/rf_furnace_a.pkl --bind 0.0.0.0:6000
+# worker on another host (with a copy of the key file, or --authkey <key>)
+python distributed.py worker --address coordinator-host:6000 --authkey-file distributed.key
+
+The messages are pickles, so anyone with the key can run code on the coordinator and the workers: the coordinator only listens on
+localhost unless --bind says otherwise, and there is no default key.
+"""
+import argparse
+import datetime
+import logging
+import multiprocessing as mp
+from multiprocessing.connection import Client, Listener
+import numpy as np
+import os
+import pickle
+import queue
+import secrets
+import threading
+import time
+import traceback
+from tqdm import tqdm
+
+# local imports
+from main import prepare_data
+from reader import read_json, read_model
+from tools import bind_optimization_results, format_for_pool, log_run_summary, make_chunks, optimize_rows, RESULT_COLUMNS, OPTIMIZATION_METHODS
+from tree_engine import compile_model
+
+import warnings
+warnings.filterwarnings('ignore')
+
+
+class ChunkFailedError(Exception):
+    """
+    Exception raised when a chunk failed on every retry
+    """
+
+    def __init__(self, chunk, attempts, reason) -> None:
+        """
+        Parameters
+        ----------
+        chunk : Tuple[int, int]
+            start and stop row
+        attempts : int
+            number of attempts
+        reason : str
+            error of the last attempt
+        """
+        self.chunk = chunk
+        self.attempts = attempts
+        self.reason = reason
+        super().__init__(self.reason)
+
+    def __str__(self):
+        return f'Rows {self.chunk[0]}-{self.chunk[1]} failed {self.attempts} times, last error: {self.reason}'
+
+
+def parse_address(address):
+    """Function to parse host:port into a (host, port) tuple"""
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def write_authkey(path, authkey):
+    """Function to write a key to a file that only the owner can read (replaced if it exists)"""
+    if os.path.exists(path):
+        os.remove(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(authkey)
+
+
+def read_authkey(path):
+    """Function to read a key written by write_authkey"""
+    with open(path, 'r') as fp:
+        return fp.read().strip()
+
+
+def parse_args() -> argparse.Namespace:
+    """Function to parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='role', required=True)
+
+    coordinator = subparsers.add_parser('coordinator', help='Hand out the rows of the input file and save the results')
+    coordinator.add_argument('input_file', type=str, help='Path to the input file')
+    coordinator.add_argument('out_path', type=str, help='Path to the output file (including the directory)')
+    coordinator.add_argument('c_value', type=float, help='C value')
+    coordinator.add_argument('--date-label', type=str, required=False, default='Date', help='Column Label for the date')
+    coordinator.add_argument('--max-iter', type=int, required=False, default=75, help='Max iterations of the optimizer')
+    coordinator.add_argument('--config-path', type=str, required=False, default='controllable.json', help='Path to the config file')
+    coordinator.add_argument('--model-path', type=str, required=False, default='model.pkl', help='Path to model pickle file (sent to the workers)')
+    coordinator.add_argument('--method', type=str, required=False, default='annealing', choices=OPTIMIZATION_METHODS, help='Optimization method')
+    coordinator.add_argument('--pop-size', type=int, required=False, default=64, help='Candidates per generation for the population search and differential evolution')
+    coordinator.add_argument('--compile-model', action='store_true', help='Send the flattened tree ensemble (see tree_engine.py) to the workers')
+    coordinator.add_argument('--chunk-size', type=int, required=False, default=32, help='Rows per chunk')
+    coordinator.add_argument('--bind', type=str, required=False, default='127.0.0.1:6000', help='host:port the coordinator listens on (e.g. 0.0.0.0:6000 for workers on other hosts)')
+    coordinator.add_argument('--authkey', type=str, required=False, default=None, help='Shared key of the coordinator and the workers (default: a random key written to --authkey-file)')
+    coordinator.add_argument('--authkey-file', type=str, required=False, default='distributed.key', help='File the random key is written to (readable by the owner only) when --authkey is not given')
+    coordinator.add_argument('--max-retries', type=int, required=False, default=3, help='Retries of a failed chunk before the run is aborted')
+    coordinator.add_argument('--chunk-timeout', type=float, required=False, default=600.0, help='Seconds to wait for the result of a chunk before it is retried')
+    coordinator.add_argument('--local-workers', type=int, required=False, default=0, help='Local worker processes to start (stand-in for remote hosts)')
+
+    worker = subparsers.add_parser('worker', help='Optimize the chunks of a coordinator')
+    worker.add_argument('--address', type=str, required=True, help='host:port of the coordinator')
+    worker.add_argument('--authkey', type=str, required=False, default=None, help='Shared key of the coordinator and the workers')
+    worker.add_argument('--authkey-file', type=str, required=False, default=None, help='File with the shared key (see the coordinator --authkey-file)')
+    worker.add_argument('--retry-connect', type=float, required=False, default=30.0, help='Seconds to keep trying to reach the coordinator')
+
+    args = parser.parse_args()
+    if args.role == 'worker' and (args.authkey is None) == (args.authkey_file is None):
+        parser.error("the worker needs one of --authkey or --authkey-file")
+    return args
+
+
+class Coordinator(object):
+    """
+    Class that serves the chunks of a run to the connected workers (one thread per connection) and collects the results
+    """
+
+    def __init__(self, arrays, model, maxiter, c, options, warm=None, chunksize=32, max_retries=3, chunk_timeout=600.0) -> None:
+        """
+        Parameters
+        ----------
+        arrays : Dict[str, np.ndarray]
+            controls, noncontrols, bounds and outlet (see tools.format_for_pool)
+        model : Model
+            model that implements predict (pickled once and sent to every worker)
+        maxiter : int
+            max iterations
+        c : float
+            c value
+        options : Dict[str, ?]
+            additional keyword arguments to run_optimization
+        warm : Dict[str, float] | None
+            warm start settings (see tools._init_worker) --- applied within each chunk
+        chunksize : int
+            rows per chunk
+        max_retries : int
+            retries of a failed chunk before the run is aborted
+        chunk_timeout : float
+            seconds to wait for the result of a chunk
+        """
+        self.arrays = arrays
+        self.settings = pickle.dumps({'model': model, 'maxiter': maxiter, 'c': c, 'options': options, 'warm': warm})
+        self.max_retries = max_retries
+        self.chunk_timeout = chunk_timeout
+
+        n_rows, n_controls = arrays['controls'].shape
+        self.result = np.full((n_rows, n_controls + len(RESULT_COLUMNS)), np.nan)
+        self.chunks = make_chunks(n_rows, chunksize)
+        self._pending = queue.Queue()
+        for chunk in self.chunks:
+            self._pending.put(chunk)
+        self._attempts = {chunk: 0 for chunk in self.chunks}
+        self._remaining = len(self.chunks)
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._error = None
+        self._progress = None
+        self.workers = 0
+        self.retries = 0
+
+    def _fail(self, chunk, reason):
+        """Function to put a failed chunk back in the queue (or abort the run after max_retries)"""
+        logger = logging.getLogger(__name__)
+        with self._lock:
+            self._attempts[chunk] += 1
+            if self._attempts[chunk] > self.max_retries:
+                self._error = ChunkFailedError(chunk, self._attempts[chunk], reason)
+                self._done.set()
+                return
+            self.retries += 1
+        logger.warning(f"Rows {chunk[0]}-{chunk[1]} failed ({reason.strip().splitlines()[-1]}), retry {self._attempts[chunk]} of {self.max_retries}")
+        self._pending.put(chunk)
+
+    def _complete(self, chunk, result):
+        """Function to write the result of a chunk"""
+        start, stop = chunk
+        with self._lock:
+            self.result[start:stop] = result
+            self._remaining -= 1
+            if self._progress is not None:
+                self._progress.update(stop - start)
+            if self._remaining == 0:
+                self._done.set()
+
+    def _serve(self, conn, peer):
+        """Function to hand out chunks to a worker until the run is done or the worker fails"""
+        logger = logging.getLogger(__name__)
+        chunk = None
+        try:
+            conn.send(('setup', None, self.settings))
+            while not self._done.is_set():
+                try:
+                    chunk = self._pending.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+
+                start, stop = chunk
+                rows = {name: array[start:stop] for name, array in self.arrays.items()}
+                conn.send(('chunk', chunk, rows))
+                if not conn.poll(self.chunk_timeout):
+                    raise TimeoutError(f"no result after {self.chunk_timeout} s")
+
+                kind, returned, payload = conn.recv()
+                if kind == 'result' and returned == chunk:
+                    self._complete(chunk, payload)
+                else:
+                    self._fail(chunk, payload if kind == 'error' else f"unexpected message {kind}")
+                chunk = None
+
+            conn.send(('stop', None, None))
+        except (EOFError, OSError, TimeoutError) as err:
+            logger.warning(f"Worker {peer} lost: {err!r}")
+            if chunk is not None:
+                self._fail(chunk, f"worker {peer} lost: {err!r}")
+        finally:
+            conn.close()
+            with self._lock:
+                self.workers -= 1
+
+    def _accept(self, listener):
+        """Function to accept worker connections (a thread per worker) until the listener is closed"""
+        logger = logging.getLogger(__name__)
+        while not self._done.is_set():
+            try:
+                conn = listener.accept()
+            except (OSError, EOFError):
+                # closed at the end of the run (or a failed handshake)
+                if self._done.is_set():
+                    return
+                continue
+            peer = listener.last_accepted
+            with self._lock:
+                self.workers += 1
+            logger.info(f"Worker connected from {peer[0]}:{peer[1]} ({self.workers} connected)")
+            threading.Thread(target=self._serve, args=(conn, f'{peer[0]}:{peer[1]}'), daemon=True).start()
+
+    def run(self, address, authkey):
+        """
+        Function to listen for workers and serve every chunk
+
+        Parameters
+        ----------
+        address : Tuple[str, int]
+            (host, port) to listen on
+        authkey : bytes
+            shared key of the coordinator and the workers
+
+        Returns
+        -------
+        result : np.ndarray
+            optimal controls and RESULT_COLUMNS of each row
+        """
+        logger = logging.getLogger(__name__)
+        listener = Listener(address, authkey=authkey)
+        logger.info(f"Listening on {listener.address[0]}:{listener.address[1]}, {len(self.chunks)} chunks, model and settings {len(self.settings) / 1e6:.2f} MB per worker")
+
+        threading.Thread(target=self._accept, args=(listener,), daemon=True).start()
+        with tqdm(total=len(self.result)) as self._progress:
+            self._done.wait()
+        self._progress = None
+        listener.close()
+
+        if self._error is not None:
+            raise self._error
+        logger.info(f"All {len(self.chunks)} chunks done ({self.retries} retries)")
+
+        return self.result
+
+
+def connect(address, authkey, retry_connect):
+    """Function to connect to the coordinator, retrying for retry_connect seconds (it may not be listening yet)"""
+    give_up = time.perf_counter() + retry_connect
+    while True:
+        try:
+            return Client(address, authkey=authkey)
+        except ConnectionRefusedError:
+            if time.perf_counter() > give_up:
+                raise
+            time.sleep(0.5)
+
+
+def run_worker(address, authkey, retry_connect=30.0):
+    """
+    Function to connect to a coordinator and optimize its chunks until it says stop
+
+    A worker that loses its connection (e.g. the coordinator timed out one of its chunks) connects again, and exits once the coordinator is
+    gone.
+
+    Parameters
+    ----------
+    address : Tuple[str, int]
+        (host, port) of the coordinator
+    authkey : bytes
+        shared key of the coordinator and the workers
+    retry_connect : float
+        seconds to keep trying to reach the coordinator
+    """
+    logger = logging.getLogger(__name__)
+    conn = connect(address, authkey, retry_connect)
+
+    while True:
+        try:
+            with conn:
+                _, _, settings = conn.recv()
+                settings = pickle.loads(settings)
+                logger.info(f"Worker {os.getpid()} connected to {address[0]}:{address[1]}")
+
+                while True:
+                    kind, chunk, rows = conn.recv()
+                    if kind == 'stop':
+                        return
+
+                    try:
+                        n_rows, n_controls = rows['controls'].shape
+                        state = {
+                            'arrays': {**rows, 'result': np.full((n_rows, n_controls + len(RESULT_COLUMNS)), np.nan)},
+                            'model': settings['model'],
+                            'maxiter': settings['maxiter'],
+                            'c': settings['c'],
+                            'options': settings['options'],
+                            'warm': settings['warm'],
+                            'cache': None,
+                            }
+                        optimize_rows(state, 0, n_rows)
+                        result = ('result', chunk, state['arrays']['result'])
+                    except Exception:
+                        result = ('error', chunk, traceback.format_exc())
+                    conn.send(result)
+        except (EOFError, OSError) as err:
+            logger.warning(f"Worker {os.getpid()} lost the coordinator ({err!r}), reconnecting")
+
+        try:
+            conn = connect(address, authkey, retry_connect=5.0)
+        except OSError:
+            # the run is over
+            return
+
+
+def start_local_workers(address, authkey, n_workers):
+    """
+    Function to start worker processes on this host (stand-in for remote hosts)
+
+    Parameters
+    ----------
+    address : Tuple[str, int]
+        (host, port) of the coordinator
+    authkey : bytes
+        shared key of the coordinator and the workers
+    n_workers : int
+        number of processes
+
+    Returns
+    -------
+    workers : List[mp.Process]
+        started processes
+    """
+    # a coordinator bound to every interface is reached on localhost
+    host = '127.0.0.1' if address[0] in ('', '0.0.0.0') else address[0]
+    workers = [mp.get_context("spawn").Process(target=run_worker, args=((host, address[1]), authkey), daemon=True) for _ in range(n_workers)]
+    for worker in workers:
+        worker.start()
+
+    return workers
+
+
+def main() -> None:
+    """Main Function"""
+    start = datetime.datetime.now()
+    args = parse_args()
+
+    # set up logger
+    formatstr = '%(asctime)s: %(levelname)s: %(funcName)s Line: %(lineno)d %(message)s'
+    datestr = '%m/%d/%Y %H:%M:%S'
+    logging.basicConfig(
+        level=logging.INFO,
+        format=formatstr,
+        datefmt=datestr,
+        handlers=[
+            logging.FileHandler(f'distributed_{args.role}.log'),
+            logging.StreamHandler()
+            ]
+        )
+    if args.role == 'worker':
+        authkey = args.authkey if args.authkey is not None else read_authkey(args.authkey_file)
+        run_worker(parse_address(args.address), authkey.encode(), args.retry_connect)
+        return
+
+    # no shared default key: anyone who knows the key can send pickles to the coordinator and the workers (never logged)
+    if args.authkey is None:
+        args.authkey = secrets.token_hex(16)
+        write_authkey(args.authkey_file, args.authkey)
+        logging.info(f"Random key written to {args.authkey_file}: workers connect with --address <this host>:{parse_address(args.bind)[1]} --authkey-file <copy of {args.authkey_file}>")
+    authkey = args.authkey.encode()
+
+    logging.info("Reading Config and Data")
+    config = read_json(args.config_path)
+    controllable = list(config['controllable'].keys())
+    noncontrollable = config['noncontrollable']
+    model = read_model(args.model_path)
+    if args.compile_model or args.method == 'exact':
+        model = compile_model(model)
+
+    data, bounds, outlet = prepare_data(args.input_file, args.date_label, config)
+    dates, arrays = format_for_pool(data, args.date_label, controllable, noncontrollable, bounds, outlet)
+
+    options = {'method': args.method, 'popsize': args.pop_size}
+    coordinator = Coordinator(arrays, model, args.max_iter, args.c_value, options, chunksize=args.chunk_size, max_retries=args.max_retries, chunk_timeout=args.chunk_timeout)
+
+    address = parse_address(args.bind)
+    workers = start_local_workers(address, authkey, args.local_workers) if args.local_workers else []
+
+    run_start = time.perf_counter()
+    result = coordinator.run(address, authkey)
+    seconds = time.perf_counter() - run_start
+    for worker in workers:
+        worker.join(timeout=5)
+
+    out = bind_optimization_results(dates, result, args.date_label, controllable)
+    log_run_summary(out, seconds)
+
+    out_dir = os.path.dirname(args.out_path)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    logging.info(f"Saving results to {args.out_path}")
+    out.to_csv(args.out_path)
+
+    run_time = datetime.datetime.now() - start
+    logging.info(f"Total run time: {run_time.total_seconds() / 60:.3f} (minutes)")
+
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+"""
+Exact optimizer for tree ensembles (branch and bound over the cells of the split thresholds)
+
+A tree ensemble prediction is constant between the split thresholds, so the bounded control box of a row is cut into a grid of cells by the
+thresholds of the controllable features that fall inside the bounds. Inside a cell the prediction is constant and the fuel term (oil + gas)
+is smallest at the lowest point of the cell, so the problem reduces to picking the best cell.
+
+The cells are searched with branch and bound:
+    lower bound of a box of cells = lowest fuel in the box + c * distance from the outlet to the [min, max] prediction interval of the box
+    (the interval comes from the leaves of each tree that the box can reach)
+    upper bound = the objective at the lowest corner of each box (evaluated with the model when the box is created)
+Boxes are split along the axis with the most cells until the best lower bound left is not better than the best point found, which makes the
+answer optimal over the cell grid (the search is stopped with success=False if max_nodes boxes are processed first).
+"""
+import heapq
+import numpy as np
+from scipy.optimize import OptimizeResult
+import time
+
+# split_cell for nodes that never go left (-1) / always go left (leaves and noncontrol splits that go left)
+_NEVER_LEFT = -1
+_ALWAYS_LEFT = np.iinfo(np.int64).max
+
+
+def control_splits(forest, n_controls, bounds):
+    """
+    Function to get the split thresholds of each controllable feature that fall inside the bounds
+
+    Parameters
+    ----------
+    forest : FlatForest
+        compiled model (the controllable features are the first n_controls features)
+    n_controls : int
+        number of controllable features
+    bounds : np.ndarray
+        (lower, upper) for each controllable variable
+
+    Returns
+    -------
+    splits : List[np.ndarray]
+        sorted unique thresholds in [lower, upper) for each controllable feature
+    """
+    internal = forest.left != np.arange(forest.n_nodes)
+    splits = []
+
+    for f in range(n_controls):
+        thresholds = forest.threshold[internal & (forest.feature == f)]
+        splits.append(np.unique(thresholds[(thresholds >= bounds[f, 0]) & (thresholds < bounds[f, 1])]))
+
+    return splits
+
+
+def cell_points(splits, bounds):
+    """
+    Function to get the lowest point of each cell of each controllable feature
+
+    cell 0 is [lower, t_0], cell j is (t_j-1, t_j] and the last cell is (t_k-1, upper] --- the models compare float32 inputs, so the lowest
+    point of a cell above a threshold is the smallest float32 greater than the threshold
+
+    Parameters
+    ----------
+    splits : List[np.ndarray]
+        thresholds of each controllable feature (see control_splits)
+    bounds : np.ndarray
+        (lower, upper) for each controllable variable
+
+    Returns
+    -------
+    points : List[np.ndarray]
+        lowest point of each cell (len(splits[f]) + 1 values for feature f)
+    """
+    points = []
+
+    for f, thresholds in enumerate(splits):
+        above = thresholds.astype(np.float32)
+        above = np.where(above <= thresholds, np.nextafter(above, np.float32(np.inf)), above).astype(np.float64)
+        points.append(np.minimum(np.concatenate([[bounds[f, 0]], above]), bounds[f, 1]))
+
+    return points
+
+
+def split_cells(forest, splits, bounds, noncontrollable):
+    """
+    Function to express every split of the forest in terms of cell indices for one row
+
+    A node sends the cells j < split_cell[node] of its feature left and the cells j >= split_cell[node] right. Splits on noncontrollable
+    features (fixed for the row) send everything to one side.
+
+    Parameters
+    ----------
+    forest : FlatForest
+        compiled model (controllable features first, then the noncontrollable features)
+    splits : List[np.ndarray]
+        thresholds of each controllable feature (see control_splits)
+    bounds : np.ndarray
+        (lower, upper) for each controllable variable
+    noncontrollable : np.ndarray
+        noncontrollable values of the row
+
+    Returns
+    -------
+    control_index : np.ndarray
+        controllable feature of each node (0 for nodes that do not split on a controllable feature)
+    split_cell : np.ndarray
+        first cell that goes right for each node
+    """
+    n_controls = len(splits)
+    internal = forest.left != np.arange(forest.n_nodes)
+    is_control = internal & (forest.feature < n_controls)
+
+    control_index = np.where(is_control, forest.feature, 0)
+    split_cell = np.full(forest.n_nodes, _ALWAYS_LEFT, dtype=np.int64)
+
+    for f, thresholds in enumerate(splits):
+        nodes = np.flatnonzero(is_control & (forest.feature == f))
+        node_thresholds = forest.threshold[nodes]
+        # the cells with an upper edge <= t go left (thresholds below the box send every cell right)
+        split_cell[nodes] = np.searchsorted(thresholds, node_thresholds, side='right')
+        # thresholds above the box send every cell left
+        split_cell[nodes[node_thresholds >= bounds[f, 1]]] = _ALWAYS_LEFT
+
+    # noncontrollable splits are fixed by the row
+    nodes = np.flatnonzero(internal & ~is_control)
+    x = np.asarray(noncontrollable, dtype=np.float32)[forest.feature[nodes] - n_controls]
+    split_cell[nodes] = np.where(x <= forest.threshold[nodes], _ALWAYS_LEFT, _NEVER_LEFT)
+
+    return control_index, split_cell
+
+
+def prediction_interval(forest, control_index, split_cell, low, high):
+    """
+    Function to get the min and max prediction of the forest over a box of cells
+
+    Parameters
+    ----------
+    forest : FlatForest
+        compiled model
+    control_index : np.ndarray
+        see split_cells
+    split_cell : np.ndarray
+        see split_cells
+    low : np.ndarray
+        first cell of the box for each controllable feature
+    high : np.ndarray
+        last cell of the box for each controllable feature (inclusive)
+
+    Returns
+    -------
+    min_prediction : float
+        lower bound of the prediction over the box
+    max_prediction : float
+        upper bound of the prediction over the box
+    """
+    nodes = forest.roots
+    trees = np.arange(forest.n_trees)
+    is_leaf = forest.left == np.arange(forest.n_nodes)
+    leaf_nodes, leaf_trees = [], []
+
+    while len(nodes):
+        leaf = is_leaf[nodes]
+        leaf_nodes.append(nodes[leaf])
+        leaf_trees.append(trees[leaf])
+        nodes, trees = nodes[~leaf], trees[~leaf]
+
+        cell = split_cell[nodes]
+        go_left = low[control_index[nodes]] < cell
+        go_right = high[control_index[nodes]] >= cell
+
+        nodes, trees = np.concatenate([forest.left[nodes[go_left]], forest.right[nodes[go_right]]]), np.concatenate([trees[go_left], trees[go_right]])
+
+    leaf_nodes = np.concatenate(leaf_nodes)
+    leaf_trees = np.concatenate(leaf_trees)
+
+    # min / max leaf of each tree
+    order = np.argsort(leaf_trees, kind='stable')
+    values = forest.value[leaf_nodes[order]]
+    starts = np.flatnonzero(np.r_[True, np.diff(leaf_trees[order]) != 0])
+
+    low_sum = np.minimum.reduceat(values, starts).sum()
+    high_sum = np.maximum.reduceat(values, starts).sum()
+
+    return forest.base_score + forest.scale * low_sum, forest.base_score + forest.scale * high_sum
+
+
+def branch_and_bound(forest, controllable, noncontrollable, bounds, outlet, c, max_nodes=20000, tol=1e-9, deadline=None):
+    """
+    Function to find the optimal controls of a single row over the cell grid of the forest (see the module docstring)
+
+    Parameters
+    ----------
+    forest : FlatForest
+        compiled model (controllable features first, oil and gas are the first two)
+    controllable : np.ndarray
+        current controllable values (starting incumbent)
+    noncontrollable : np.ndarray
+        noncontrollable values
+    bounds : np.ndarray
+        (lower, upper) for each controllable variable
+    outlet : float
+        outlet value
+    c : float
+        weight of the outlet deviation
+    max_nodes : int
+        max boxes to process before giving up on the proof of optimality
+    tol : float
+        boxes whose lower bound is within tol of the best point are pruned
+    deadline : float | None
+        time.perf_counter() value after which the search stops with the best point found so far
+
+    Returns
+    -------
+    result : OptimizeResult
+        x, fun, success (True if proven optimal), nit (boxes processed), nfev (forest traversals: interval bounds + point evaluations),
+        gap (best objective - lowest lower bound left) and timed_out (the deadline stopped the search)
+    """
+    bounds = np.asarray(bounds, dtype=float)
+    noncontrollable = np.asarray(noncontrollable, dtype=float)
+    n_controls = len(bounds)
+
+    splits = control_splits(forest, n_controls, bounds)
+    points = cell_points(splits, bounds)
+    control_index, split_cell = split_cells(forest, splits, bounds, noncontrollable)
+    n_cells = np.array([len(p) for p in points])
+
+    def evaluate(x):
+        prediction = forest.predict(np.concatenate([x, noncontrollable]))[0]
+        return x[0] + x[1] + c * abs(prediction - outlet)
+
+    def corner(low):
+        return np.array([points[f][low[f]] for f in range(n_controls)])
+
+    def lower_bound(low, high):
+        min_prediction, max_prediction = prediction_interval(forest, control_index, split_cell, low, high)
+        deviation = max(min_prediction - outlet, outlet - max_prediction, 0.0)
+        return points[0][low[0]] + points[1][low[1]] + c * deviation
+
+    # start from the current operating point
+    best_x = np.clip(np.asarray(controllable, dtype=float), bounds[:, 0], bounds[:, 1])
+    best_fun = evaluate(best_x)
+    nfev = 1
+
+    low, high = np.zeros(n_controls, dtype=np.int64), n_cells - 1
+    x = corner(low)
+    value = evaluate(x)
+    if value < best_fun:
+        best_fun, best_x = value, x
+    heap = [(lower_bound(low, high), 0, low, high)]
+    nfev += 2
+    counter = 1
+    nit = 0
+    timed_out = False
+
+    while heap and nit < max_nodes:
+        if deadline is not None and time.perf_counter() >= deadline:
+            timed_out = True
+            break
+
+        bound, _, low, high = heapq.heappop(heap)
+        if bound >= best_fun - tol:
+            # every box left is worse than the best point
+            heap = []
+            break
+        nit += 1
+
+        if np.all(low == high):
+            # a single cell: the lowest point is the best point of the cell (its corner was evaluated when the box was created)
+            continue
+
+        # split the axis with the most cells in half
+        axis = int(np.argmax(high - low))
+        middle = (low[axis] + high[axis]) // 2
+        left_high, right_low = high.copy(), low.copy()
+        left_high[axis], right_low[axis] = middle, middle + 1
+
+        # the left box shares the corner of its parent, only the right corner is new
+        x = corner(right_low)
+        value = evaluate(x)
+        nfev += 1
+        if value < best_fun:
+            best_fun, best_x = value, x
+
+        for child_low, child_high in ((low, left_high), (right_low, high)):
+            child_bound = lower_bound(child_low, child_high)
+            nfev += 1
+            if child_bound < best_fun - tol:
+                heapq.heappush(heap, (child_bound, counter, child_low, child_high))
+                counter += 1
+
+    gap = max(best_fun - heap[0][0], 0.0) if heap else 0.0
+
+    return OptimizeResult(x=best_x, fun=best_fun, success=not heap, nit=nit, nfev=nfev, gap=gap, n_cells=int(np.prod(n_cells.astype(float))), timed_out=timed_out)
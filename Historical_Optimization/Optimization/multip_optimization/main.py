@@ -4,13 +4,16 @@ import multiprocessing as mp
 import os
 import os.path as osp
 from unittest import result
+import numpy as np
 import pandas as pd
 import datetime
+import tempfile
 from tqdm import tqdm
 
 # local imports
-from reader import read_file, read_json, read_pickle
-from tools import mp_optimization
+from reader import read_file, read_json, read_model
+from tools import mp_optimization, mp_sweep_optimization, stream_optimization, OPTIMIZATION_METHODS
+from tree_engine import compile_model, check_parity
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -22,18 +25,121 @@ def parse_args() -> argparse.Namespace:
 
     parser.add_argument('input_file', type=str, help='Path to the input file')
     parser.add_argument('out_path', type=str, help='Path to the output file (including the directory)')
-    parser.add_argument('c_value', type=float, help='C value')
+    parser.add_argument('c_value', type=float, nargs='+', help='C value (several values run a sweep that shares the model predictions across c values)')
     parser.add_argument('--date-label', type=str, required=False, default='Date', help='Column Label for the date')
     parser.add_argument('--n-cores', type=int, required=False, default=mp.cpu_count(), help='Number of cores to use (default is all')
     parser.add_argument('--max-iter', type=int, required=False, default=75, help='Max iterations for dual annealing')
     parser.add_argument('--config-path', type=str, required=False, default='controllable.json', help='Path to the config file')
     parser.add_argument('--model-path', type=str, required=False, default='model.pkl', help='Path to model pickle file')
+    parser.add_argument('--method', type=str, required=False, default='annealing', choices=OPTIMIZATION_METHODS, help='Optimization method: annealing (dual annealing), population (batched population search), differential_evolution (vectorized), grid (deterministic coordinate search), lbfgsb / nelder_mead (local polish from the current point), surrogate (L-BFGS-B on a quadratic fit of sampled points, checked against the model) or exact (branch and bound over the tree splits)')
+    parser.add_argument('--compile-model', action='store_true', help='Flatten the tree ensemble into numpy arrays (checked against the original model) before optimizing')
+    parser.add_argument('--stream', action='store_true', help='Append results to out_path as they finish and skip timestamps already in out_path (resumable)')
+    parser.add_argument('--chunk-size', type=int, required=False, default=None, help='Rows per task (default: about 8 tasks per core, 64 when streaming)')
+    parser.add_argument('--max-in-flight', type=int, required=False, default=None, help='Max chunks queued at once when streaming (default: 2 per core)')
+    parser.add_argument('--warm-start', action='store_true', help='Solve blocks of consecutive timestamps in order, starting each one from the previous optimum')
+    parser.add_argument('--warm-tol', type=float, required=False, default=0.05, help='Max relative state change for a warm started timestamp to use the reduced budget')
+    parser.add_argument('--warm-max-iter', type=int, required=False, default=None, help='Reduced iteration budget for small state changes (default is max-iter // 5)')
+    parser.add_argument('--cluster', action='store_true', help='Optimize one representative per cluster of rows within the tolerances (cluster_tolerance in the config)')
+    parser.add_argument('--cluster-tol', type=float, required=False, default=0.0, help='Tolerance for the variables missing from cluster_tolerance in the config (0 means exact match)')
+    parser.add_argument('--stop-tol', type=float, required=False, default=0.0, help='Min improvement of the best objective that counts as progress for --patience')
+    parser.add_argument('--patience', type=int, required=False, default=None, help='Stop a row when the best objective has not improved by more than --stop-tol over this many iterations')
+    parser.add_argument('--max-evals', type=int, required=False, default=None, help='Max objective evaluations per row')
+    parser.add_argument('--deadline', type=float, required=False, default=None, help='Wall clock budget of each row in seconds (the best point found so far is returned when it runs out)')
+    parser.add_argument('--cache', action='store_true', help='Cache the model predictions of each timestamp on the controls quantized to their resolution (cache_resolution in the config)')
+    parser.add_argument('--cache-size', type=int, required=False, default=4096, help='Max predictions kept in the cache of each worker (least recently used are dropped)')
+    parser.add_argument('--cache-resolution', type=float, required=False, default=0.0, help='Resolution of the controls missing from cache_resolution in the config (0 means exact match)')
+    parser.add_argument('--pop-size', type=int, required=False, default=64, help='Candidates per generation for the population search and differential evolution (per control for the grid search)')
 
 
     args = parser.parse_args()
+
+    # a sweep (several c values) shares the predictions of each row across the c values, these options need one c value
+    if len(args.c_value) > 1:
+        single_c = [flag for flag, used in (('--stream', args.stream), ('--warm-start', args.warm_start), ('--cluster', args.cluster)) if used]
+        if single_c:
+            parser.error(f"{', '.join(single_c)} cannot be used with several c values (sweep)")
+        # the shared population search runs every generation for every c value
+        no_stopping = [flag for flag, used in (('--patience', args.patience is not None), ('--max-evals', args.max_evals is not None), ('--deadline', args.deadline is not None)) if used]
+        if args.method == 'population' and no_stopping:
+            parser.error(f"{', '.join(no_stopping)} cannot be used with several c values and --method population")
+
     return args
 
 
+def prepare_data(input_file:str, date_label:str, config:dict):
+    """
+    Function to read the input data and build the per row bounds of the controllable variables
+
+    Parameters
+    ----------
+    input_file : str
+        path to the input file
+    date_label : str
+        label of the date column
+    config : dict
+        config (read_params, controllable, noncontrollable)
+
+    Returns
+    -------
+    data : pd.DataFrame
+        input data (rows with OUTLET >= 280), index is the date
+    bounds : np.ndarray
+        rows x controls x (lower, upper)
+    outlet : pd.Series
+        outlet of each row
+    """
+    controllable = config['controllable']
+    read_params = config['read_params']
+
+    # only the columns of the model are read (columnar files skip the others on disk)
+    columns = [*controllable, *config['noncontrollable'], 'OUTLET']
+    if read_params['index_col'] != '':
+        columns.append('index')
+
+    # TODO: think about how to pass args and kwargs in here ...
+    data = read_file(input_file, date_label, *read_params['args'], columns=columns, **read_params['kwargs'])
+
+    if read_params['index_col'] != '':
+        data.drop(labels='index', axis=1, inplace=True)
+        
+    data = data[data['OUTLET'] >= 280]
+
+    bounds = control_bounds(data, controllable)
+
+    outlet = data.loc[:, 'OUTLET'].copy()
+
+    return data, bounds, outlet
+
+
+def control_bounds(data:pd.DataFrame, controllable:dict):
+    """
+    Function to build the bounds of the controllable variables around the current values of each row
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        data with a column for each controllable variable
+    controllable : Dict[str, List[float]]
+        max decrease and max increase of each controllable variable (controllable in the config)
+
+    Returns
+    -------
+    bounds : np.ndarray
+        rows x controls x (lower, upper)
+    """
+    max_decrease = [thing[0] for thing in controllable.values()]
+    max_increase = [thing[1] for thing in controllable.values()]
+
+    min_bounds = data.loc[:, controllable.keys()] + max_decrease
+    max_bounds = data.loc[:, controllable.keys()] + max_increase
+
+    min_bounds.loc[min_bounds['OIL'] < 0, 'OIL'] = 0 
+    min_bounds.loc[min_bounds['COMBUSTION_AIR'] < 0, 'COMBUSTION_AIR'] = 0 
+
+    # rows x controls x (lower, upper)
+    return np.stack([min_bounds.values, max_bounds.values], axis=-1)
+
+
 def main() -> None:
     """Main Function"""
     start = datetime.datetime.now()
@@ -61,38 +167,41 @@ def main() -> None:
     config = read_json(args.config_path)
     controllable = config['controllable']
     noncontrollable = config['noncontrollable']
-    read_params = config['read_params']
     # load model
-    model = read_pickle(args.model_path)
-
-    # TODO: think about how to pass args and kwargs in here ...
-    data = read_file(args.input_file, args.date_label, *read_params['args'], **read_params['kwargs'])
-
-    if read_params['index_col'] != '':
-        data.drop(labels='index', axis=1, inplace=True)
-        
-    data = data[data['OUTLET'] >= 280]
-
-    max_decrease = [thing[0] for thing in controllable.values()]
-    max_increase = [thing[1] for thing in controllable.values()]
+    model = read_model(args.model_path)
+    # workers load the model themselves (once per worker)
+    model_path = args.model_path
+
+    data, bounds, outlet = prepare_data(args.input_file, args.date_label, config)
+
+    cluster_tolerances = None
+    if args.cluster:
+        # one tolerance per variable: controls, noncontrols, outlet
+        tolerance_map = config.get('cluster_tolerance', {})
+        cluster_tolerances = [tolerance_map.get(name, args.cluster_tol) for name in [*controllable.keys(), *noncontrollable, 'OUTLET']]
+
+    # adaptive stopping of each row (run_optimization)
+    stopping = {'stop_tol': args.stop_tol, 'patience': args.patience, 'max_evaluations': args.max_evals}
+
+    # prediction cache of each worker (controls quantized to their instrument resolution)
+    cache = None
+    if args.cache:
+        resolution_map = config.get('cache_resolution', {})
+        cache = {'resolution': [resolution_map.get(name, args.cache_resolution) for name in controllable.keys()], 'max_size': args.cache_size}
+
+    # the exact optimizer works on the compiled trees
+    if args.compile_model or args.method == 'exact':
+        logging.info("Compiling model")
+        original_model = model
+        model = compile_model(original_model)
+        max_error = check_parity(model, original_model, data.loc[:, [*controllable.keys(), *noncontrollable]].iloc[:1000])
+        logging.info(f"Compiled {model.n_trees} trees ({model.n_nodes} nodes, {model.nbytes / 1e6:.2f} MB), max error vs original model: {max_error:.3e}")
+
+        # save the node arrays so the workers can memory map them
+        compiled_dir = tempfile.TemporaryDirectory()
+        model.save(compiled_dir.name)
+        model_path = compiled_dir.name
 
-    min_bounds = data.loc[:, controllable.keys()] + max_decrease
-    max_bounds = data.loc[:, controllable.keys()] + max_increase
-
-    min_bounds.loc[min_bounds['OIL'] < 0, 'OIL'] = 0 
-    min_bounds.loc[min_bounds['COMBUSTION_AIR'] < 0, 'COMBUSTION_AIR'] = 0 
-
-    bounds = list(zip(zip(min_bounds['OIL'], max_bounds['OIL']), zip(min_bounds['GAS'], max_bounds['GAS']), zip(min_bounds['COMBUSTION_AIR'], max_bounds['COMBUSTION_AIR']), zip(min_bounds['INLET_TEMP'], max_bounds['INLET_TEMP'])))
-
-    outlet = data.loc[:, 'OUTLET'].copy()
-
-    
-
-    logging.info("Formatting Data for multiprocessing")
-    # format data for multiprocessing
-    out = mp_optimization(data, args.date_label, controllable.keys(), noncontrollable, bounds, model, args.max_iter, args.n_cores, outlet, args.c_value)
-
-    logging.info(f"Saving results to {args.out_path}")
     # FIXME: clean up this check ...
     no_slash = osp.split(args.out_path)[:-1]
     if no_slash[0] == '':
@@ -103,7 +212,34 @@ def main() -> None:
         logging.info("Output path not detected ... creating path")
         os.makedirs(out_dir)
 
-    out.to_csv(args.out_path)
+    logging.info("Formatting Data for multiprocessing")
+    if len(args.c_value) > 1:
+        sweep, frontier = mp_sweep_optimization(
+            data, args.date_label, controllable.keys(), noncontrollable, bounds, model, args.max_iter, args.n_cores, outlet, args.c_value,
+            method=args.method, popsize=args.pop_size, model_path=model_path, chunksize=args.chunk_size, stopping={**stopping, 'deadline': args.deadline}, cache=cache
+            )
+
+        frontier_path = osp.splitext(args.out_path)[0] + '_frontier.csv'
+        logging.info(f"Saving results to {args.out_path} and the frontier to {frontier_path}")
+        sweep.to_csv(args.out_path)
+        frontier.to_csv(frontier_path)
+    elif args.stream:
+        logging.info(f"Streaming results to {args.out_path}")
+        stream_optimization(
+            data, args.date_label, controllable.keys(), noncontrollable, bounds, model, args.max_iter, args.n_cores, outlet, args.c_value[0], args.out_path,
+            method=args.method, popsize=args.pop_size, model_path=model_path, chunksize=args.chunk_size or 64, max_in_flight=args.max_in_flight,
+            warm_start=args.warm_start, warm_tol=args.warm_tol, warm_maxiter=args.warm_max_iter, stopping=stopping, cache=cache, deadline=args.deadline
+            )
+    else:
+        # format data for multiprocessing
+        out = mp_optimization(
+            data, args.date_label, controllable.keys(), noncontrollable, bounds, model, args.max_iter, args.n_cores, outlet, args.c_value[0],
+            method=args.method, popsize=args.pop_size, model_path=model_path, chunksize=args.chunk_size,
+            warm_start=args.warm_start, warm_tol=args.warm_tol, warm_maxiter=args.warm_max_iter, stopping=stopping, cache=cache, deadline=args.deadline, cluster_tolerances=cluster_tolerances
+            )
+
+        logging.info(f"Saving results to {args.out_path}")
+        out.to_csv(args.out_path)
 
     run_time = datetime.datetime.now() - start
     logging.info(f"Total run time: {run_time.total_seconds() / 60:.3f} (minutes)")
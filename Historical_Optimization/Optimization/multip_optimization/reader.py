@@ -3,7 +3,9 @@ import os.path as osp
 import pandas as pd
 import pickle
 
-FILE_TYPES = ['csv', 'xlsx', 'json', 'txt']
+from tree_engine import FlatForest
+
+FILE_TYPES = ['csv', 'xlsx', 'json', 'txt', 'parquet', 'feather']
 
 class UnsupportedFileType(Exception):
     def __init__(self, extension):
@@ -31,7 +33,7 @@ def read_json(*args: str):
         data = json.load(f)
     return data
 
-def read_file(file_path:str, date_label:str, *args, **kwargs) -> pd.DataFrame:
+def read_file(file_path:str, date_label:str, *args, columns=None, **kwargs) -> pd.DataFrame:
     """
     High level function to read in data from a few different file types
 
@@ -43,6 +45,8 @@ def read_file(file_path:str, date_label:str, *args, **kwargs) -> pd.DataFrame:
         name of the date label
     args : List[?]
         additonal arguments to the read function
+    columns : List[str] | None
+        columns to read besides the date (None for every column) --- csv and parquet skip the other columns while reading
     kwargs : Dict[str] -> ?
         additional kwargs to the read function
 
@@ -54,12 +58,23 @@ def read_file(file_path:str, date_label:str, *args, **kwargs) -> pd.DataFrame:
     if extension not in FILE_TYPES:
         raise UnsupportedFileType(extension=extension)
 
+    if columns is not None:
+        columns = [date_label, *[column for column in columns if column != date_label]]
+
     if extension == 'csv' or extension == 'txt':
-        return pd.read_csv(file_path, *args, **kwargs).set_index(date_label)
+        return pd.read_csv(file_path, *args, usecols=columns, **kwargs).set_index(date_label)
+    elif extension == 'parquet':
+        # written by data_download.py: the date is the index (restored with its dtype)
+        data = pd.read_parquet(file_path, *args, columns=columns, **kwargs)
+        return data.set_index(date_label) if date_label in data.columns else data
+    elif extension == 'feather':
+        # feather keeps the date as a column
+        return pd.read_feather(file_path, *args, columns=columns, **kwargs).set_index(date_label)
     elif extension == 'xlsx':
-        return pd.read_excel(file_path, *args, **kwargs).set_index(date_label)
+        return pd.read_excel(file_path, *args, usecols=columns, **kwargs).set_index(date_label)
     # TODO: check the if this is the conversion we want to 
-    return pd.DataFrame(read_json(file_path)).set_index(date_label)
+    data = pd.DataFrame(read_json(file_path)).set_index(date_label)
+    return data if columns is None else data.loc[:, columns[1:]]
 
 def read_pickle(*args:str):
     """
@@ -81,4 +96,25 @@ def read_pickle(*args:str):
         data = pickle.load(fp)
 
     return data
-    
\ No newline at end of file
+    
+
+def read_model(*args:str):
+    """
+    Function to load a model from a pickle file or from a directory written by FlatForest.save (memory mapped)
+
+    Parameters
+    ----------
+    args: List[str] | str
+        input path to the model, separate arguments will be combined in to a single path: ie foo, bar, model.pkl -> foo/bar/model.pkl
+
+    Returns
+    -------
+    model : Model
+        model that implements predict
+    """
+    model_path = osp.join(*args)
+
+    if osp.isdir(model_path):
+        return FlatForest.load(model_path)
+
+    return read_pickle(model_path)
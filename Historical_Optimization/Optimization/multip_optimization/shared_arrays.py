@@ -0,0 +1,89 @@
+"""
+Numpy arrays backed by multiprocessing.shared_memory so the pool workers can read the inputs and write the results without pickling them
+
+Usage
+-----
+with SharedArrays({'controls': controls, 'result': np.zeros(...)}) as shared:
+    # pass shared.spec to the workers (pool initializer) and call attach_arrays(spec) there
+    ...
+    result = shared['result'].copy()
+"""
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class SharedArrays(object):
+    """
+    Class to copy a set of arrays into shared memory blocks (one block per array) and release them on exit
+    """
+
+    def __init__(self, arrays) -> None:
+        """
+        Parameters
+        ----------
+        arrays : Dict[str, np.ndarray]
+            arrays to copy into shared memory
+        """
+        self._blocks = {}
+        self.arrays = {}
+        self.spec = {}
+
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            # zero sized blocks are not allowed
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            view[...] = array
+
+            self._blocks[name] = block
+            self.arrays[name] = view
+            self.spec[name] = (block.name, array.shape, array.dtype.str)
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Function to release (close and unlink) the shared memory blocks"""
+        # drop the views before closing the buffers
+        self.arrays = {}
+        for block in self._blocks.values():
+            block.close()
+            block.unlink()
+        self._blocks = {}
+
+
+def attach_arrays(spec):
+    """
+    Function to attach to shared memory blocks created by SharedArrays (from a worker process)
+
+    Parameters
+    ----------
+    spec : Dict[str, Tuple[str, Tuple[int], str]]
+        SharedArrays.spec: name -> (block name, shape, dtype)
+
+    Returns
+    -------
+    arrays : Dict[str, np.ndarray]
+        numpy views on the shared blocks
+    blocks : List[shared_memory.SharedMemory]
+        the shared memory handles --- these must be kept alive as long as the arrays are used
+    """
+    arrays = {}
+    blocks = []
+
+    for name, (block_name, shape, dtype) in spec.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        blocks.append(block)
+
+    return arrays, blocks
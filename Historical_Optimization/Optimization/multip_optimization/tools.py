@@ -1,14 +1,38 @@
+from collections import deque
 from datetime import datetime
 from functools import wraps
 import logging
 import multiprocessing as mp
 import numpy as np
 # import numpy.typing as npt
+import os
 import pandas as pd
-from scipy.optimize import dual_annealing
+import pickle
+from scipy.optimize import differential_evolution, dual_annealing, minimize, OptimizeResult
+import time
 from tqdm import tqdm
 from typing import List, Tuple, Protocol
 
+from cache import CachedModel
+from cluster import cluster_rows, approximation_error
+from exact import branch_and_bound
+from reader import read_model
+from shared_arrays import SharedArrays, attach_arrays
+from tree_engine import compile_model
+
+# columns written after the optimal controls in the result array (see bind_optimization_results)
+RESULT_COLUMNS = [
+    'Success', 'Iterations', 'Evaluations',
+    # telemetry of each row (see _optimize_chunk)
+    'Objective_Calls', 'Predict_Time', 'Wall_Time', 'Worker_PID', 'Nonoptimized_Objective', 'Optimized_Objective',
+    # prediction cache lookups of each row (0 without the cache)
+    'Cache_Hits', 'Cache_Misses',
+    # whether the row ran out of its deadline (best point found so far)
+    'Deadline_Hit',
+    ]
+# columns written after the optimal controls for each c value by sweep_optimization
+SWEEP_COLUMNS = ['Success', 'Fuel', 'Outlet_Deviation', 'Objective']
+
 class Model(Protocol):
     def predict(self, formatted_data: np.ndarray) -> np.ndarray:
         """Function to predict the denominator of the Process KPI based on controllable and noncontrollable data"""
@@ -35,19 +59,443 @@ def objective(controls, noncontrols, model: Model, outlet, c):
     return (oil + gas) + c * abs(model_output - outlet)
 
 
+def batch_objective(population, noncontrols, model: Model, outlet, c):
+    """
+    Vectorized version of the objective --- scores a whole population of candidate controls with a single model.predict call
+
+    Parameters
+    ----------
+    population : np.ndarray
+        candidate control values (n_candidates x n_controls) --- a single candidate (1d) is also accepted
+    noncontrols : List[float] | np.ndarray
+        noncontrollable variables (shared by every candidate)
+    model : Model
+        model that implements predict method
+    outlet : float
+        outlet temperature
+    c : float
+        weight of the outlet deviation term
+
+    Returns
+    -------
+    out : np.ndarray
+        objective value for each candidate (n_candidates,)
+    """
+    population = np.atleast_2d(population)
+    noncontrols = np.broadcast_to(np.asarray(noncontrols, dtype=float), (population.shape[0], len(noncontrols)))
+    data = np.concatenate([population, noncontrols], axis=1)
+    oil = population[:, 0]
+    gas = population[:, 1]
+    model_output = model.predict(data)
+
+    return (oil + gas) + c * np.abs(model_output - outlet)
+
+
+def objective_values(controls, noncontrols, model: Model, outlet, c):
+    """
+    Function to get the objective of many rows (each row has its own noncontrollables and outlet) with a single model.predict call
+
+    Parameters
+    ----------
+    controls : np.ndarray
+        control values (rows x controls)
+    noncontrols : np.ndarray
+        noncontrollable variables (rows x noncontrols)
+    model : Model
+        model that implements predict method
+    outlet : np.ndarray
+        outlet temperature of each row
+    c : float
+        weight of the outlet deviation term
+
+    Returns
+    -------
+    out : np.ndarray
+        objective value of each row (rows,)
+    """
+    controls = np.asarray(controls, dtype=float)
+    model_output = np.asarray(model.predict(np.concatenate([controls, np.asarray(noncontrols, dtype=float)], axis=1)))
+
+    return (controls[:, 0] + controls[:, 1]) + c * np.abs(model_output - outlet)
+
+
+class TimedModel(object):
+    """
+    Class that wraps a Model and records the number of predict calls and the time spent in them (implements predict so it can be used as a Model)
+    """
+
+    def __init__(self, model) -> None:
+        self.model = model
+        self.calls = 0
+        self.seconds = 0.0
+
+    def predict(self, formatted_data):
+        start = time.perf_counter()
+        out = self.model.predict(formatted_data)
+        self.seconds += time.perf_counter() - start
+        self.calls += 1
+        return out
+
+
+def population_search(func, bounds, args=(), x0=None, maxiter=30, popsize=64, elite_frac=0.2, seed=None):
+    """
+    Batched population search (cross entropy style) --- every generation is scored with one call to a vectorized objective
+
+    Each generation the best elite_frac of the population is kept, a new population is sampled from a normal distribution around the elites 
+    (clipped to the bounds) and the spread shrinks as the elites converge. The best point seen so far is always carried over.
+
+    Parameters
+    ----------
+    func : Callable
+        vectorized objective: func(population, *args) -> np.ndarray (one value per row)
+    bounds : List[Tuple[float, float]]
+        lower and upper bound for each variable
+    args : Tuple
+        additional arguments to func
+    x0 : List[float] | np.ndarray | None
+        starting point (the current operating point), included in the first generation
+    maxiter : int
+        number of generations (number of calls to func)
+    popsize : int
+        number of candidates per generation
+    elite_frac : float
+        fraction of the population used to build the next generation
+    seed : int | None
+        seed for the random number generator
+
+    Returns
+    -------
+    result : OptimizeResult
+        x, fun, success, nit and nfev (same fields as the scipy optimizers)
+    """
+    rng = np.random.default_rng(seed)
+    bounds = np.asarray(bounds, dtype=float)
+    lower, upper = bounds[:, 0], bounds[:, 1]
+    n_elite = max(int(popsize * elite_frac), 2)
+
+    # first generation is spread uniformly over the box
+    population = rng.uniform(lower, upper, size=(popsize, len(bounds)))
+    if x0 is not None:
+        population[0] = np.clip(x0, lower, upper)
+
+    best_x = None
+    best_fun = np.inf
+    nfev = 0
+
+    for nit in range(1, maxiter + 1):
+        values = func(population, *args)
+        nfev += len(population)
+
+        order = np.argsort(values)
+        if values[order[0]] < best_fun:
+            best_fun = values[order[0]]
+            best_x = population[order[0]].copy()
+
+        elites = population[order[:n_elite]]
+        mean = elites.mean(axis=0)
+        std = elites.std(axis=0) + 1e-12
+
+        population = np.clip(rng.normal(mean, std, size=(popsize, len(bounds))), lower, upper)
+        population[0] = best_x
+
+    return OptimizeResult(x=best_x, fun=best_fun, success=True, nit=nit, nfev=nfev)
+
+
+class EarlyStop(Exception):
+    """Raised by ConvergenceMonitor to stop an optimizer (caught by run_optimization)"""
+
+    def __init__(self, reason) -> None:
+        self.reason = reason
+
+    def __str__(self):
+        return f"Optimization stopped early: {self.reason}"
+
+
+class ConvergenceMonitor(object):
+    """
+    Class that wraps an objective, keeps the best point evaluated so far and stops the optimizer (raises EarlyStop) when the best objective
+    has not improved by more than tol over patience iterations, when the evaluation budget is used up or when the deadline has passed
+    """
+
+    def __init__(self, func, tol: float = 0.0, patience: int = None, max_evaluations: int = None, evaluations_per_iteration: int = 1, batch: bool = False, deadline: float = None) -> None:
+        """
+        Parameters
+        ----------
+        func : Callable
+            objective: func(x, *args) -> float (or func(population, *args) -> np.ndarray if batch)
+        tol : float
+            min improvement of the best objective that resets the patience
+        patience : int | None
+            iterations without improvement before stopping (None to never stop on convergence)
+        max_evaluations : int | None
+            max objective evaluations (candidates) for the row (None for no budget)
+        evaluations_per_iteration : int
+            evaluations that make up one iteration of the optimizer (used to count the patience and estimate the iterations)
+        batch : bool
+            func scores a whole population at once
+        deadline : float | None
+            time.perf_counter() value after which the optimizer is stopped (checked after every objective call)
+        """
+        self.func = func
+        self.tol = tol
+        self.patience = patience
+        self.max_evaluations = max_evaluations
+        self.evaluations_per_iteration = max(evaluations_per_iteration, 1)
+        self.batch = batch
+        self.deadline = deadline
+
+        self.nfev = 0
+        self.best_x = None
+        self.best_fun = np.inf
+        # objective and evaluation count of the last improvement by more than tol
+        self._reference = np.inf
+        self._last_improvement = 0
+
+    @property
+    def nit(self):
+        """Estimated iterations used (evaluations / evaluations per iteration)"""
+        return int(np.ceil(self.nfev / self.evaluations_per_iteration))
+
+    def __call__(self, x, *args):
+        values = self.func(x, *args)
+        candidates = np.atleast_2d(x) if self.batch else [x]
+        scores = np.atleast_1d(values)
+
+        k = int(np.argmin(scores))
+        self.nfev += len(scores)
+        if scores[k] < self.best_fun:
+            self.best_fun = float(scores[k])
+            self.best_x = np.array(candidates[k], dtype=float)
+        if self.best_fun < self._reference - self.tol:
+            self._reference = self.best_fun
+            self._last_improvement = self.nfev
+
+        if self.max_evaluations is not None and self.nfev >= self.max_evaluations:
+            raise EarlyStop('evaluation budget')
+        if self.patience is not None and self.nfev - self._last_improvement >= self.patience * self.evaluations_per_iteration:
+            raise EarlyStop('converged')
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            raise EarlyStop('deadline')
+
+        return values
+
+
+# optimizer backends selectable by name: name -> (optimizer, evaluations per iteration) --- see register_optimizer
+OPTIMIZERS = {}
+
+
+def register_optimizer(name, evaluations_per_iteration):
+    """
+    Decorator to add an optimizer backend to OPTIMIZERS
+
+    Every backend has the same contract: optimizer(func, bounds, x0, maxiter, popsize, seed) -> OptimizeResult (x, fun, success, nit, nfev)
+    where func is the vectorized objective of the row (func(population) -> one value per candidate, a single 1d candidate is also accepted)
+    and bounds are the (lower, upper) of each controllable variable.
+
+    Parameters
+    ----------
+    name : str
+        name of the backend (the method argument of run_optimization)
+    evaluations_per_iteration : Callable
+        evaluations_per_iteration(n_controls, popsize) -> objective evaluations in one iteration of the backend (for the adaptive stopping)
+    """
+    def decorator(optimizer):
+        OPTIMIZERS[name] = (optimizer, evaluations_per_iteration)
+        return optimizer
+    return decorator
+
+
+@register_optimizer('annealing', lambda n_controls, popsize: 2 * n_controls)
+def annealing_optimizer(func, bounds, x0, maxiter, popsize, seed):
+    """Dual annealing (one objective call per candidate)"""
+    return dual_annealing(lambda x: func(x)[0], bounds, x0=x0, maxiter=maxiter, seed=seed)
+
+
+@register_optimizer('population', lambda n_controls, popsize: popsize)
+def population_optimizer(func, bounds, x0, maxiter, popsize, seed):
+    """Batched population search (see population_search)"""
+    return population_search(func, bounds, x0=x0, maxiter=maxiter, popsize=popsize, seed=seed)
+
+
+@register_optimizer('differential_evolution', lambda n_controls, popsize: max(popsize // n_controls, 5) * n_controls)
+def differential_evolution_optimizer(func, bounds, x0, maxiter, popsize, seed):
+    """Differential evolution with every generation scored in one objective call (about popsize candidates per generation)"""
+    bounds = np.asarray(bounds, dtype=float)
+    # scipy's popsize is a multiplier of the number of variables, vectorized passes the candidates as columns
+    return differential_evolution(
+        lambda population: func(population.T), bounds, x0=np.clip(x0, bounds[:, 0], bounds[:, 1]), maxiter=maxiter,
+        popsize=max(popsize // len(bounds), 5), seed=seed, polish=False, vectorized=True, updating='deferred'
+        )
+
+
+@register_optimizer('grid', lambda n_controls, popsize: n_controls * popsize)
+def grid_optimizer(func, bounds, x0, maxiter, popsize, seed):
+    """
+    Deterministic bounded coordinate search (seed is not used)
+
+    Each iteration goes through the controls one at a time and scores popsize evenly spaced values of that control (one objective call)
+    with the other controls fixed at the best point, then the search window of every control is halved around the best point.
+    """
+    bounds = np.asarray(bounds, dtype=float)
+    lower, upper = bounds[:, 0], bounds[:, 1]
+    best_x = np.clip(np.asarray(x0, dtype=float), lower, upper)
+    best_fun = func(best_x)[0]
+    width = upper - lower
+    nfev = 1
+
+    for nit in range(1, maxiter + 1):
+        for j in range(len(bounds)):
+            candidates = np.repeat(best_x[None, :], popsize, axis=0)
+            candidates[:, j] = np.linspace(max(best_x[j] - width[j] / 2, lower[j]), min(best_x[j] + width[j] / 2, upper[j]), popsize)
+            values = func(candidates)
+            nfev += popsize
+
+            k = int(np.argmin(values))
+            if values[k] < best_fun:
+                best_fun, best_x = values[k], candidates[k]
+        width = width / 2
+
+    return OptimizeResult(x=best_x, fun=best_fun, success=True, nit=maxiter, nfev=nfev)
+
+
+def _quadratic_features(z):
+    """Function to build the features of a full quadratic (1, z, z_i * z_j for i <= j) of the rows of z"""
+    n = z.shape[1]
+    i, j = np.triu_indices(n)
+    return np.hstack([np.ones((len(z), 1)), z, z[:, i] * z[:, j]])
+
+
+def fit_quadratic(z, values, ridge=1e-6):
+    """
+    Function to fit a full quadratic surrogate (ridge least squares) to the objective values of the points z
+
+    Parameters
+    ----------
+    z : np.ndarray
+        points scaled to the unit box (n_points x n_controls)
+    values : np.ndarray
+        objective value of each point
+    ridge : float
+        ridge penalty (keeps the fit stable with few points)
+
+    Returns
+    -------
+    surrogate : Callable
+        surrogate(z) -> (value, gradient) at a single point
+    """
+    n = z.shape[1]
+    i, j = np.triu_indices(n)
+    features = _quadratic_features(z)
+    coef = np.linalg.solve(features.T @ features + ridge * np.eye(features.shape[1]), features.T @ values)
+
+    linear = coef[1:n + 1]
+    # symmetric hessian of the quadratic part: the z_i * z_j coefficient is split between (i, j) and (j, i)
+    hessian = np.zeros((n, n))
+    hessian[i, j] += coef[n + 1:]
+    hessian = hessian + hessian.T
+
+    def surrogate(point):
+        value = _quadratic_features(point[None, :])[0] @ coef
+        return value, linear + hessian @ point
+
+    return surrogate
+
+
+@register_optimizer('surrogate', lambda n_controls, popsize: popsize + 1)
+def surrogate_optimizer(func, bounds, x0, maxiter, popsize, seed, rtol=0.05):
+    """
+    Smooth surrogate search: the model is only sampled, the gradient based search runs on a quadratic fit of the samples
+
+    Each iteration samples popsize points (latin hypercube, one objective call) in the trust box (the bounds at first), fits a full quadratic
+    to every sample in the box, minimizes it with L-BFGS-B and scores the surrogate optimum with the model (one objective call). If the
+    surrogate was within rtol of the range of the sampled objective at its optimum, the search stops. Otherwise the trust box is halved around
+    the best point and the search is refined. x and fun are always the best point scored by the model, surrogate_gap is the last
+    |surrogate - model| at the surrogate optimum.
+    """
+    bounds = np.asarray(bounds, dtype=float)
+    lower, upper = bounds[:, 0], bounds[:, 1]
+    width = np.maximum(upper - lower, 1e-12)
+    rng = np.random.default_rng(seed)
+    n = len(bounds)
+
+    best_x = np.clip(np.asarray(x0, dtype=float), lower, upper)
+    best_fun = func(best_x)[0]
+    nfev = 1
+    points, values = best_x[None, :], np.array([best_fun])
+    box_lower, box_upper = lower, upper
+    gap, success = np.inf, False
+
+    for nit in range(1, maxiter + 1):
+        # latin hypercube in the trust box
+        strata = (rng.permuted(np.tile(np.arange(popsize), (n, 1)), axis=1).T + rng.uniform(size=(popsize, n))) / popsize
+        samples = box_lower + strata * (box_upper - box_lower)
+        sample_values = func(samples)
+        nfev += popsize
+        points, values = np.vstack([points, samples]), np.concatenate([values, sample_values])
+
+        k = int(np.argmin(values))
+        best_x, best_fun = points[k], values[k]
+
+        # fit on the samples in the trust box, in unit box coordinates
+        inside = np.all((points >= box_lower - 1e-12) & (points <= box_upper + 1e-12), axis=1)
+        z = (points[inside] - lower) / width
+        surrogate = fit_quadratic(z, values[inside])
+        spread = np.ptp(values[inside])
+        z_bounds = np.stack([(box_lower - lower) / width, (box_upper - lower) / width], axis=1)
+        fit = minimize(surrogate, (best_x - lower) / width, jac=True, method='L-BFGS-B', bounds=z_bounds)
+
+        # verify the surrogate optimum with the model
+        x = np.clip(lower + fit.x * width, lower, upper)
+        value = func(x)[0]
+        nfev += 1
+        points, values = np.vstack([points, x]), np.append(values, value)
+        if value < best_fun:
+            best_x, best_fun = x, value
+
+        gap = abs(value - fit.fun)
+        if gap <= rtol * max(spread, 1e-12):
+            success = True
+            break
+
+        # refine: halve the trust box around the best point
+        half = (box_upper - box_lower) / 4
+        box_lower, box_upper = np.maximum(best_x - half, lower), np.minimum(best_x + half, upper)
+
+    return OptimizeResult(x=best_x, fun=best_fun, success=success, nit=nit, nfev=nfev, surrogate_gap=gap)
+
+
+def _local_optimizer(method):
+    """Function to build a local polish backend: scipy.optimize.minimize from the current operating point (popsize and seed are not used)"""
+    def optimizer(func, bounds, x0, maxiter, popsize, seed):
+        bounds = np.asarray(bounds, dtype=float)
+        x0 = np.clip(np.asarray(x0, dtype=float), bounds[:, 0], bounds[:, 1])
+        options = {'maxiter': maxiter}
+        if method == 'Nelder-Mead':
+            # tree ensembles are flat at the scale of the default simplex (5% of x0), start from 10% of the width of the bounds instead
+            # (steps that would leave the bounds go the other way)
+            step = 0.1 * (bounds[:, 1] - bounds[:, 0])
+            step = np.where(x0 + step > bounds[:, 1], -step, step)
+            options['initial_simplex'] = np.vstack([x0, x0 + np.diag(step)])
+        return minimize(lambda x: func(x)[0], x0, method=method, bounds=bounds, options=options)
+    return optimizer
+
+
+register_optimizer('lbfgsb', lambda n_controls, popsize: n_controls + 1)(_local_optimizer('L-BFGS-B'))
+register_optimizer('nelder_mead', lambda n_controls, popsize: 2)(_local_optimizer('Nelder-Mead'))
+
+# the exact optimizer works on the trees themselves (not on the objective) so it is handled by run_optimization
+OPTIMIZATION_METHODS = [*OPTIMIZERS, 'exact']
+
 
 def format_for_pool(
     df:pd.DataFrame, 
     date_label:str, 
     control_variables: List[str], 
     noncontrol_variables: List[str], 
-    bounds : List[List[float]], 
-    model : Model, 
-    maxiter : int,
-    outlet,
-    c) -> Tuple[Tuple[datetime, List[float], List[float]]]:
+    bounds, 
+    outlet) -> Tuple[List[datetime], dict]:
     """
-    Function to format historical format of data into tuples for the pool
+    Function to format historical format of data into arrays for the pool (these are copied into shared memory by mp_optimization)
 
     Parameters
     ----------
@@ -59,37 +507,33 @@ def format_for_pool(
         control variables (column names)
     noncontrol_variables : List[str]
         noncontrol variables (column names)
-    bounds : List[List[float, float]]
-        lower and upper bound for each variable
-    model : Model
-        model that implements predict method
-    maxiter : int
-        max iterations
+    bounds : np.ndarray | List[List[Tuple[float, float]]]
+        lower and upper bound for each control variable of each row (rows x controls x 2)
+    outlet : np.ndarray | pd.Series
+        outlet value of each row
 
     Returns
     -------
-    out :  Tuple[Tuple[datetime, List[float], List[float]]]
-        output in the format for the pool.starmap ... elements of the inner tuple will be: timestamp, controllable variables (values) and noncontrollable variables (values)
+    dates : List[datetime]
+        timestamp of each row
+    arrays : Dict[str, np.ndarray]
+        controls (rows x controls), noncontrols (rows x noncontrols), bounds (rows x controls x 2) and outlet (rows,)
     """
     # create a copy for manipulation
-    df_copy = df.copy().reset_index()
-
-    # convert each bound to a tuple
-    tuple_bounds = (tuple(bound) for bound in bounds)
+    df_copy = df.reset_index()
 
-    dates = df_copy.pop(date_label)
-    controls = df_copy[control_variables].values
-    noncontrols = df_copy[noncontrol_variables].values
+    dates = df_copy[date_label].tolist()
+    arrays = {
+        'controls': df_copy[list(control_variables)].values.astype(float),
+        'noncontrols': df_copy[list(noncontrol_variables)].values.astype(float),
+        'bounds': np.asarray(bounds, dtype=float).reshape(len(dates), len(control_variables), 2),
+        'outlet': np.asarray(outlet, dtype=float),
+        }
 
-    result = [None] * len(dates)
+    return dates, arrays
 
-    for i, row in enumerate(controls):
-        result[i] = (dates[i], row, noncontrols[i, :], model, bounds[i], maxiter, outlet[i], c)
-
-    return result
 
-
-def run_optimization(timestamp, controllable: List[float], noncontrollable: List[float], model: Model, bounds: List[List[float]], maxiter: int, outlet, c_value):
+def run_optimization(timestamp, controllable: List[float], noncontrollable: List[float], model: Model, bounds: List[List[float]], maxiter: int, outlet, c_value, method: str = 'annealing', popsize: int = 64, seed=None, stop_tol: float = 0.0, patience: int = None, max_evaluations: int = None, deadline: float = None):
     """
     High level api call to run the optimization procedure --- this will be the function passed to mp.Pool().map()
 
@@ -106,36 +550,236 @@ def run_optimization(timestamp, controllable: List[float], noncontrollable: List
     bounds : Tuple[Tuple[float, float]]
         lower and upper bound for each variable
     maxiter : int
-        max iterations for the dual_annealing
+        max iterations for the dual_annealing (number of generations for the population search)
+    method : str
+        one of OPTIMIZATION_METHODS: a backend of OPTIMIZERS (annealing, population, differential_evolution, grid, lbfgsb, nelder_mead) or
+        exact (branch and bound over the split thresholds of the tree ensemble, see exact.py --- maxiter is not used)
+    popsize : int
+        candidates per generation (population, differential_evolution) or per control (grid)
+    seed : int | None
+        seed for the optimizer's random number generator
+    stop_tol : float
+        min improvement of the best objective that counts as progress for the adaptive stopping
+    patience : int | None
+        stop when the best objective has not improved by more than stop_tol over this many iterations (None to always run maxiter)
+    max_evaluations : int | None
+        max objective evaluations for the row (None for no budget)
+    deadline : float | None
+        wall clock budget of the row in seconds: once it runs out the best point found so far is returned (the current operating point is
+        evaluated first so it is the worst case) --- the optimizer can overrun it by at most one objective call
+
+    NOTE: the adaptive stopping does not apply to the exact method (it stops on its own once the optimum is proven), the deadline does
 
     Returns
     -------
     timestamp : datetime
         timestamp
-    nonoptimized_predicted_kpi_denominator : float
-        value of objective function without the optimized controls (no directive)
-    optimized_predicted_kpi_denominator : float
-        value of objective function with the optimal controls
     optimal_controls : List[float]
         optimal control values for the control variables
     success : bool
-        whether the optimization was successful or not
+        whether the optimization was successful or not (a run stopped by patience or the budget returns the best point found, success=True)
+    nit : int
+        iterations used (estimated from the evaluations if the run was stopped early)
+    nfev : int
+        objective evaluations used
+    timed_out : bool
+        whether the deadline ran out before the optimizer finished
     """
-    result = dual_annealing(objective, bounds, args=(noncontrollable, model, outlet, c_value), x0=controllable, maxiter=maxiter)    
-    optimal_controls = result.x
+    end = time.perf_counter() + deadline if deadline is not None else None
+
+    if method == 'exact':
+        result = branch_and_bound(compile_model(model), controllable, noncontrollable, bounds, outlet, c_value, deadline=end)
+        return timestamp, result.x, result.success, result.nit, result.nfev, result.timed_out
+
+    optimizer, evaluations_per_iteration = OPTIMIZERS[method]
+    monitor = ConvergenceMonitor(batch_objective, stop_tol, patience, max_evaluations, evaluations_per_iteration(len(bounds), popsize), batch=True, deadline=end)
+    func = lambda population: monitor(population, noncontrollable, model, outlet, c_value)
+    timed_out = False
+
+    try:
+        if end is not None:
+            # the current operating point (within the bounds) is the fallback answer
+            box = np.asarray(bounds, dtype=float)
+            func(np.clip(np.asarray(controllable, dtype=float), box[:, 0], box[:, 1]))
+        result = optimizer(func, bounds, controllable, maxiter, popsize, seed)
+    except EarlyStop as stop:
+        timed_out = stop.reason == 'deadline'
+        result = OptimizeResult(x=monitor.best_x, fun=monitor.best_fun, success=True, nit=min(monitor.nit, maxiter), nfev=monitor.nfev)
 
     # NOTE: the timestamp will be used to verify the order of the result but it shouldn't be needed --- check on this later ...
-    return timestamp, optimal_controls, result.success
+    return timestamp, result.x, result.success, result.nit, monitor.nfev, timed_out
+
+
+def sweep_population_search(controllable, noncontrollable, model: Model, bounds, maxiter: int, outlet, c_values: List[float], popsize: int = 64, elite_frac=0.2, seed=None):
+    """
+    Population search for several c values at once --- every candidate is predicted once and scored for every c value
+
+    Each generation the elites of every c value are picked from the whole (shared) population and each c value samples its share of the
+    next generation around its own elites, so a whole sweep costs maxiter predicts of popsize rows (the cost of a single c value).
+
+    Parameters
+    ----------
+    controllable : np.ndarray
+        controllable variables (the current operating point, included in the first generation)
+    noncontrollable : np.ndarray
+        noncontrollable variables
+    model : Model
+        model that implements predict
+    bounds : np.ndarray
+        (lower, upper) for each controllable variable
+    maxiter : int
+        number of generations (number of calls to model.predict)
+    outlet : float
+        outlet value
+    c_values : List[float]
+        c values
+    popsize : int
+        candidates per generation (shared by every c value)
+    elite_frac : float
+        fraction of the population used to build the next generation of each c value
+    seed : int | None
+        seed for the random number generator
+
+    Returns
+    -------
+    best_x : np.ndarray
+        optimal controls for each c value (c values x controls)
+    best_fuel : np.ndarray
+        fuel (oil + gas) at the optimum of each c value
+    best_deviation : np.ndarray
+        |prediction - outlet| at the optimum of each c value
+    nfev : int
+        number of rows sent to the model
+    """
+    rng = np.random.default_rng(seed)
+    bounds = np.asarray(bounds, dtype=float)
+    lower, upper = bounds[:, 0], bounds[:, 1]
+    c_values = np.asarray(c_values, dtype=float)
+    n_c, n_controls = len(c_values), len(bounds)
+    n_elite = max(int(popsize * elite_frac), 2)
+    # rows of the next generation sampled for each c value
+    shares = np.diff(np.linspace(0, popsize, n_c + 1).astype(int))
+
+    best_x = np.tile(np.clip(controllable, lower, upper), (n_c, 1))
+    best_fun = np.full(n_c, np.inf)
+    best_fuel = np.zeros(n_c)
+    best_deviation = np.zeros(n_c)
+
+    population = rng.uniform(lower, upper, size=(popsize, n_controls))
+    population[0] = best_x[0]
+    nfev = 0
+
+    for _ in range(maxiter):
+        prediction = np.asarray(model.predict(np.concatenate([population, np.broadcast_to(noncontrollable, (len(population), len(noncontrollable)))], axis=1)))
+        nfev += len(population)
 
+        fuel = population[:, 0] + population[:, 1]
+        deviation = np.abs(prediction - outlet)
+        # c values x candidates
+        values = fuel[None, :] + c_values[:, None] * deviation[None, :]
 
-def bind_optimization_results(results, date_label:str, controls:List[str]):
+        samples = []
+        for k in range(n_c):
+            order = np.argsort(values[k])
+            if values[k, order[0]] < best_fun[k]:
+                best_fun[k] = values[k, order[0]]
+                best_x[k] = population[order[0]]
+                best_fuel[k] = fuel[order[0]]
+                best_deviation[k] = deviation[order[0]]
+
+            elites = population[order[:n_elite]]
+            samples.append(rng.normal(elites.mean(axis=0), elites.std(axis=0) + 1e-12, size=(shares[k], n_controls)))
+
+        population = np.clip(np.concatenate(samples), lower, upper)
+        # carry over the best point of every c value
+        population[:n_c] = best_x[:len(population)]
+
+    return best_x, best_fuel, best_deviation, nfev
+
+
+def sweep_optimization(controllable, noncontrollable, model: Model, bounds, maxiter: int, outlet, c_values: List[float], method: str = 'annealing', popsize: int = 64, seed=0, stopping=None, cache=None):
+    """
+    Function to run the optimization of a single timestamp for several c values, sharing the model predictions across the c values
+
+    The objective only depends on c through the weight of the outlet deviation, so a prediction made for one c value can be used by all of them:
+        population: sweep_population_search (every candidate is predicted once and scored for every c value)
+        other backends: one run per c value through a prediction cache (same seed for every c value so the early candidates overlap)
+
+    NOTE: only the population search shares much. The other backends only share the candidates that come out identical for every c value:
+    measured on furnace A, about 50% of the predictions were shared for population, about 6% for annealing and none for exact (which does
+    not predict). A cache with a resolution (cache, --cache in main.py) also shares the candidates within the resolution of each other: with
+    a 0.05 resolution on every control, annealing shared about 70% at a slightly higher mean objective (13.73 vs 13.51).
+
+    Parameters
+    ----------
+    controllable : np.ndarray
+        controllable variables
+    noncontrollable : np.ndarray
+        noncontrollable variables
+    model : Model
+        model that implements predict
+    bounds : np.ndarray
+        (lower, upper) for each controllable variable
+    maxiter : int
+        max iterations
+    outlet : float
+        outlet value
+    c_values : List[float]
+        c values to optimize for
+    method : str
+        one of OPTIMIZATION_METHODS
+    popsize : int
+        candidates per generation for the population search
+    seed : int
+        seed shared by every c value
+    stopping : Dict[str, ?] | None
+        adaptive stopping and deadline arguments of run_optimization (stop_tol, patience, max_evaluations, deadline) --- not used by population
+    cache : Dict[str, ?] | None
+        CachedModel arguments (resolution, max_size) of the shared prediction cache --- None for exact matches without a size limit
+
+    Returns
+    -------
+    result : np.ndarray
+        one row per c value: optimal controls followed by SWEEP_COLUMNS
+    n_scored : int
+        candidate evaluations across every c value
+    n_predicted : int
+        rows actually sent to the model
+    """
+    result = np.empty((len(c_values), len(controllable) + len(SWEEP_COLUMNS)))
+
+    if method == 'population':
+        best_x, fuel, deviation, nfev = sweep_population_search(controllable, noncontrollable, model, bounds, maxiter, outlet, c_values, popsize=popsize, seed=seed)
+        for k, c in enumerate(c_values):
+            result[k] = [*best_x[k], True, fuel[k], deviation[k], fuel[k] + c * deviation[k]]
+        return result, nfev * len(c_values), nfev
+
+    # the exact optimizer needs the trees themselves (no cache)
+    shared = CachedModel(model, **(cache or {})) if method != 'exact' else model
+    for k, c in enumerate(c_values):
+        _, optimal_controls, success, _, _, _ = run_optimization(None, controllable, noncontrollable, shared, bounds, maxiter, outlet, c, method=method, popsize=popsize, seed=seed, **(stopping or {}))
+        # a quantized cache entry can be off by the resolution, the reported deviation is then from the model itself
+        scorer = model if cache is not None and cache.get('resolution') is not None else shared
+        prediction = np.asarray(scorer.predict(np.concatenate([optimal_controls, noncontrollable])[None, :]))[0]
+        fuel = optimal_controls[0] + optimal_controls[1]
+        deviation = abs(prediction - outlet)
+        result[k] = [*optimal_controls, success, fuel, deviation, fuel + c * deviation]
+
+    if method == 'exact':
+        return result, len(c_values), len(c_values)
+    return result, shared.hits + shared.misses, shared.misses
+
+
+def bind_optimization_results(dates, result, date_label:str, controls:List[str]):
     """
     Function to bind the optimization results
 
     Parameters
     ----------
-    results : Tuple[Tuple[datetime, List[float], bool]]
-        results from the optimization procedure: timestamp, controls values, success
+    dates : List[datetime]
+        timestamp of each row
+    result : np.ndarray
+        result array written by the workers (rows x (controls + RESULT_COLUMNS)): optimal control values followed by RESULT_COLUMNS
     date_label : str
         date label 
     controls : List[str]
@@ -144,29 +788,453 @@ def bind_optimization_results(results, date_label:str, controls:List[str]):
     Returns
     -------
     out : pd.DataFrame
-        results bound into a dataframe: columns: date_label (date), optimized_kpi, nonopt_kpi, success
+        results bound into a dataframe: index is date_label (date), columns are the optimized controls and RESULT_COLUMNS
     """
-    # preallocate result variables
-    dates = [None] * len(results)
-    control_values = [None] * len(results)
-    success = [None] * len(results)
-
-    # unpack results
-    for i, row in enumerate(results):
-        dates[i], control_values[i], success[i] = row
-
-    # TODO: check once if the result is in order ...
+    n_controls = len(controls)
 
     # bind to df
-    out = pd.DataFrame(control_values, columns=[name+'_Optimized' for name in controls], index=dates)
+    out = pd.DataFrame(result[:, :n_controls], columns=[name+'_Optimized' for name in controls], index=pd.to_datetime(dates))
     out.index.name = date_label
-    # NOTE: check if this line below is needed
-    out.index = pd.to_datetime(out.index)
 
-    out['Success'] = success
+    for j, name in enumerate(RESULT_COLUMNS):
+        out[name] = result[:, n_controls + j]
+
+    out[['Success', 'Deadline_Hit']] = out[['Success', 'Deadline_Hit']].astype(bool)
+    counts = ['Iterations', 'Evaluations', 'Objective_Calls', 'Worker_PID', 'Cache_Hits', 'Cache_Misses']
+    out[counts] = out[counts].astype(int)
 
     return out
-    
+
+
+# per worker state set by _init_worker (each worker loads the model and attaches to the shared arrays once)
+_worker_state = {}
+
+def _init_worker(model, model_path, spec, maxiter, c, options, warm=None, cache=None):
+    """
+    Pool initializer: load the model (from model_path if given) and attach to the shared input/result arrays for the whole run
+
+    Parameters
+    ----------
+    model : Model | None
+        model that implements predict (only used if model_path is None)
+    model_path : str | None
+        path to a model pickle or a directory written by FlatForest.save (memory mapped)
+    spec : Dict[str, Tuple[str, Tuple[int], str]]
+        SharedArrays.spec of controls, noncontrols, bounds, outlet and result
+    maxiter : int
+        max iterations
+    c : float
+        c value
+    options : Dict[str, ?]
+        additional keyword arguments to run_optimization
+    warm : Dict[str, float] | None
+        warm start settings for _optimize_chunk: tol (max state change) and maxiter (reduced budget) --- None to start every row from scratch
+    cache : Dict[str, ?] | None
+        CachedModel arguments (resolution, max_size) of the prediction cache used by _optimize_chunk --- None for no cache
+    """
+    start = time.perf_counter()
+    _worker_state['model'] = read_model(model_path) if model_path is not None else model
+    _worker_state['arrays'], _worker_state['blocks'] = attach_arrays(spec)
+    _worker_state['maxiter'] = maxiter
+    _worker_state['c'] = c
+    _worker_state['options'] = options
+    _worker_state['warm'] = warm
+    _worker_state['cache'] = CachedModel(_worker_state['model'], **cache) if cache is not None else None
+    _worker_state['startup'] = time.perf_counter() - start
+
+
+def _worker_startup(_):
+    """Function to report the pid and the initializer time of a worker"""
+    return os.getpid(), _worker_state['startup']
+
+
+def state_change(controls, noncontrols, previous_controls, previous_noncontrols, bounds):
+    """
+    Function to measure how much the operating state moved between two consecutive timestamps
+
+    Parameters
+    ----------
+    controls : np.ndarray
+        controllable variables of this timestamp
+    noncontrols : np.ndarray
+        noncontrollable variables of this timestamp
+    previous_controls : np.ndarray
+        controllable variables of the previous timestamp
+    previous_noncontrols : np.ndarray
+        noncontrollable variables of the previous timestamp
+    bounds : np.ndarray
+        (lower, upper) for each controllable variable of this timestamp
+
+    Returns
+    -------
+    change : float
+        max of the control changes (relative to the width of the bounds) and the noncontrol changes (relative to their previous value)
+    """
+    control_change = np.abs(controls - previous_controls) / np.maximum(bounds[:, 1] - bounds[:, 0], 1e-12)
+    noncontrol_change = np.abs(noncontrols - previous_noncontrols) / np.maximum(np.abs(previous_noncontrols), 1e-12)
+
+    return float(max(control_change.max(initial=0), noncontrol_change.max(initial=0)))
+
+
+def _optimize_chunk(chunk):
+    """
+    Function to run the optimization for the rows [start, stop) of the shared arrays and write the results into the shared result array
+
+    With warm start (worker state) the rows of the chunk are solved in time order: each row starts from the previous row's optimum and,
+    if the state change (see state_change) is within the tolerance, only gets the reduced iteration budget.
+
+    Along with the optimal controls, the telemetry of each row is written to the result array (see RESULT_COLUMNS): objective calls, time
+    spent in model.predict (including the cache lookups), wall time, worker pid, the objective at the current operating point and at the
+    optimum and the cache hits/misses (the worker's cache is cleared after every row).
+
+    Parameters
+    ----------
+    chunk : Tuple[int, int]
+        start and stop row
+
+    Returns
+    -------
+    chunk : Tuple[int, int]
+        start and stop row (the rows are now in the result array)
+    """
+    optimize_rows(_worker_state, *chunk)
+
+    return chunk
+
+
+def optimize_rows(state, start, stop):
+    """
+    Function to optimize the rows [start, stop) of the arrays of a worker state and write them into its result array (see _optimize_chunk)
+
+    Parameters
+    ----------
+    state : Dict[str, ?]
+        arrays (controls, noncontrols, bounds, outlet, result), model, maxiter, c, options, warm and cache (see _init_worker)
+    start : int
+        first row
+    stop : int
+        row after the last row
+    """
+    arrays = state['arrays']
+    controls, noncontrols, bounds, outlet, result = arrays['controls'], arrays['noncontrols'], arrays['bounds'], arrays['outlet'], arrays['result']
+    n_controls = controls.shape[1]
+    warm = state['warm']
+    exact = state['options'].get('method') == 'exact'
+    # the exact optimizer needs the trees themselves (no cache)
+    cache = state['cache'] if not exact else None
+    pid = os.getpid()
+
+    for i in range(start, stop):
+        x0 = controls[i]
+        maxiter = state['maxiter']
+
+        if warm is not None and i > start:
+            x0 = np.clip(optimal_controls, bounds[i, :, 0], bounds[i, :, 1])
+            if state_change(controls[i], noncontrols[i], controls[i - 1], noncontrols[i - 1], bounds[i]) <= warm['tol']:
+                maxiter = warm['maxiter']
+
+        row_start = time.perf_counter()
+        if cache is not None:
+            hits_before, misses_before = cache.hits, cache.misses
+        if exact:
+            # the exact optimizer traverses the trees itself (no predict calls to time)
+            _, optimal_controls, success, nit, nfev, timed_out = run_optimization(i, x0, noncontrols[i], state['model'], bounds[i], maxiter, outlet[i], state['c'], **state['options'])
+            calls, predict_time = nfev, np.nan
+        else:
+            model = TimedModel(cache if cache is not None else state['model'])
+            _, optimal_controls, success, nit, nfev, timed_out = run_optimization(i, x0, noncontrols[i], model, bounds[i], maxiter, outlet[i], state['c'], **state['options'])
+            calls, predict_time = model.calls, model.seconds
+        wall_time = time.perf_counter() - row_start
+
+        hits = misses = 0
+        if cache is not None:
+            # the noncontrollables change with the timestamp
+            hits, misses = cache.hits - hits_before, cache.misses - misses_before
+            cache.clear()
+
+        # objective at the current operating point and at the optimum (one predict call, not counted in the row's telemetry)
+        nonoptimized, optimized = batch_objective(np.vstack([controls[i], optimal_controls]), noncontrols[i], state['model'], outlet[i], state['c'])
+
+        result[i, :n_controls] = optimal_controls
+        result[i, n_controls:] = success, nit, nfev, calls, predict_time, wall_time, pid, nonoptimized, optimized, hits, misses, timed_out
+
+
+def _sweep_chunk(chunk):
+    """
+    Function to run sweep_optimization for the rows [start, stop) of the shared arrays (c values from the worker state)
+
+    Parameters
+    ----------
+    chunk : Tuple[int, int]
+        start and stop row
+
+    Returns
+    -------
+    chunk : Tuple[int, int]
+        start and stop row (the rows are now in the result array)
+    n_scored : int
+        candidate evaluations across every c value
+    n_predicted : int
+        rows sent to the model
+    """
+    state = _worker_state
+    arrays = state['arrays']
+    controls, noncontrols, bounds, outlet, result = arrays['controls'], arrays['noncontrols'], arrays['bounds'], arrays['outlet'], arrays['result']
+    start, stop = chunk
+    n_scored = n_predicted = 0
+
+    for i in range(start, stop):
+        result[i], row_scored, row_predicted = sweep_optimization(controls[i], noncontrols[i], state['model'], bounds[i], state['maxiter'], outlet[i], state['c'], seed=i, **state['options'])
+        n_scored += row_scored
+        n_predicted += row_predicted
+
+    return chunk, n_scored, n_predicted
+
+
+def make_chunks(n_rows, chunksize):
+    """
+    Function to split the rows into contiguous (start, stop) ranges
+
+    Parameters
+    ----------
+    n_rows : int
+        number of rows
+    chunksize : int
+        rows per chunk
+
+    Returns
+    -------
+    chunks : List[Tuple[int, int]]
+        (start, stop) of each chunk
+    """
+    return [(start, min(start + chunksize, n_rows)) for start in range(0, n_rows, chunksize)]
+
+
+def _start_pool(n_process, initargs):
+    """
+    Function to start the spawn pool (see _init_worker for initargs) and wait for every worker to be ready
+
+    Parameters
+    ----------
+    n_process : int
+        number of processes
+    initargs : Tuple
+        arguments to _init_worker
+
+    Returns
+    -------
+    pool : mp.Pool
+        started pool
+    """
+    logger = logging.getLogger(__name__)
+    logger.info(f"Running multiprocessing with {n_process} cores")
+
+    start = time.perf_counter()
+    pool = mp.get_context("spawn").Pool(processes=n_process, initializer=_init_worker, initargs=initargs)
+    startup = pool.map(_worker_startup, range(n_process), chunksize=1)
+    logger.info(f"Pool startup: {time.perf_counter() - start:.2f} (s), worker model load: {max(load for _, load in startup):.2f} (s)")
+
+    return pool
+
+
+def read_done_dates(out_path, date_label):
+    """
+    Function to read the timestamps already written to a streaming output file (a partially written last line is removed)
+
+    Parameters
+    ----------
+    out_path : str
+        path to the output csv
+    date_label : str
+        label of the date column
+
+    Returns
+    -------
+    done : pd.DatetimeIndex
+        timestamps already in the output
+    """
+    if not os.path.exists(out_path) or os.path.getsize(out_path) == 0:
+        return pd.DatetimeIndex([])
+
+    # a kill in the middle of a write can leave a partial line at the end
+    with open(out_path, 'rb+') as fp:
+        content = fp.read()
+        if not content.endswith(b'\n'):
+            fp.truncate(content.rfind(b'\n') + 1)
+
+    return pd.DatetimeIndex(pd.to_datetime(pd.read_csv(out_path, usecols=[date_label])[date_label]))
+
+
+def log_run_summary(out, seconds=None):
+    """
+    Function to log a summary of the per row telemetry of a run
+
+    Parameters
+    ----------
+    out : pd.DataFrame
+        results (see bind_optimization_results) --- only the RESULT_COLUMNS are used
+    seconds : float | None
+        wall time of the whole run (for rows/sec)
+    """
+    logger = logging.getLogger(__name__)
+    if out.empty:
+        return
+
+    wall_time = out['Wall_Time']
+    logger.info(
+        f"Run summary: {len(out)} rows, success {out['Success'].mean():.1%}, row wall time mean {wall_time.mean():.3f} s / p50 {wall_time.quantile(0.5):.3f} s / "
+        f"p99 {wall_time.quantile(0.99):.3f} s" + (f", {len(out) / seconds:.2f} rows/sec" if seconds else "")
+        )
+    # no predict time for the exact optimizer
+    predict_share = f", {out['Predict_Time'].sum() / wall_time.sum():.1%} of the row time in model.predict" if out['Predict_Time'].notna().any() else ""
+    logger.info(
+        f"Run summary: {out['Iterations'].mean():.1f} iterations, {out['Evaluations'].mean():.0f} evaluations and {out['Objective_Calls'].mean():.0f} objective calls per row"
+        + predict_share
+        )
+    if out['Deadline_Hit'].any():
+        logger.info(f"Run summary: {out['Deadline_Hit'].mean():.1%} of the rows ran out of their deadline")
+    lookups = out['Cache_Hits'].sum() + out['Cache_Misses'].sum()
+    if lookups:
+        logger.info(f"Run summary: prediction cache hit rate {out['Cache_Hits'].sum() / lookups:.1%} ({out['Cache_Misses'].sum() / len(out):.0f} rows predicted per row)")
+    logger.info(
+        f"Run summary: objective {out['Nonoptimized_Objective'].mean():.4f} -> {out['Optimized_Objective'].mean():.4f} (mean), "
+        f"rows per worker: {out['Worker_PID'].value_counts().to_dict()}"
+        )
+
+
+def stream_optimization(
+    data:pd.DataFrame, 
+    date_label:str, 
+    controllable_vars:List[str], 
+    noncontrollable_vars:List[str], 
+    control_bounds, 
+    model:Model, 
+    maxiter:int, 
+    n_process:int,
+    outlet,
+    c,
+    out_path:str,
+    method: str = 'annealing',
+    popsize: int = 64,
+    model_path: str = None,
+    chunksize: int = 64,
+    max_in_flight: int = None,
+    warm_start: bool = False,
+    warm_tol: float = 0.05,
+    warm_maxiter: int = None,
+    stopping: dict = None,
+    cache: dict = None,
+    deadline: float = None):
+    """
+    Function to run the optimization in the multiprocessing format and append the results to out_path as each chunk finishes
+
+    Timestamps already in out_path are skipped, so a killed run picks up where it stopped when it is started again with the same arguments.
+    At most max_in_flight chunks are queued to the pool at any time and no results are kept in memory once they are written. An error in a
+    worker is raised here (the pool is terminated and the shared memory unlinked), the chunks written before it are kept.
+    NOTE: rows are written in chunk order
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        data of interest
+    date_label : str
+        label of the date 
+    controllable_vars : List[str]
+        list of the names of the controllable columns
+    noncontrollable_vars : List[str]
+        list of the noncontrollable variables that are still used in the model
+    control_bounds : np.ndarray | List[List[Tuple[float, float]]]
+        (lower, upper) for each controllable variable of each row (rows x controls x 2) --- assumes order is the same as controllable_vars
+    model : Model
+        model that implements .predict
+    maxiter : int
+        max iterations of each step of the optimization
+    n_process : int
+        number of processes to use
+    out_path : str
+        output csv (appended to)
+    method : str
+        optimization method passed to run_optimization (see OPTIMIZATION_METHODS)
+    popsize : int
+        candidates per generation for the population search
+    model_path : str | None
+        if given, each worker loads the model from this path (pickle or FlatForest directory) instead of receiving the pickled model
+    chunksize : int
+        rows per task (and per write)
+    max_in_flight : int | None
+        max chunks queued to the pool at once (default: 2 per process)
+    warm_start : bool
+        solve each chunk in time order, starting each row from the previous row's optimum
+    warm_tol : float
+        max state change (see state_change) for a row to get the reduced budget
+    warm_maxiter : int | None
+        reduced iteration budget (default: maxiter // 5)
+    stopping : Dict[str, ?] | None
+        adaptive stopping arguments of run_optimization (stop_tol, patience, max_evaluations)
+    cache : Dict[str, ?] | None
+        CachedModel arguments (resolution, max_size) of a per worker prediction cache that is cleared for every row --- None for no cache
+    deadline : float | None
+        wall clock budget of each row in seconds (see run_optimization) --- None to let the optimizer finish
+
+    Returns
+    -------
+    n_rows : int
+        number of rows optimized in this run
+    """
+    logger = logging.getLogger(__name__)
+
+    # skip the timestamps that are already in the output
+    done = read_done_dates(out_path, date_label)
+    todo = ~pd.to_datetime(data.index).isin(done)
+    logger.info(f"{len(done)} timestamps already in {out_path}, {int(todo.sum())} left")
+    if not todo.any():
+        return 0
+
+    dates, arrays = format_for_pool(data.loc[todo], date_label, controllable_vars, noncontrollable_vars, np.asarray(control_bounds, dtype=float)[todo], np.asarray(outlet, dtype=float)[todo])
+    n_rows, n_controls = arrays['controls'].shape
+    arrays['result'] = np.full((n_rows, n_controls + len(RESULT_COLUMNS)), np.nan)
+    options = {'method': method, 'popsize': popsize, 'deadline': deadline, **(stopping or {})}
+    warm = {'tol': warm_tol, 'maxiter': warm_maxiter or max(maxiter // 5, 1)} if warm_start else None
+    chunks = make_chunks(n_rows, chunksize)
+
+    if max_in_flight is None:
+        max_in_flight = 2 * n_process
+    # decided from the file itself: a run killed after the header but before any row leaves a header and no dates
+    write_header = not os.path.exists(out_path) or os.path.getsize(out_path) == 0
+
+    # telemetry of the rows written in this run (for the summary)
+    telemetry = []
+    run_start = time.perf_counter()
+
+    with SharedArrays(arrays) as shared:
+        initargs = (None if model_path is not None else model, model_path, shared.spec, maxiter, c, options, warm, cache)
+
+        with _start_pool(n_process, initargs) as pool:
+            with tqdm(total=n_rows) as progress:
+                def write_chunk(pending_result):
+                    # get raises the error of a failed worker
+                    nonlocal write_header
+                    start, stop = pending_result.get()
+                    out = bind_optimization_results(dates[start:stop], shared['result'][start:stop], date_label, controllable_vars)
+                    out.to_csv(out_path, mode='a', header=write_header)
+                    write_header = False
+                    telemetry.append(out[RESULT_COLUMNS])
+                    progress.update(stop - start)
+
+                # bounded submission: the oldest pending chunk is written before the next one is queued
+                pending = deque()
+                for chunk in chunks:
+                    if len(pending) >= max_in_flight:
+                        write_chunk(pending.popleft())
+                    pending.append(pool.apply_async(_optimize_chunk, (chunk,)))
+                while pending:
+                    write_chunk(pending.popleft())
+
+    log_run_summary(pd.concat(telemetry), time.perf_counter() - run_start)
+
+    return n_rows
+
+
 def mp_optimization(
     data:pd.DataFrame, 
     date_label:str, 
@@ -177,10 +1245,23 @@ def mp_optimization(
     maxiter:int, 
     n_process:int,
     outlet,
-    c):
+    c,
+    method: str = 'annealing',
+    popsize: int = 64,
+    model_path: str = None,
+    chunksize: int = None,
+    warm_start: bool = False,
+    warm_tol: float = 0.05,
+    warm_maxiter: int = None,
+    stopping: dict = None,
+    cache: dict = None,
+    deadline: float = None,
+    cluster_tolerances: np.ndarray = None):
     """
     Function to run the optimizaion in the multiprocessing format
 
+    The inputs and the results live in shared memory, each worker loads the model once (pool initializer) and the tasks are contiguous row ranges
+
     Parameters
     ----------
     data : pd.DataFrame
@@ -191,14 +1272,36 @@ def mp_optimization(
         list of the names of the controllable columns
     noncontrollable_vars : List[str]
         list of the noncontrollable variables that are still used in the model
-    control_bounds : List[List[float, float]]
-        list of controls (lower, upper) for each controllable variables --- assumes order is the same as controllable_vars
+    control_bounds : np.ndarray | List[List[Tuple[float, float]]]
+        (lower, upper) for each controllable variable of each row (rows x controls x 2) --- assumes order is the same as controllable_vars
     model : Model
         model that implements .predict
     maxiter : int
         max iterations of each step of the optimization
     n_process : int
         number of processes to use
+    method : str
+        optimization method passed to run_optimization (see OPTIMIZATION_METHODS)
+    popsize : int
+        candidates per generation for the population search
+    model_path : str | None
+        if given, each worker loads the model from this path (pickle or FlatForest directory) instead of receiving the pickled model
+    chunksize : int | None
+        rows per task (default: about 8 tasks per process) --- with warm start each chunk is a block of consecutive timestamps
+    warm_start : bool
+        solve each chunk in time order, starting each row from the previous row's optimum
+    warm_tol : float
+        max state change (see state_change) for a row to get the reduced budget
+    warm_maxiter : int | None
+        reduced iteration budget (default: maxiter // 5)
+    stopping : Dict[str, ?] | None
+        adaptive stopping arguments of run_optimization (stop_tol, patience, max_evaluations)
+    cache : Dict[str, ?] | None
+        CachedModel arguments (resolution, max_size) of a per worker prediction cache that is cleared for every row --- None for no cache
+    deadline : float | None
+        wall clock budget of each row in seconds (see run_optimization) --- None to let the optimizer finish
+    cluster_tolerances : np.ndarray | None
+        if given, rows within these tolerances (controls, noncontrols, outlet) are optimized once (see cluster.py)
 
     Returns
     -------
@@ -206,15 +1309,188 @@ def mp_optimization(
         optimization results 
     """
     logger = logging.getLogger(__name__)
-    reformatted = format_for_pool(data, date_label, controllable_vars, noncontrollable_vars, control_bounds, model, maxiter, outlet, c)
 
-    logger.info(f"Running multiprocessing with {n_process} cores")
-    with mp.get_context("spawn").Pool(processes=n_process) as pool:
-        out = pool.starmap(run_optimization, tqdm(reformatted, total=len(reformatted[0])))
+    dates, arrays = format_for_pool(data, date_label, controllable_vars, noncontrollable_vars, control_bounds, outlet)
+
+    if cluster_tolerances is not None:
+        # only optimize one representative per cluster
+        rows = arrays
+        labels, arrays = cluster_rows(rows, cluster_tolerances)
+        logger.info(f"Clustering: {len(labels)} rows -> {len(arrays['controls'])} clusters ({len(labels) - len(arrays['controls'])} optimizations saved)")
+
+    n_rows, n_controls = arrays['controls'].shape
+    arrays['result'] = np.full((n_rows, n_controls + len(RESULT_COLUMNS)), np.nan)
+    options = {'method': method, 'popsize': popsize, 'deadline': deadline, **(stopping or {})}
+    warm = {'tol': warm_tol, 'maxiter': warm_maxiter or max(maxiter // 5, 1)} if warm_start else None
+
+    if chunksize is None:
+        chunksize = max(n_rows // (n_process * 8), 1)
+    chunks = make_chunks(n_rows, chunksize)
+
+    run_start = time.perf_counter()
+    with SharedArrays(arrays) as shared:
+        initargs = (None if model_path is not None else model, model_path, shared.spec, maxiter, c, options, warm, cache)
+        logger.info(f"Shared arrays: {shared.nbytes / 1e6:.2f} MB, worker initializer sends {len(pickle.dumps(initargs)) * n_process / 1e6:.2f} MB ({n_process} workers), {len(chunks)} chunks of {chunksize} rows")
+
+        with _start_pool(n_process, initargs) as pool:
+            with tqdm(total=n_rows) as progress:
+                for start, stop in pool.imap_unordered(_optimize_chunk, chunks):
+                    progress.update(stop - start)
+
+        result = shared['result'].copy()
+    seconds = time.perf_counter() - run_start
+
+    if cluster_tolerances is not None:
+        if model is None:
+            model = read_model(model_path)
+        error = approximation_error(model, rows, labels, arrays, result[:, :n_controls], c)
+        logger.info(f"Clustering: max approximation error {error.max():.4g} (mean {error.mean():.4g}) in the objective of the member rows")
+        result = result[labels]
+
+        # the objectives depend on the state of each member (the rest of the telemetry is the representative's)
+        objective_columns = n_controls + RESULT_COLUMNS.index('Nonoptimized_Objective'), n_controls + RESULT_COLUMNS.index('Optimized_Objective')
+        result[:, objective_columns[0]] = objective_values(rows['controls'], rows['noncontrols'], model, rows['outlet'], c)
+        result[:, objective_columns[1]] = objective_values(result[:, :n_controls], rows['noncontrols'], model, rows['outlet'], c)
 
     logger.info("Bind results to historical format")
-    result = bind_optimization_results(out, date_label, controllable_vars)
+    result = bind_optimization_results(dates, result, date_label, controllable_vars)
+    log_run_summary(result, seconds)
 
     return result
-    
-        
+
+
+def bind_sweep_results(dates, result, c_values, date_label:str, controls:List[str]):
+    """
+    Function to bind the sweep results into a long dataframe (one row per timestamp and c value)
+
+    Parameters
+    ----------
+    dates : List[datetime]
+        timestamp of each row
+    result : np.ndarray
+        result array written by the workers (rows x c values x (controls + SWEEP_COLUMNS))
+    c_values : List[float]
+        c values
+    date_label : str
+        date label
+    controls : List[str]
+        control variable labels
+
+    Returns
+    -------
+    out : pd.DataFrame
+        index is (date_label, c), columns are the optimized controls and SWEEP_COLUMNS
+    """
+    n_rows, n_c, n_columns = result.shape
+    index = pd.MultiIndex.from_product([pd.to_datetime(dates), c_values], names=[date_label, 'c'])
+    columns = [name+'_Optimized' for name in controls] + SWEEP_COLUMNS
+
+    out = pd.DataFrame(result.reshape(n_rows * n_c, n_columns), index=index, columns=columns)
+    out['Success'] = out['Success'].astype(bool)
+
+    return out
+
+
+def pareto_frontier(sweep):
+    """
+    Function to summarize a sweep into the fuel vs outlet deviation frontier (one point per c value)
+
+    Parameters
+    ----------
+    sweep : pd.DataFrame
+        output of bind_sweep_results
+
+    Returns
+    -------
+    frontier : pd.DataFrame
+        index is c, columns: mean Fuel, mean Outlet_Deviation and the success rate
+    """
+    return sweep.groupby(level='c').agg(Fuel=('Fuel', 'mean'), Outlet_Deviation=('Outlet_Deviation', 'mean'), Success=('Success', 'mean'))
+
+
+def mp_sweep_optimization(
+    data:pd.DataFrame, 
+    date_label:str, 
+    controllable_vars:List[str], 
+    noncontrollable_vars:List[str], 
+    control_bounds, 
+    model:Model, 
+    maxiter:int, 
+    n_process:int,
+    outlet,
+    c_values:List[float],
+    method: str = 'annealing',
+    popsize: int = 64,
+    model_path: str = None,
+    chunksize: int = None,
+    stopping: dict = None,
+    cache: dict = None):
+    """
+    Function to run the optimization for several c values in one run (see sweep_optimization) in the multiprocessing format
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        data of interest
+    date_label : str
+        label of the date 
+    controllable_vars : List[str]
+        list of the names of the controllable columns
+    noncontrollable_vars : List[str]
+        list of the noncontrollable variables that are still used in the model
+    control_bounds : np.ndarray | List[List[Tuple[float, float]]]
+        (lower, upper) for each controllable variable of each row (rows x controls x 2) --- assumes order is the same as controllable_vars
+    model : Model
+        model that implements .predict
+    maxiter : int
+        max iterations of each step of the optimization
+    n_process : int
+        number of processes to use
+    c_values : List[float]
+        c values to sweep
+    method : str
+        optimization method passed to run_optimization (see OPTIMIZATION_METHODS)
+    popsize : int
+        candidates per generation for the population search
+    model_path : str | None
+        if given, each worker loads the model from this path (pickle or FlatForest directory) instead of receiving the pickled model
+    chunksize : int | None
+        rows per task (default: about 8 tasks per process)
+    stopping : Dict[str, ?] | None
+        adaptive stopping and deadline arguments of run_optimization (stop_tol, patience, max_evaluations, deadline)
+    cache : Dict[str, ?] | None
+        CachedModel arguments (resolution, max_size) of the prediction cache shared by the c values of a row
+
+    Returns
+    -------
+    sweep : pd.DataFrame
+        one row per timestamp and c value (see bind_sweep_results)
+    frontier : pd.DataFrame
+        fuel vs outlet deviation for each c value (see pareto_frontier)
+    """
+    logger = logging.getLogger(__name__)
+
+    dates, arrays = format_for_pool(data, date_label, controllable_vars, noncontrollable_vars, control_bounds, outlet)
+    n_rows, n_controls = arrays['controls'].shape
+    arrays['result'] = np.full((n_rows, len(c_values), n_controls + len(SWEEP_COLUMNS)), np.nan)
+    options = {'method': method, 'popsize': popsize, 'stopping': stopping, 'cache': cache}
+
+    if chunksize is None:
+        chunksize = max(n_rows // (n_process * 8), 1)
+    chunks = make_chunks(n_rows, chunksize)
+    n_scored = n_predicted = 0
+
+    with SharedArrays(arrays) as shared:
+        initargs = (None if model_path is not None else model, model_path, shared.spec, maxiter, list(c_values), options)
+
+        with _start_pool(n_process, initargs) as pool:
+            with tqdm(total=n_rows) as progress:
+                for (start, stop), chunk_scored, chunk_predicted in pool.imap_unordered(_sweep_chunk, chunks):
+                    n_scored += chunk_scored
+                    n_predicted += chunk_predicted
+                    progress.update(stop - start)
+
+        logger.info(f"{n_scored} candidate evaluations across {len(c_values)} c values needed {n_predicted} model predictions ({1 - n_predicted / max(n_scored, 1):.1%} shared)")
+        sweep = bind_sweep_results(dates, shared['result'].copy(), list(c_values), date_label, controllable_vars)
+
+    return sweep, pareto_frontier(sweep)
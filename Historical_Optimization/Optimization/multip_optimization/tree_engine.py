@@ -0,0 +1,358 @@
+"""
+Array backed inference for the fitted tree ensembles (RandomForestRegressor / XGBRegressor) used by the optimization
+
+The trees of a fitted ensemble are flattened into contiguous numpy arrays (one entry per node across every tree):
+    feature   : index of the split feature
+    threshold : go left when x <= threshold
+    left      : global index of the left child
+    right     : global index of the right child
+    value     : leaf value (0 for internal nodes)
+
+Leaves point to themselves (threshold = inf) so every row can be pushed through every tree for a fixed number of steps (max depth) with
+a handful of vectorized numpy operations. A FlatForest implements predict so it can be passed anywhere a Model is expected (run_optimization,
+mp_optimization, ...).
+
+Usage
+-----
+model = read_pickle('rf_furnace_a.pkl')
+engine = compile_model(model)
+check_parity(engine, model, data)
+"""
+import json
+import numpy as np
+import os
+import os.path as osp
+
+# arrays written by FlatForest.save (one .npy file each) --- everything else goes in meta.json
+ARRAY_NAMES = ['feature', 'threshold', 'left', 'right', 'value', 'missing_left', 'roots', 'children']
+
+
+class ParityError(Exception):
+    def __init__(self, max_error, tolerance) -> None:
+        self.max_error = max_error
+        self.tolerance = tolerance
+
+    def __str__(self) -> str:
+        return f"Compiled model does not match the original model: max absolute error {self.max_error:.3e} > tolerance {self.tolerance:.3e}"
+
+
+class UnsupportedModel(Exception):
+    def __init__(self, model) -> None:
+        self.model = model
+
+    def __str__(self) -> str:
+        return f"{type(self.model).__name__} is not supported. Supported models are fitted sklearn tree ensembles (RandomForestRegressor, ExtraTreesRegressor) and XGBRegressor"
+
+
+def _node_depths(left, right):
+    """
+    Function to compute the depth of every node of a single tree (root is node 0)
+
+    Parameters
+    ----------
+    left : np.ndarray
+        left child of each node (-1 for leaves)
+    right : np.ndarray
+        right child of each node (-1 for leaves)
+
+    Returns
+    -------
+    depth : np.ndarray
+        depth of each node
+    """
+    depth = np.zeros(len(left), dtype=np.int64)
+    stack = [0]
+    while stack:
+        node = stack.pop()
+        for child in (left[node], right[node]):
+            if child != -1:
+                depth[child] = depth[node] + 1
+                stack.append(child)
+    return depth
+
+
+class FlatForest(object):
+    """
+    Tree ensemble flattened into contiguous numpy node arrays
+
+    prediction = base_score + scale * sum(leaf value of each tree)
+        RandomForest: base_score = 0, scale = 1 / n_trees
+        XGBoost: base_score = model base score, scale = 1
+    """
+
+    def __init__(self, feature, threshold, left, right, value, missing_left, roots, max_depth, n_features, scale=1.0, base_score=0.0, children=None) -> None:
+        self.feature = np.ascontiguousarray(feature, dtype=np.int64)
+        self.threshold = np.ascontiguousarray(threshold, dtype=np.float64)
+        self.left = np.ascontiguousarray(left, dtype=np.int64)
+        self.right = np.ascontiguousarray(right, dtype=np.int64)
+        self.value = np.ascontiguousarray(value, dtype=np.float64)
+        self.missing_left = np.ascontiguousarray(missing_left, dtype=bool)
+        self.roots = np.ascontiguousarray(roots, dtype=np.int64)
+        self.max_depth = int(max_depth)
+        self.n_features = int(n_features)
+        self.scale = float(scale)
+        self.base_score = float(base_score)
+        # interleaved children: children[2 * node + go_left] is the next node
+        if children is None:
+            children = np.stack([self.right, self.left], axis=1).ravel()
+        self.children = np.ascontiguousarray(children, dtype=np.int64)
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @property
+    def n_nodes(self):
+        return len(self.feature)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in ARRAY_NAMES)
+
+    def save(self, path):
+        """
+        Function to save the node arrays to a directory (one .npy file per array) so they can be memory mapped by FlatForest.load
+
+        Parameters
+        ----------
+        path : str
+            output directory (created if it does not exist)
+        """
+        os.makedirs(path, exist_ok=True)
+
+        for name in ARRAY_NAMES:
+            np.save(osp.join(path, f"{name}.npy"), getattr(self, name))
+
+        meta = {'max_depth': self.max_depth, 'n_features': self.n_features, 'scale': self.scale, 'base_score': self.base_score}
+        with open(osp.join(path, 'meta.json'), 'w') as fp:
+            json.dump(meta, fp, indent=4)
+
+        return
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Function to load a FlatForest saved with FlatForest.save
+
+        Parameters
+        ----------
+        path : str
+            directory written by FlatForest.save
+        mmap_mode : str | None
+            numpy memory map mode --- with the default ('r') the node arrays are shared through the page cache by every process that loads them
+
+        Returns
+        -------
+        forest : FlatForest
+            flattened ensemble
+        """
+        with open(osp.join(path, 'meta.json'), 'r') as fp:
+            meta = json.load(fp)
+
+        arrays = {name: np.load(osp.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in ARRAY_NAMES}
+
+        return cls(**arrays, **meta)
+
+    @classmethod
+    def from_trees(cls, trees, n_features, scale=1.0, base_score=0.0):
+        """
+        Function to concatenate single trees (local node indices, -1 for leaf children) into a FlatForest
+
+        Parameters
+        ----------
+        trees : List[Tuple[np.ndarray, ...]]
+            one (feature, threshold, left, right, value, missing_left) tuple per tree
+        n_features : int
+            number of input features
+        scale : float
+            scale applied to the sum of the tree outputs
+        base_score : float
+            constant added to the prediction
+
+        Returns
+        -------
+        forest : FlatForest
+            flattened ensemble
+        """
+        features, thresholds, lefts, rights, values, missing = [], [], [], [], [], []
+        roots = np.zeros(len(trees), dtype=np.int64)
+        max_depth = 0
+        offset = 0
+
+        for i, (feature, threshold, left, right, value, missing_left) in enumerate(trees):
+            left = np.asarray(left, dtype=np.int64)
+            right = np.asarray(right, dtype=np.int64)
+            n_nodes = len(left)
+            is_leaf = left == -1
+            own = np.arange(n_nodes)
+
+            # leaves point to themselves and always go "left"
+            features.append(np.where(is_leaf, 0, feature))
+            thresholds.append(np.where(is_leaf, np.inf, threshold))
+            lefts.append(np.where(is_leaf, own, left) + offset)
+            rights.append(np.where(is_leaf, own, right) + offset)
+            values.append(np.where(is_leaf, value, 0.0))
+            missing.append(np.where(is_leaf, True, missing_left))
+
+            roots[i] = offset
+            max_depth = max(max_depth, int(_node_depths(left, right).max()))
+            offset += n_nodes
+
+        return cls(
+            np.concatenate(features), np.concatenate(thresholds), np.concatenate(lefts), np.concatenate(rights),
+            np.concatenate(values), np.concatenate(missing), roots, max_depth, n_features, scale=scale, base_score=base_score
+            )
+
+    @classmethod
+    def from_sklearn(cls, model):
+        """
+        Function to flatten a fitted sklearn tree ensemble (RandomForestRegressor, ExtraTreesRegressor)
+
+        Parameters
+        ----------
+        model : sklearn.ensemble.RandomForestRegressor
+            fitted model (single output)
+
+        Returns
+        -------
+        forest : FlatForest
+            flattened ensemble
+        """
+        trees = []
+        for estimator in model.estimators_:
+            tree = estimator.tree_
+            # older versions of sklearn do not support missing values (NaN goes right)
+            missing_left = getattr(tree, 'missing_go_to_left', np.zeros(tree.node_count, dtype=bool)).astype(bool)
+            trees.append((tree.feature, tree.threshold, tree.children_left, tree.children_right, tree.value[:, 0, 0], missing_left))
+
+        return cls.from_trees(trees, model.n_features_in_, scale=1.0 / len(trees))
+
+    @classmethod
+    def from_xgboost(cls, model):
+        """
+        Function to flatten a fitted XGBRegressor (or Booster) trained with the reg:squarederror objective
+
+        Parameters
+        ----------
+        model : xgboost.XGBRegressor | xgboost.Booster
+            fitted model
+
+        Returns
+        -------
+        forest : FlatForest
+            flattened ensemble
+        """
+        booster = model.get_booster() if hasattr(model, 'get_booster') else model
+        dump = json.loads(bytes(booster.save_raw(raw_format='json')))
+        learner = dump['learner']
+
+        # base_score is stored as a string: "5E-1" or "[5E-1]" depending on the version
+        base_score = float(learner['learner_model_param']['base_score'].strip('[]'))
+        n_features = int(learner['learner_model_param']['num_feature'])
+
+        trees = []
+        for tree in learner['gradient_booster']['model']['trees']:
+            left = np.asarray(tree['left_children'], dtype=np.int64)
+            right = np.asarray(tree['right_children'], dtype=np.int64)
+            # xgboost goes left when x < split (float32) ... convert to x <= largest float32 below the split
+            split = np.asarray(tree['split_conditions'], dtype=np.float32)
+            threshold = np.nextafter(split, np.float32(-np.inf)).astype(np.float64)
+            # leaf values are stored in split_conditions for the leaves
+            value = split.astype(np.float64)
+            trees.append((tree['split_indices'], threshold, left, right, value, np.asarray(tree['default_left'], dtype=bool)))
+
+        return cls.from_trees(trees, n_features, scale=1.0, base_score=base_score)
+
+    def predict(self, formatted_data):
+        """
+        Function to predict a batch of rows (or a single row)
+
+        Parameters
+        ----------
+        formatted_data : np.ndarray | pd.DataFrame
+            input data (n_rows x n_features) or a single row (n_features,)
+
+        Returns
+        -------
+        out : np.ndarray
+            prediction for each row (n_rows,)
+        """
+        # the trees compare float32 inputs (same as sklearn and xgboost)
+        X = np.atleast_2d(np.asarray(formatted_data, dtype=np.float32))
+        n_rows, n_features = X.shape
+        has_missing = np.isnan(X).any()
+
+        # one (row, tree) pair per entry ... rows are looked up in the raveled data
+        flat = X.ravel()
+        row_offset = np.repeat(np.arange(n_rows) * n_features, self.n_trees)
+        node = np.tile(self.roots, n_rows)
+
+        for _ in range(self.max_depth):
+            x = flat[row_offset + self.feature[node]]
+            go_left = x <= self.threshold[node]
+            if has_missing:
+                go_left |= np.isnan(x) & self.missing_left[node]
+            node = self.children[2 * node + go_left]
+
+        return self.base_score + self.scale * self.value[node].reshape(n_rows, self.n_trees).sum(axis=1)
+
+
+def compile_model(model):
+    """
+    Function to flatten a fitted model into a FlatForest
+
+    Parameters
+    ----------
+    model : Model
+        fitted RandomForestRegressor / ExtraTreesRegressor / XGBRegressor (a FlatForest is returned as is)
+
+    Returns
+    -------
+    forest : FlatForest
+        flattened ensemble
+    """
+    if isinstance(model, FlatForest):
+        return model
+    if hasattr(model, 'get_booster') or type(model).__name__ == 'Booster':
+        return FlatForest.from_xgboost(model)
+    if hasattr(model, 'estimators_') and all(hasattr(estimator, 'tree_') for estimator in model.estimators_):
+        return FlatForest.from_sklearn(model)
+    raise UnsupportedModel(model)
+
+
+def check_parity(engine, model, data, rtol=1e-5, atol=1e-6):
+    """
+    Function to check the compiled model against the original model's predict
+
+    Parameters
+    ----------
+    engine : FlatForest
+        compiled model
+    model : Model
+        original model
+    data : np.ndarray | pd.DataFrame
+        rows to compare the predictions on (columns in the order the model was trained on)
+    rtol : float
+        relative tolerance (xgboost accumulates the leaves in float32)
+    atol : float
+        absolute tolerance
+
+    Returns
+    -------
+    max_error : float
+        max absolute difference between the two predictions
+
+    Raises
+    ------
+    ParityError
+        if any difference is greater than atol + rtol * abs(original prediction)
+    """
+    data = np.asarray(data, dtype=np.float64)
+    reference = np.asarray(model.predict(data), dtype=np.float64).ravel()
+    error = np.abs(engine.predict(data) - reference)
+    max_error = float(error.max())
+
+    if np.any(error > atol + rtol * np.abs(reference)):
+        raise ParityError(max_error, float(np.max(atol + rtol * np.abs(reference))))
+
+    return max_error